@@ -0,0 +1,167 @@
+"""Long-running local agent that keeps identity, trust and peer connections warm.
+
+`myshare agent` runs it; `myshare send` hands its work to a running agent
+over a Unix socket (see agent_client) and sends in-process when there is
+none. The agent keeps the loaded keys, trust store and device registry in
+memory, plus one keep-alive connection pool per recently used peer, so a
+send skips key loading, /info negotiation and TLS handshakes. New
+connections resume cached TLS sessions (see transfer.tls).
+"""
+import asyncio
+import json
+import os
+import time
+from aiohttp import ClientSession, TCPConnector
+from . import agent_client
+from .device_registry import DeviceRegistry
+from .discovery.mdns import MDNSDiscovery
+from .security.identity import Identity
+from .security.trust_store import TrustStore
+from .transfer.client import TransferClient
+from .transfer.paths import url_host
+from .transfer.tls import client_context
+
+PEER_IDLE_TIMEOUT = 600  # Close a peer's connection pool after this long unused
+KEEPALIVE_TIMEOUT = 60  # Below the receiver's 75 s keep-alive, so it never closes a connection being reused
+POOL_LIMIT = 16  # Connections kept open per peer
+
+
+class Agent:
+    """Serve CLI requests from memory-resident state over a Unix socket."""
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or agent_client.agent_socket()
+        self.identity = Identity()
+        self.identity.public_key  # Load the signing key now rather than on the first send
+        self.trust_store = TrustStore()
+        self.registry = DeviceRegistry(self.identity.config_dir)
+        self.mdns = MDNSDiscovery(self.identity)
+        self.clients = {}  # (compress, use_channel) -> TransferClient; each keeps its hash and /info caches
+        self.peers = {}  # base_url -> [ClientSession, last used, sends in progress]
+        self.started = time.time()
+        self.stopping = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, agent_client.request, {'command': 'ping'}, self.socket_path) is not None:
+            raise Exception(f"An agent is already running on {self.socket_path}")
+        self.socket_path.unlink(missing_ok=True)
+        # Only this user may talk to the agent; it signs with their identity
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(
+                self.handle_client, str(self.socket_path), limit=agent_client.MAX_MESSAGE_SIZE)
+        finally:
+            os.umask(old_umask)
+        self.stopping = asyncio.Event()
+        reaper = asyncio.create_task(self.close_idle_peers())
+        watcher = asyncio.create_task(self.mdns.watch(self.registry))  # Keeps device addresses fresh
+        print(f"Agent listening on {self.socket_path}")
+        try:
+            async with server:
+                await self.stopping.wait()
+        finally:
+            reaper.cancel()
+            watcher.cancel()
+            for session, _, _ in self.peers.values():
+                await session.close()
+            self.socket_path.unlink(missing_ok=True)
+
+    async def handle_client(self, reader, writer):
+        """Answer one JSON request line with one JSON reply line."""
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                message = json.loads(line)
+                reply = await self.dispatch(message)
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e) or type(e).__name__}
+            writer.write(json.dumps(reply).encode() + b'\n')
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass  # CLI went away, or sent an over-long line
+        finally:
+            writer.close()
+
+    async def dispatch(self, message):
+        command = message.get('command')
+        if command == 'ping':
+            return {
+                'ok': True,
+                'pid': os.getpid(),
+                'device_id': self.identity.device_id,
+                'uptime': time.time() - self.started,
+                'peers': sorted(self.peers),
+                'tls': client_context().stats.as_dict(),
+            }
+        if command == 'stop':
+            self.stopping.set()
+            return {'ok': True}
+        if command == 'send':
+            return await self.send(message)
+        return {'ok': False, 'error': f"Unknown command: {command}"}
+
+    async def send(self, message):
+        """Send to one device, or to several at once; summaries are keyed by the IDs given."""
+        targets, error = await self.resolve_devices(message.get('devices') or [message['device']])
+        if error:
+            return {'ok': False, 'error': error}
+        client = self.client(message.get('compress', True), message.get('channel', False))
+        targets = await client.choose_addresses(targets)
+        peers = {f"https://{url_host(d['address'])}:{d['port']}": self.peer(d['address'], d['port'])
+                 for d in targets.values()}
+        for peer in peers.values():
+            peer[2] += 1
+        concurrency, streams = message.get('concurrency', 4), message.get('streams')
+        stats = None
+        try:
+            if len(targets) == 1:
+                (device, device_info), = targets.items()
+                summaries = {device: await client.send_files(
+                    device_info['address'], device_info['port'], message['paths'], device_info['device_id'],
+                    concurrency=concurrency, streams=streams, session=next(iter(peers.values()))[0])}
+            else:
+                results, stats = await client.send_files_many(
+                    [(d['address'], d['port'], d['device_id']) for d in targets.values()], message['paths'],
+                    concurrency, streams, sessions={base_url: peer[0] for base_url, peer in peers.items()},
+                    swarm=message.get('swarm', False))
+                summaries = {device: results[d['device_id']] for device, d in targets.items()}
+        finally:
+            for peer in peers.values():
+                peer[1] = time.monotonic()
+                peer[2] -= 1
+        return {'ok': True, 'summaries': summaries, 'stats': stats}
+
+    def client(self, compress, use_channel):
+        key = (compress, use_channel)
+        if key not in self.clients:
+            self.clients[key] = TransferClient(self.identity, self.trust_store, compress=compress,
+                                               use_channel=use_channel)
+            if len(self.clients) > 1:
+                self.clients[key].paths = next(iter(self.clients.values())).paths  # One view of path speeds
+        return self.clients[key]
+
+    def peer(self, address, port):
+        """Return the pool entry for a peer, opening a ClientSession on first use."""
+        base_url = f"https://{url_host(address)}:{port}"
+        peer = self.peers.get(base_url)
+        if peer is None or peer[0].closed:
+            connector = TCPConnector(limit=POOL_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            peer = self.peers[base_url] = [ClientSession(connector=connector), time.monotonic(), 0]
+        return peer
+
+    async def close_idle_peers(self):
+        while True:
+            await asyncio.sleep(PEER_IDLE_TIMEOUT / 10)
+            now = time.monotonic()
+            for base_url, (session, last_used, active) in list(self.peers.items()):
+                if not active and now - last_used > PEER_IDLE_TIMEOUT:
+                    del self.peers[base_url]
+                    await session.close()
+
+    async def resolve_devices(self, device_ids):
+        """Look devices up by short or full ID; return ({device_id: device_info}, error message)."""
+        # Queries the registry database, so entries `myshare search` and the listener add are seen at once
+        return await self.mdns.lookup(self.registry, device_ids)
@@ -0,0 +1,33 @@
+"""Client side of the background agent's Unix socket protocol.
+
+Requests and replies are single JSON objects, one per line. This module
+only uses the standard library, so the CLI can hand work to a running
+agent without loading keys, trust data or the HTTP stack itself.
+"""
+import json
+import socket
+from pathlib import Path
+
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # Longest request line the agent accepts
+
+
+def agent_socket():
+    return Path.home() / '.myshare' / 'agent.sock'
+
+
+def request(message, socket_path=None):
+    """Send one request to the agent and return its reply, or None if no agent is running."""
+    path = socket_path or agent_socket()
+    if not hasattr(socket, 'AF_UNIX') or not path.exists():
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError:
+            return None  # Stale socket left behind by an agent that exited
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        with sock.makefile('rb') as reply:
+            line = reply.readline()
+    if not line:
+        raise Exception("Agent closed the connection")
+    return json.loads(line)
@@ -0,0 +1,297 @@
+"""Loopback transfer benchmarks behind `myshare bench`.
+
+Each scenario generates a synthetic file set, starts a TransferServer on
+localhost in a child process with a throwaway identity under a temporary
+home directory, and sends the set with TransferClient from a second child
+process. Separate processes keep CPU time and peak RSS apart for the two
+sides. Each scenario can be run several times and reports the median of
+every metric, since a single loopback run varies by more than the
+regressions worth catching. Results are plain dicts, written as JSON by
+the CLI so runs can be compared for regressions.
+"""
+import asyncio
+import multiprocessing
+import os
+import pathlib
+import platform
+import random
+import resource
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+MIB = 1024 * 1024
+# name -> (file count, smallest file, largest file); --scale multiplies counts, or the size of a single file
+SCENARIOS = {
+    'huge': (1, 1024 * MIB, 1024 * MIB),
+    'medium': (64, 8 * MIB, 8 * MIB),
+    'tiny': (20_000, 0, 4096),
+}
+# Metrics compared against a baseline; True where higher is better
+COMPARED = {
+    'mb_per_s': True,
+    'files_per_s': True,
+    'latency_p50': False,
+    'latency_p99': False,
+    'client_cpu_seconds': False,
+    'server_cpu_seconds': False,
+}
+RESULTS_VERSION = 1
+
+
+def scenario_files(name, scale):
+    """Return (count, smallest, largest) for a scenario at the given scale."""
+    count, smallest, largest = SCENARIOS[name]
+    if count == 1:
+        size = max(1, int(largest * scale))
+        return 1, size, size
+    return max(1, int(count * scale)), smallest, largest
+
+
+def generate(root, name, scale):
+    """Write a scenario's files of random bytes under root/name; return (directory, files, bytes)."""
+    count, smallest, largest = scenario_files(name, scale)
+    directory = root / name
+    rng = random.Random(name)
+    total = 0
+    for i in range(count):
+        size = rng.randint(smallest, largest)
+        path = directory / f'{i % 100:02d}' / f'{i:06d}.bin' if count > 100 else directory / f'{i:06d}.bin'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining:
+                chunk = min(remaining, 4 * MIB)
+                f.write(rng.randbytes(chunk))
+                remaining -= chunk
+        total += size
+    return directory, count, total
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def usage():
+    """CPU seconds and peak RSS (MB) of this process so far."""
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = rusage.ru_maxrss / (MIB if sys.platform == 'darwin' else 1024)
+    return rusage.ru_utime + rusage.ru_stime, peak
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def serve(home, port, fsync, conn):
+    """Child process: run a receiver until told to stop, then report its CPU time and peak RSS."""
+    os.environ['HOME'] = home
+    sys.stdout = open(os.devnull, 'w')
+    from .security.identity import Identity
+    from .security.trust_store import TrustStore
+    from .transfer.server import TransferServer
+
+    server = TransferServer(Identity(), TrustStore(), port, fsync=fsync)
+
+    async def run():
+        task = asyncio.create_task(server.run())
+        while True:
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+        cpu_start, _ = usage()
+        conn.send(server.identity.device_id)
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return cpu_start
+
+    cpu_start = asyncio.run(run())
+    cpu_end, peak = usage()
+    conn.send({'cpu_seconds': cpu_end - cpu_start, 'peak_rss_mb': peak})
+
+
+def send(home, port, device_id, directory, options, conn):
+    """Child process: send a directory to the receiver once and report what it took."""
+    os.environ['HOME'] = home
+    sys.stdout = open(os.devnull, 'w')
+    from aiohttp import ClientSession, TCPConnector, TraceConfig
+    from .security.identity import Identity
+    from .security.trust_store import TrustStore
+    from .transfer.client import TransferClient
+
+    latencies = []
+
+    async def request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def request_end(session, context, params):
+        latencies.append(time.perf_counter() - context.start)
+
+    trace = TraceConfig()
+    trace.on_request_start.append(request_start)
+    trace.on_request_end.append(request_end)
+
+    client = TransferClient(Identity(), TrustStore(), compress=options['compress'],
+                            use_channel=options['channel'])
+
+    async def run():
+        connector = TCPConnector(limit=options['concurrency'])
+        async with ClientSession(connector=connector, trace_configs=[trace]) as session:
+            start = time.perf_counter()
+            summary = await client.send_files('127.0.0.1', port, [directory], device_id,
+                                              concurrency=options['concurrency'], session=session)
+            return summary, time.perf_counter() - start
+
+    cpu_start, _ = usage()
+    try:
+        summary, elapsed = asyncio.run(run())
+    except Exception as e:
+        conn.send({'error': str(e) or type(e).__name__})
+        return
+    cpu_end, peak = usage()
+    conn.send({
+        'seconds': elapsed,
+        'summary': summary,
+        'latencies': latencies,
+        'cpu_seconds': cpu_end - cpu_start,
+        'peak_rss_mb': peak,
+    })
+
+
+def run_scenario(name, scale, options, work_dir):
+    """Run one scenario with a fresh receiver and sender; return its result dict."""
+    directory, count, total = generate(work_dir / 'data', name, scale)
+    context = multiprocessing.get_context('spawn')
+    server_home = tempfile.mkdtemp(prefix='rx-', dir=work_dir)
+    client_home = tempfile.mkdtemp(prefix='tx-', dir=work_dir)
+    port = free_port()
+
+    def start(target, *args):
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=target, args=args + (child_conn,), daemon=True)
+        process.start()
+        child_conn.close()  # So recv() raises EOFError if the child dies
+        return process, conn
+
+    server, server_conn = start(serve, server_home, port, options['fsync'])
+    client = None
+    try:
+        try:
+            device_id = server_conn.recv()
+            client, client_conn = start(send, client_home, port, device_id, str(directory), options)
+            sent = client_conn.recv()
+            client.join()
+            server_conn.send('stop')
+            served = server_conn.recv()
+            server.join()
+        except EOFError:
+            sent = {'error': "A benchmark process exited unexpectedly"}
+    finally:
+        for process in (server, client):
+            if process is not None and process.is_alive():
+                process.kill()
+        shutil.rmtree(work_dir / 'data', ignore_errors=True)
+        shutil.rmtree(server_home, ignore_errors=True)
+        shutil.rmtree(client_home, ignore_errors=True)
+
+    if 'error' in sent:
+        return {'files': count, 'bytes': total, 'error': sent['error']}
+    seconds = max(sent['seconds'], 1e-9)
+    summary = sent['summary']
+    return {
+        'files': count,
+        'bytes': total,
+        'seconds': seconds,
+        'mb_per_s': total / MIB / seconds,
+        'files_per_s': count / seconds,
+        'requests': len(sent['latencies']),
+        'latency_p50': percentile(sent['latencies'], 0.5),
+        'latency_p99': percentile(sent['latencies'], 0.99),
+        'failed': len(summary['failed']),
+        'tls': summary['tls'],
+        'client_cpu_seconds': sent['cpu_seconds'],
+        'client_peak_rss_mb': sent['peak_rss_mb'],
+        'server_cpu_seconds': served['cpu_seconds'],
+        'server_peak_rss_mb': served['peak_rss_mb'],
+    }
+
+
+def median_result(runs):
+    """Combine repeated runs of a scenario into one result holding the median of each measurement.
+
+    A failed run makes the whole scenario report that failure.
+    """
+    for result in runs:
+        if 'error' in result:
+            return result
+    combined = dict(runs[0], runs=len(runs))
+    for key, value in runs[0].items():
+        if isinstance(value, (int, float)) and key not in ('files', 'bytes'):
+            combined[key] = statistics.median(result[key] for result in runs)
+    combined['failed'] = max(result['failed'] for result in runs)
+    return combined
+
+
+def run_benchmarks(names, scale=1.0, concurrency=4, compress=False, channel=False, fsync='never',
+                   progress=None, runs=1):
+    """Run the named scenarios in order, each `runs` times; return the results document.
+
+    progress(name, result), if given, is called as each scenario finishes.
+    """
+    options = {'concurrency': concurrency, 'compress': compress, 'channel': channel, 'fsync': fsync}
+    results = {
+        'version': RESULTS_VERSION,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'options': dict(options, scale=scale, runs=runs),
+        'scenarios': {},
+    }
+    work_dir = pathlib.Path(tempfile.mkdtemp(prefix='myshare-bench-'))
+    try:
+        for name in names:
+            result = median_result([run_scenario(name, scale, options, work_dir) for _ in range(runs)])
+            results['scenarios'][name] = result
+            if progress is not None:
+                progress(name, result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=0.10):
+    """Yield (scenario, metric, baseline value, new value, relative change, regressed) for shared metrics.
+
+    A change counts as a regression when it moves the metric the wrong
+    way by more than `threshold` of the baseline value.
+    """
+    for name, result in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if not old:
+            continue
+        for metric, higher_is_better in COMPARED.items():
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = change < 0 if higher_is_better else change > 0
+            yield name, metric, before, after, change, worse and abs(change) > threshold
@@ -3,8 +3,6 @@ Camera-based file grabbing using gesture recognition.
 Point camera at files displayed on screen and gesture to grab them.
 """
 
-import cv2
-import numpy as np
 from pathlib import Path
 from datetime import datetime
 import json
@@ -49,6 +47,8 @@ class CameraGrab:
 
     def detect_hand_position(self, frame, mask):
         """Detect hand position in frame."""
+        import cv2
+
         contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
         
         if not contours:
@@ -68,6 +68,10 @@ class CameraGrab:
         Open camera and show files on screen.
         User points hand at a file and moves hand UP to grab it.
         """
+        # OpenCV is slow to import and only needed here, not for the grab state
+        import cv2
+        import numpy as np
+
         cap = cv2.VideoCapture(0)
         
         if not cap.isOpened():
@@ -1,63 +1,193 @@
-"""Device registry for managing discovered devices with simple IDs."""
+"""Device registry for managing discovered devices with simple IDs.
+
+It doubles as the persistent discovery cache: every entry records when
+the device was last seen and until when its mDNS records are valid, so
+an address can be used straight away while fresh and rechecked once stale.
+
+Entries live in a SQLite database indexed by short ID, device ID and
+public key fingerprint. Each change is a small transaction instead of a
+rewrite of the whole registry, and the listener's browser, the agent and
+CLI commands can read and write it at the same time. A device_registry.json
+from earlier versions is imported on first use.
+"""
+import contextlib
 import json
+import os
+import sqlite3
+import threading
+import time
 from pathlib import Path
 
+DEFAULT_TTL = 120  # Seconds an entry stays fresh when added without a TTL
+BUSY_TIMEOUT = 10  # Seconds to wait for another process's write to finish
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    number INTEGER PRIMARY KEY,  -- The short ID, shown zero-padded to 4 digits
+    device_id TEXT NOT NULL UNIQUE,
+    device_name TEXT,
+    address TEXT,
+    addresses TEXT,  -- JSON list
+    port INTEGER,
+    pubkey_fingerprint TEXT,
+    seen_at REAL,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS devices_fingerprint ON devices (pubkey_fingerprint);
+"""
+COLUMNS = 'number, device_id, device_name, address, addresses, port, pubkey_fingerprint, seen_at, expires'
+
 
 class DeviceRegistry:
     """Maintain a registry of discovered devices with simple 4-digit IDs."""
 
     def __init__(self, config_dir: Path):
         self.config_dir = config_dir
-        self.registry_file = config_dir / "device_registry.json"
-        self.registry = self.load()
+        self.registry_file = config_dir / "device_registry.db"
+        self.legacy_file = config_dir / "device_registry.json"
+        # Autocommit, so every change is its own transaction unless grouped with batch().
+        # Used from executor threads by the mDNS watcher, so every use holds the lock
+        self.db = sqlite3.connect(self.registry_file, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                  check_same_thread=False)
+        self.lock = threading.RLock()  # Reentrant, as batch() holds it across the changes it groups
+        self.db.execute('PRAGMA journal_mode=WAL')  # Readers never wait for a writer
+        self.db.execute('PRAGMA synchronous=NORMAL')  # A lost entry is found again by the next browse
+        self.db.executescript(SCHEMA)
+        self.in_batch = False
+        if self.legacy_file.exists():
+            self.import_legacy()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group changes into one transaction, e.g. every device found by one browse."""
+        with self.lock:
+            if self.in_batch:
+                yield
+                return
+            self.db.execute('BEGIN IMMEDIATE')
+            self.in_batch = True
+            try:
+                yield
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            else:
+                self.db.execute('COMMIT')
+            finally:
+                self.in_batch = False
+
+    def import_legacy(self):
+        """Move the entries of a JSON registry into the database, keeping their short IDs."""
+        try:
+            with open(self.legacy_file, 'r') as f:
+                legacy = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.batch():
+            for short_id, info in legacy.items():
+                if short_id.isdigit():
+                    self.db.execute(
+                        f'INSERT OR IGNORE INTO devices ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (int(short_id), info['device_id'], info.get('device_name'), info.get('address'),
+                         json.dumps(info.get('addresses') or [info.get('address')]), info.get('port'),
+                         info.get('pubkey_fingerprint'), info.get('seen_at', 0), info.get('expires', 0)))
+        with contextlib.suppress(FileNotFoundError):  # Another process imported it at the same time
+            os.replace(self.legacy_file, self.legacy_file.with_suffix('.json.imported'))
 
     def load(self):
-        """Load device registry from file."""
-        if self.registry_file.exists():
-            with open(self.registry_file, 'r') as f:
-                return json.load(f)
-        return {}
+        """Load the whole registry as {short ID: device info}."""
+        with self.lock:
+            rows = self.db.execute(f'SELECT {COLUMNS} FROM devices ORDER BY number').fetchall()
+        return {info['short_id']: info for info in map(self.row_info, rows)}
+
+    @property
+    def registry(self):
+        """The whole registry as {short ID: device info}, read from the database each time."""
+        return self.load()
+
+    def reload(self):
+        """Pick up entries other processes added; reads always see the database, so nothing to do."""
 
     def save(self):
-        """Save device registry to file."""
-        with open(self.registry_file, 'w') as f:
-            json.dump(self.registry, f, indent=2)
-
-    def add_device(self, device_id, device_name, address, port, pubkey_fingerprint):
-        """Add a device to the registry, auto-assigning a 4-digit ID."""
-        # Generate next available 4-digit ID
-        existing_ids = [int(k) for k in self.registry.keys() if k.isdigit()]
-        next_id = max(existing_ids) + 1 if existing_ids else 1
-        short_id = f"{next_id:04d}"
-        
-        self.registry[short_id] = {
-            'device_id': device_id,
-            'device_name': device_name,
-            'address': address,
-            'port': port,
-            'pubkey_fingerprint': pubkey_fingerprint
-        }
-        self.save()
-        return short_id
+        """Save device registry; changes are written as they are made, so nothing to do."""
+
+    def add_device(self, device_id, device_name, address, port, pubkey_fingerprint, ttl=DEFAULT_TTL,
+                   addresses=None):
+        """Add or refresh a device, auto-assigning a 4-digit ID; a known device keeps its ID.
+
+        ttl is how many seconds the address stays fresh. addresses lists
+        every address the device advertised, address being its primary one.
+        """
+        now = time.time()
+        with self.batch():
+            # The next number is one past the highest, read from the end of the primary key index
+            self.db.execute(
+                'INSERT INTO devices (device_id, device_name, address, addresses, port, pubkey_fingerprint, '
+                'seen_at, expires) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (device_id) DO UPDATE SET device_name = excluded.device_name, '
+                'address = excluded.address, addresses = excluded.addresses, port = excluded.port, '
+                'pubkey_fingerprint = excluded.pubkey_fingerprint, seen_at = excluded.seen_at, '
+                'expires = excluded.expires',
+                (device_id, device_name, address, json.dumps(addresses or [address]), port, pubkey_fingerprint,
+                 now, now + ttl))
+            number, = self.db.execute('SELECT number FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+        return f"{number:04d}"
+
+    def expire(self, device_id):
+        """Mark a device's address stale, e.g. after its service said goodbye."""
+        now = time.time()
+        with self.lock:
+            self.db.execute('UPDATE devices SET expires = ? WHERE device_id = ? AND expires > ?',
+                            (now, device_id, now))
+
+    def is_fresh(self, device_info):
+        """Whether a device's cached address is still within its TTL."""
+        return device_info.get('expires', 0) > time.time()
 
     def get_device_by_short_id(self, short_id):
         """Get device info by short 4-digit ID."""
-        if short_id in self.registry:
-            return self.registry[short_id]
-        return None
+        if not short_id.isdigit():
+            return None
+        info = self.select('number = ?', int(short_id))
+        return info if info and info['short_id'] == short_id else None
 
     def get_device_by_full_id(self, device_id):
         """Get device info by full device ID (UUID)."""
-        for short_id, info in self.registry.items():
-            if info['device_id'] == device_id:
-                return {**info, 'short_id': short_id}
-        return None
+        return self.select('device_id = ?', device_id)
+
+    def get_device_by_fingerprint(self, pubkey_fingerprint):
+        """Get device info by public key fingerprint, the most recently seen if several share it."""
+        return self.select('pubkey_fingerprint = ? ORDER BY seen_at DESC', pubkey_fingerprint)
 
     def list_devices(self):
         """List all registered devices with short IDs."""
-        return self.registry
+        return self.load()
 
     def clear(self):
         """Clear the registry."""
-        self.registry = {}
-        self.save()
+        with self.lock:
+            self.db.execute('DELETE FROM devices')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def select(self, where, value):
+        with self.lock:
+            row = self.db.execute(f'SELECT {COLUMNS} FROM devices WHERE {where} LIMIT 1', (value,)).fetchone()
+        return self.row_info(row) if row else None
+
+    @staticmethod
+    def row_info(row):
+        number, device_id, device_name, address, addresses, port, pubkey_fingerprint, seen_at, expires = row
+        return {
+            'short_id': f"{number:04d}",
+            'device_id': device_id,
+            'device_name': device_name,
+            'address': address,
+            'addresses': json.loads(addresses) if addresses else [address],
+            'port': port,
+            'pubkey_fingerprint': pubkey_fingerprint,
+            'seen_at': seen_at,
+            'expires': expires,
+        }
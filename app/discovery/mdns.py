@@ -1,9 +1,18 @@
 import asyncio
+import contextlib
+import ipaddress
 import socket
-from zeroconf import Zeroconf, ServiceInfo
-from zeroconf.asyncio import AsyncZeroconf, AsyncServiceBrowser
+from concurrent.futures import ThreadPoolExecutor
+from zeroconf import DNSAddress, DNSService, IPVersion, Zeroconf, ServiceInfo, current_time_millis
+from zeroconf.asyncio import AsyncZeroconf, AsyncServiceBrowser, AsyncServiceInfo
 from zeroconf._exceptions import NonUniqueNameException
 
+DISCOVERY_TIMEOUT = 5  # Seconds to browse at most
+SETTLE_TIME = 1.0  # Browsing ends once no new service has appeared for this long
+RESOLVE_TIMEOUT = 3000  # Milliseconds to wait for one service's address
+DEFAULT_TTL = 120  # Seconds a device's address is trusted when its records carry no TTL
+CONNECT_TIMEOUT = 2  # Seconds to wait when checking that a cached address still answers
+
 class MDNSDiscovery:
     """Handle mDNS discovery and advertising."""
 
@@ -14,8 +23,11 @@ class MDNSDiscovery:
         self.service_name = f"{self.identity.device_id}.{self.service_type}"
 
     def advertise(self, port):
-        """Advertise the service."""
-        self.zeroconf = Zeroconf()
+        """Advertise the service on every interface, with all of this machine's addresses."""
+        try:
+            self.zeroconf = Zeroconf(ip_version=IPVersion.All)
+        except OSError:
+            self.zeroconf = Zeroconf()  # No IPv6 multicast here; IPv6 addresses still go out over IPv4
         device_name = socket.gethostname()
         txt = {
             'device_id': self.identity.device_id,
@@ -26,7 +38,7 @@ class MDNSDiscovery:
         info = ServiceInfo(
             self.service_type,
             self.service_name,
-            addresses=[socket.inet_aton(self.get_local_ip())],
+            parsed_addresses=self.get_local_ips(),
             port=port,
             properties=txt
         )
@@ -47,17 +59,42 @@ class MDNSDiscovery:
             self.zeroconf.unregister_all_services()
             self.zeroconf.close()
 
-    async def discover(self):
-        """Discover available services."""
-        from zeroconf.asyncio import AsyncServiceInfo
+    async def browse(self, timeout=DISCOVERY_TIMEOUT, settle=SETTLE_TIME):
+        """Yield devices as their services appear on the network and resolve.
+
+        Each service is resolved as soon as it is seen, concurrently with the
+        others, so services that do not answer cost no extra time. Browsing
+        ends `settle` seconds after the last new service once every
+        resolution has finished, or after `timeout` seconds; pass settle=None
+        to browse for the full timeout.
+        """
+        loop = asyncio.get_running_loop()
         aiozc = AsyncZeroconf()
-        services = []
-        found_names = []
+        results = asyncio.Queue()  # Resolved devices, or None for a service that did not resolve
+        resolving = set()
+        found_names = set()
+        last_found = loop.time()
+
+        async def resolve(name):
+            device = None
+            try:
+                device = await self.resolve(aiozc.zeroconf, name)
+            finally:
+                # Before the result is queued, so the loop that wakes for it already sees nothing pending
+                resolving.discard(asyncio.current_task())
+                results.put_nowait(device)
+
+        def found(name):
+            nonlocal last_found
+            if name in found_names:
+                return
+            found_names.add(name)
+            last_found = loop.time()
+            resolving.add(loop.create_task(resolve(name)))
 
         class Listener:
             def add_service(self, zc, type_, name):
-                if name not in found_names:
-                    found_names.append(name)
+                loop.call_soon_threadsafe(found, name)
 
             def update_service(self, zc, type_, name):
                 pass
@@ -65,33 +102,216 @@ class MDNSDiscovery:
             def remove_service(self, zc, type_, name):
                 pass
 
-        listener = Listener()
-        browser = AsyncServiceBrowser(aiozc.zeroconf, self.service_type, listener)
-        await asyncio.sleep(5)  # Wait for discovery
-        await browser.async_cancel()
-
-        for name in found_names:
-            info = AsyncServiceInfo(self.service_type, name)
-            await info.async_request(aiozc.zeroconf, 3000)
-            if info.addresses:
-                txt = {k.decode(): v.decode() for k, v in info.properties.items()}
-                services.append({
-                    'device_id': txt.get('device_id'),
-                    'device_name': txt.get('device_name'),
-                    'address': socket.inet_ntoa(info.addresses[0]),
-                    'port': info.port,
-                    'pubkey_fingerprint': txt.get('pubkey_fingerprint')
-                })
-
-        await aiozc.async_close()
+        browser = AsyncServiceBrowser(aiozc.zeroconf, self.service_type, Listener())
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                wait = deadline - loop.time()
+                if settle is not None and not resolving and results.empty():
+                    wait = min(wait, last_found + settle - loop.time())
+                if wait <= 0:
+                    break
+                try:
+                    device = await asyncio.wait_for(results.get(), wait)
+                except asyncio.TimeoutError:
+                    continue
+                if device is not None:
+                    yield device
+        finally:
+            await browser.async_cancel()
+            for task in resolving:
+                task.cancel()
+            await aiozc.async_close()
+
+    async def discover(self, device_ids=None, timeout=DISCOVERY_TIMEOUT):
+        """Discover available services.
+
+        With device_ids, returns as soon as all of those devices are found
+        instead of waiting for the network to go quiet.
+        """
+        wanted = set(device_ids or ())
+        services = []
+        browse = self.browse(timeout, settle=None if wanted else SETTLE_TIME)
+        async with contextlib.aclosing(browse) as devices:
+            async for device in devices:
+                services.append(device)
+                wanted.discard(device['device_id'])
+                if device_ids and not wanted:
+                    break
         return services
 
-    def get_local_ip(self):
-        """Get local IP address."""
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    async def lookup(self, registry, device_ids):
+        """Find devices by short or full ID, from the registry where possible.
+
+        A fresh registry entry is used as it is, and a stale one as long as
+        its address still accepts connections. Devices that are missing
+        from the registry or have moved are looked for in one live browse,
+        and what it finds is stored in the registry. Returns
+        ({device_id: device info}, None), or (None, error message).
+        Registry reads and writes run in the default executor, since another
+        process's write can keep them waiting.
+        """
+        loop = asyncio.get_running_loop()
+        found, missing = {}, {}
+        for device_id in device_ids:
+            # Check if it's a short ID (4-digit)
+            if len(device_id) == 4 and device_id.isdigit():
+                device_info = await loop.run_in_executor(None, registry.get_device_by_short_id, device_id)
+                if not device_info:
+                    return None, f"Device {device_id} not found in registry. Run 'myshare search' first"
+            else:
+                device_info = await loop.run_in_executor(None, registry.get_device_by_full_id, device_id)
+            if device_info and (registry.is_fresh(device_info)
+                                or await reachable(device_info['address'], device_info['port'])):
+                found[device_id] = device_info
+            else:
+                missing[device_id] = device_info
+
+        if missing:
+            devices = await self.discover([info['device_id'] if info else device_id
+                                           for device_id, info in missing.items()])
+
+            def store():
+                with registry.batch():
+                    for device in devices:
+                        registry.add_device(device['device_id'], device['device_name'], device['address'],
+                                            device['port'], device['pubkey_fingerprint'], device['ttl'],
+                                            device['addresses'])
+
+            await loop.run_in_executor(None, store)
+            for device_id, cached in missing.items():
+                full_id = cached['device_id'] if cached else device_id
+                device_info = next((d for d in devices if d['device_id'] == full_id), cached)
+                if not device_info:
+                    return None, f"Device {device_id} not found" if len(device_ids) > 1 else "Device not found"
+                found[device_id] = device_info  # A stale entry that did not answer is still the best guess
+        return found, None
+
+    async def watch(self, registry, on_change=None):
+        """Keep the device registry current with the network until cancelled.
+
+        Runs a browser for as long as the listener, the agent or
+        `search --watch` runs. Services are resolved when they appear or
+        change and stored with the TTL of their records; a service that
+        says goodbye, or whose records expire, is marked stale at once.
+        `send` and `trust` then find devices in the registry instead of
+        browsing themselves.
+
+        on_change(event, short_id, device), if given, is called with event
+        'added' the first time a device is seen by this watch, 'changed'
+        when its name, addresses or port change and 'removed' when it leaves.
+        """
+        loop = asyncio.get_running_loop()
+        aiozc = AsyncZeroconf()
+        # Registry calls can wait on another process's write; one thread keeps them in event order
+        registry_io = ThreadPoolExecutor(max_workers=1)
+        updating = set()
+        present = {}  # device_id -> (name, addresses, port) of devices seen and not gone
+        events = {}  # service name -> count of its events, so a late resolution cannot undo a removal
+
+        async def update(name, removed, event):
+            device_id = name[:-len(self.service_type) - 1] if name.endswith(self.service_type) else None
+            if device_id == self.identity.device_id:
+                return
+            if removed:
+                if device_id:
+                    await loop.run_in_executor(registry_io, registry.expire, device_id)
+                    if device_id in present and on_change is not None:
+                        device_info = await loop.run_in_executor(registry_io, registry.get_device_by_full_id,
+                                                                 device_id)
+                        on_change('removed', device_info and device_info['short_id'],
+                                  device_info or {'device_id': device_id})
+                    present.pop(device_id, None)
+                return
+            device = await self.resolve(aiozc.zeroconf, name)
+            if device is None or device['device_id'] == self.identity.device_id or events[name] != event:
+                return
+            short_id = await loop.run_in_executor(
+                registry_io, registry.add_device, device['device_id'], device['device_name'], device['address'],
+                device['port'], device['pubkey_fingerprint'], device['ttl'], device['addresses'])
+            seen = (device['device_name'], device['addresses'], device['port'])
+            before = present.get(device['device_id'])
+            present[device['device_id']] = seen
+            if on_change is not None and before != seen:
+                on_change('added' if before is None else 'changed', short_id, device)
+
+        def changed(name, removed=False):
+            events[name] = events.get(name, 0) + 1
+            task = loop.create_task(update(name, removed, events[name]))
+            updating.add(task)
+            task.add_done_callback(updating.discard)
+
+        class Listener:
+            def add_service(self, zc, type_, name):
+                loop.call_soon_threadsafe(changed, name)
+
+            def update_service(self, zc, type_, name):
+                loop.call_soon_threadsafe(changed, name)
+
+            def remove_service(self, zc, type_, name):
+                loop.call_soon_threadsafe(changed, name, True)
+
+        browser = AsyncServiceBrowser(aiozc.zeroconf, self.service_type, Listener())
         try:
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
+            await asyncio.Future()  # Until cancelled
         finally:
-            s.close()
-        return ip
\ No newline at end of file
+            await browser.async_cancel()
+            for task in updating:
+                task.cancel()
+            registry_io.shutdown(wait=False, cancel_futures=True)
+            await aiozc.async_close()
+
+    async def resolve(self, zc, name):
+        """Resolve a service name to a device dict, or None if it does not answer.
+
+        'addresses' lists every address it advertised, IPv4 first, and
+        'address' is the first of them. 'ttl' is how many seconds its
+        address and port records stay valid.
+        """
+        info = AsyncServiceInfo(self.service_type, name)
+        await info.async_request(zc, RESOLVE_TIMEOUT)
+        addresses = info.parsed_addresses()
+        if not addresses:
+            return None
+        now = current_time_millis()
+        ttls = [record.get_remaining_ttl(now) for key in (info.server, info.name) if key
+                for record in zc.cache.entries_with_name(key.lower())
+                if isinstance(record, (DNSAddress, DNSService))]
+        txt = {k.decode(): v.decode() for k, v in info.properties.items() if v is not None}
+        return {
+            'device_id': txt.get('device_id'),
+            'device_name': txt.get('device_name'),
+            'address': addresses[0],
+            'addresses': addresses,
+            'port': info.port,
+            'pubkey_fingerprint': txt.get('pubkey_fingerprint'),
+            'ttl': min(ttls) if ttls else DEFAULT_TTL,
+        }
+
+    def get_local_ips(self):
+        """Get the addresses of all network interfaces, IPv4 first.
+
+        Loopback and link-local addresses are left out: they are no use to
+        other machines, and link-local IPv6 ones would need an interface
+        scope. Falls back to loopback on a machine with no network at all.
+        """
+        import ifaddr  # Only needed to advertise
+
+        ipv4, ipv6 = [], []
+        for adapter in ifaddr.get_adapters():
+            for ip in adapter.ips:
+                address = ipaddress.ip_address(ip.ip[0] if ip.is_IPv6 else ip.ip)
+                if address.is_loopback or address.is_link_local:
+                    continue
+                (ipv6 if ip.is_IPv6 else ipv4).append(str(address))
+        return list(dict.fromkeys(ipv4 + ipv6)) or ['127.0.0.1']
+
+
+async def reachable(address, port, timeout=CONNECT_TIMEOUT):
+    """Whether something accepts TCP connections at address:port."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
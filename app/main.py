@@ -1,13 +1,13 @@
+"""Command line interface.
+
+Each command imports what it needs when it runs: asyncio, aiohttp,
+zeroconf, cryptography and OpenCV together take longer to import than
+most commands take to run. benchmarks/bench_startup.py keeps every
+command's start-up time within a budget.
+"""
 import click
-import asyncio
-from .security.identity import Identity
-from .security.trust_store import TrustStore
-from .discovery.mdns import MDNSDiscovery
-from .transfer.server import TransferServer
-from .transfer.client import TransferClient
-from .device_registry import DeviceRegistry
-from .grab_state import GrabState
-from .camera_grab import CameraGrab
+import json
+import time
 from pathlib import Path
 
 @click.group()
@@ -16,44 +16,95 @@ def main():
 
 @main.command()
 @click.option('--port', default=8080, help='Port to listen on')
-def listen(port):
+@click.option('--channel-port', default=0, help='Port for the binary data channel (default: any free port)')
+@click.option('--plain-channel', is_flag=True,
+              help='Run the data channel without TLS so senders can use sendfile (trusted LANs only)')
+@click.option('--max-uploads', default=8, help='Uploads received at the same time; others wait or are told to retry')
+@click.option('--fsync', type=click.Choice(['always', 'finalize', 'never']), default='always',
+              help='When received data is synced to disk: every range, only completed files, or never')
+def listen(port, channel_port, plain_channel, max_uploads, fsync):
     """Start listening to receive files."""
+    import asyncio
+    from .device_registry import DeviceRegistry
+    from .discovery.mdns import MDNSDiscovery
+    from .security.identity import Identity
+    from .security.trust_store import TrustStore
+    from .transfer.server import TransferServer
+
     identity = Identity()
     trust_store = TrustStore()
+    registry = DeviceRegistry(Path.home() / '.myshare')
     mdns = MDNSDiscovery(identity)
     mdns.advertise(port)
-    server = TransferServer(identity, trust_store, port)
+    server = TransferServer(identity, trust_store, port, channel_port, channel_tls=not plain_channel,
+                            max_uploads=max_uploads, fsync=fsync)
+
+    async def serve():
+        # Keep the device registry current for send and trust while listening
+        watcher = asyncio.create_task(mdns.watch(registry))
+        try:
+            await server.run()
+        finally:
+            watcher.cancel()
+
     try:
-        asyncio.run(server.run())
+        asyncio.run(serve())
     finally:
         mdns.stop()
 
 @main.command()
-def search():
+@click.option('--watch', is_flag=True,
+              help='Keep running and report devices as they appear, change address or leave (Ctrl+C to stop)')
+def search(watch):
     """Search for available devices on the network."""
+    import asyncio
+    from .device_registry import DeviceRegistry
+    from .discovery.mdns import MDNSDiscovery
+    from .security.identity import Identity
+
     config_dir = Path.home() / '.myshare'
     identity = Identity()
     registry = DeviceRegistry(config_dir)
-    registry.clear()  # Clear old registry on each discover
-    
     mdns = MDNSDiscovery(identity)
-    devices = asyncio.run(mdns.discover())
-    
-    if not devices:
+
+    if watch:
+        def report(event, short_id, device):
+            name = device.get('device_name') or device['device_id']
+            if event == 'removed':
+                click.echo(f"- [{short_id}] {name} left")
+            else:
+                click.echo(f"{'+' if event == 'added' else '~'} [{short_id}] {name} at {format_addresses(device)}")
+
+        click.echo("Watching for devices (Ctrl+C to stop)")
+        try:
+            asyncio.run(mdns.watch(registry, report))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    async def show_devices():
+        # Devices are listed as they answer
+        count = 0
+        async for device in mdns.browse():
+            if not count:
+                click.echo("\nDiscovered Devices:")
+                click.echo("-" * 60)
+            count += 1
+            short_id = registry.add_device(
+                device['device_id'],
+                device['device_name'],
+                device['address'],
+                device['port'],
+                device['pubkey_fingerprint'],
+                device['ttl'],
+                device['addresses']
+            )
+            click.echo(f"[{short_id}] {device['device_name']} at {format_addresses(device)}")
+        return count
+
+    if not asyncio.run(show_devices()):
         click.echo("No devices found on the network")
         return
-    
-    click.echo("\nDiscovered Devices:")
-    click.echo("-" * 60)
-    for device in devices:
-        short_id = registry.add_device(
-            device['device_id'],
-            device['device_name'],
-            device['address'],
-            device['port'],
-            device['pubkey_fingerprint']
-        )
-        click.echo(f"[{short_id}] {device['device_name']} at {device['address']}:{device['port']}")
     click.echo("-" * 60)
     click.echo(f"\nUse 'myshare send [ID] <file>' to send to a device")
 
@@ -61,6 +112,8 @@ def search():
 @click.argument('file_path')
 def grab(file_path):
     """Grab a file to send later (grab-and-release workflow)."""
+    from .grab_state import GrabState
+
     try:
         grab_state = GrabState()
         grab_state.grab(file_path)
@@ -73,6 +126,8 @@ def grab(file_path):
 @main.command()
 def camera():
     """Grab a file using camera gesture (point and grab)."""
+    from .camera_grab import CameraGrab
+
     try:
         camera_grab = CameraGrab()
         camera_grab.grab_by_camera()
@@ -90,6 +145,8 @@ def camera():
 @main.command()
 def release():
     """Release the currently grabbed file."""
+    from .grab_state import GrabState
+
     grab_state = GrabState()
     grabbed = grab_state.get_grabbed()
     if grabbed:
@@ -101,6 +158,8 @@ def release():
 @main.command()
 def grabbed():
     """Show currently grabbed file."""
+    from .grab_state import GrabState
+
     grab_state = GrabState()
     click.echo(grab_state.show_grabbed())
 
@@ -108,34 +167,26 @@ def grabbed():
 @click.argument('device_id')
 def trust(device_id):
     """Trust a device by ID (4-digit or full UUID)."""
+    import asyncio
+    from .device_registry import DeviceRegistry
+    from .discovery.mdns import MDNSDiscovery
+    from .security.identity import Identity
+    from .security.trust_store import TrustStore
+    from .transfer.client import TransferClient
+
     config_dir = Path.home() / '.myshare'
     identity = Identity()
     trust_store = TrustStore()
     registry = DeviceRegistry(config_dir)
-    
-    # Check if it's a short ID (4-digit)
-    device_info = None
-    if len(device_id) == 4 and device_id.isdigit():
-        device_info = registry.get_device_by_short_id(device_id)
-        if device_info:
-            actual_id = device_info['device_id']
-        else:
-            click.echo(f"Device {device_id} not found in registry. Run 'myshare search' first")
-            return
-    else:
-        # Full UUID provided
-        actual_id = device_id
-        device_info = registry.get_device_by_full_id(device_id)
-    
-    if not device_info:
-        # Device not in registry, try to discover
-        mdns = MDNSDiscovery(identity)
-        devices = asyncio.run(mdns.discover())
-        device_info = next((d for d in devices if d['device_id'] == actual_id), None)
-        if not device_info:
-            click.echo("Device not found")
-            return
-    
+
+    # Registry first; a live browse only for unknown or unreachable devices
+    found, error = asyncio.run(MDNSDiscovery(identity).lookup(registry, [device_id]))
+    if error:
+        click.echo(error)
+        return
+    device_info = found[device_id]
+    actual_id = device_info['device_id']
+
     client = TransferClient(identity, trust_store)
     try:
         pubkey = asyncio.run(client.get_pubkey(device_info['address'], device_info['port']))
@@ -146,58 +197,231 @@ def trust(device_id):
         click.echo(f"Failed to trust device: {e}")
 
 @main.command()
-@click.argument('device_id')
-@click.argument('file_path', required=False)
-def send(device_id, file_path):
-    """Send a file to a device. If no file specified, uses grabbed file."""
+@click.argument('device_ids')
+@click.argument('file_paths', nargs=-1)
+@click.option('--streams', type=click.IntRange(min=1), default=None,
+              help='Parallel connections for large files (default: based on file size)')
+@click.option('--concurrency', type=click.IntRange(min=1), default=4,
+              help='Files uploaded at once when sending several files')
+@click.option('--compress/--no-compress', default=True,
+              help='Compress compressible files on the wire when the receiver supports it')
+@click.option('--channel', is_flag=True,
+              help='Send large files over the binary framed data channel')
+@click.option('--swarm', is_flag=True,
+              help='With several devices, have them pass large files on to each other so each chunk is sent once')
+@click.option('--no-agent', is_flag=True, help='Send from this process even if an agent is running')
+def send(device_ids, file_paths, streams, concurrency, compress, channel, swarm, no_agent):
+    """Send files or directories to a device. If none specified, uses grabbed file.
+
+    DEVICE_IDS may list several devices separated by commas; the files are
+    then read and hashed once and sent to all of them at the same time.
+    """
+    from . import agent_client
+    from .camera_grab import CameraGrab
+
+    device_ids = list(dict.fromkeys(d.strip() for d in device_ids.split(',') if d.strip()))
     camera_grab = CameraGrab()
+    grabbed = camera_grab.get_grabbed()
     
-    # If no file_path provided, try to use grabbed file
-    if not file_path:
-        file_path = camera_grab.get_grabbed()
-        if not file_path:
+    # If no file_paths provided, try to use grabbed file
+    if not file_paths:
+        if not grabbed:
             click.echo("No file specified and no grabbed file. Use 'myshare grab <file>' or 'myshare camera' first")
             return
-        click.echo(f"📨 Sending grabbed file: {Path(file_path).name}")
-    
+        file_paths = (grabbed,)
+        click.echo(f"📨 Sending grabbed file: {Path(grabbed).name}")
+
+    summaries = stats = None
+    if not no_agent:
+        # A running agent already has keys, devices and connections loaded
+        try:
+            reply = agent_client.request({
+                'command': 'send',
+                'devices': device_ids,
+                'paths': [str(Path(p).absolute()) for p in file_paths],
+                'streams': streams,
+                'concurrency': concurrency,
+                'compress': compress,
+                'channel': channel,
+                'swarm': swarm,
+            })
+        except Exception as e:
+            click.echo(f"Failed to send file: {e}")
+            return
+        if reply is not None:
+            if not reply['ok']:
+                click.echo(reply['error'])
+                return
+            summaries, stats = reply['summaries'], reply.get('stats')
+    if summaries is None:
+        sent = send_direct(device_ids, file_paths, streams, concurrency, compress, channel, swarm)
+        if sent is None:
+            return
+        summaries, stats = sent
+
+    succeeded = True
+    for device, summary in summaries.items():
+        prefix = f"[{device}] " if len(summaries) > 1 else ""
+        if 'error' in summary:
+            click.echo(f"{prefix}Failed to send file: {summary['error']}")
+            succeeded = False
+            continue
+        for relpath, error in summary['failed']:
+            click.echo(f"{prefix}Failed to send {relpath}: {error}")
+        elapsed = max(summary['elapsed'], 1e-6)
+        click.echo(f"{prefix}Sent {summary['files']} file(s), {format_size(summary['bytes'])} "
+                   f"in {elapsed:.1f}s ({format_size(summary['bytes'] / elapsed)}/s)"
+                   + (f", {len(summary['failed'])} failed" if summary['failed'] else ""))
+        if summary['skipped']:
+            click.echo(f"{prefix}Skipped {summary['skipped']} file(s), {format_size(summary['skipped_bytes'])} "
+                       f"already on the device")
+        tls = summary.get('tls')
+        if tls and tls['handshakes']:
+            click.echo(f"{prefix}TLS sessions resumed: {tls['resumed']}/{tls['handshakes']} handshakes")
+        succeeded = succeeded and not summary['failed']
+
+    if stats and stats.get('seeded_bytes'):
+        click.echo(f"Swarm: sent {format_size(stats['seeded_bytes'])} of large files once; "
+                   f"the devices passed it on to each other")
+
+    # Auto-release grabbed file after successful send
+    if grabbed and succeeded and grabbed in {str(Path(p).absolute()) for p in file_paths}:
+        camera_grab.release()
+
+def send_direct(device_ids, file_paths, streams, concurrency, compress, channel, swarm=False):
+    """Send from this process; return ({device name: summary}, stats), or None after reporting an error."""
+    import asyncio
+    from .device_registry import DeviceRegistry
+    from .discovery.mdns import MDNSDiscovery
+    from .security.identity import Identity
+    from .security.trust_store import TrustStore
+
     config_dir = Path.home() / '.myshare'
     identity = Identity()
     trust_store = TrustStore()
     registry = DeviceRegistry(config_dir)
-    
-    # Check if it's a short ID (4-digit)
-    device_info = None
-    actual_device_id = device_id
-    
-    if len(device_id) == 4 and device_id.isdigit():
-        device_info = registry.get_device_by_short_id(device_id)
-        if device_info:
-            actual_device_id = device_info['device_id']
-        else:
-            click.echo(f"Device {device_id} not found in registry. Run 'myshare search' first")
-            return
-    else:
-        # Full UUID provided
-        device_info = registry.get_device_by_full_id(device_id)
-        actual_device_id = device_id
-    
-    if not device_info:
-        # Device not in registry, try to discover
-        mdns = MDNSDiscovery(identity)
-        devices = asyncio.run(mdns.discover())
-        device_info = next((d for d in devices if d['device_id'] == actual_device_id), None)
-        if not device_info:
-            click.echo("Device not found")
-            return
-    
-    client = TransferClient(identity, trust_store)
+
+    # Cached addresses are used at once; one live browse covers the devices that need it
+    targets, error = asyncio.run(MDNSDiscovery(identity).lookup(registry, device_ids))
+    if error:
+        click.echo(error)
+        return None
+
+    from .transfer.client import TransferClient  # aiohttp is slow to import; not needed when the lookup fails
+    client = TransferClient(identity, trust_store, compress=compress, use_channel=channel)
     try:
-        asyncio.run(client.send_file(device_info['address'], device_info['port'], file_path, actual_device_id))
-        # Auto-release grabbed file after successful send
-        if camera_grab.get_grabbed() == str(Path(file_path).absolute()):
-            camera_grab.release()
+        # Devices with several addresses get them raced, fastest remembered path first
+        targets = asyncio.run(client.choose_addresses(targets))
+        if len(targets) == 1:
+            (device_id, device_info), = targets.items()
+            return {device_id: asyncio.run(client.send_files(
+                device_info['address'], device_info['port'], file_paths, device_info['device_id'],
+                concurrency=concurrency, streams=streams))}, None
+        results, stats = asyncio.run(client.send_files_many(
+            [(d['address'], d['port'], d['device_id']) for d in targets.values()], file_paths,
+            concurrency=concurrency, streams=streams, swarm=swarm))
+        return {device_id: results[d['device_id']] for device_id, d in targets.items()}, stats
     except Exception as e:
         click.echo(f"Failed to send file: {e}")
+        return None
+
+@main.command()
+@click.option('--stop', is_flag=True, help='Stop the running agent')
+@click.option('--status', is_flag=True, help='Show whether an agent is running')
+def agent(stop, status):
+    """Run a background agent that keeps keys and connections warm for send."""
+    from . import agent_client
+
+    if stop or status:
+        reply = agent_client.request({'command': 'stop' if stop else 'ping'})
+        if reply is None:
+            click.echo("No agent running")
+        elif stop:
+            click.echo("Agent stopped")
+        else:
+            click.echo(f"Agent running (pid {reply['pid']}, up {reply['uptime']:.0f}s, "
+                       f"{len(reply['peers'])} peer connection pool(s))")
+            tls = reply['tls']
+            if tls['handshakes']:
+                click.echo(f"TLS sessions resumed: {tls['resumed']}/{tls['handshakes']} handshakes "
+                           f"({tls['resumed'] / tls['handshakes']:.0%})")
+        return
+    import asyncio
+    from .agent import Agent
+    try:
+        asyncio.run(Agent().run())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        click.echo(f"Error: {e}")
+
+@main.command()
+@click.option('--scenarios', default='huge,medium,tiny',
+              help='Comma-separated scenarios: huge (one 1 GB file), medium (64 x 8 MB), tiny (20000 x 0-4 KB)')
+@click.option('--scale', type=click.FloatRange(min=0, min_open=True), default=1.0,
+              help='Multiply file counts (or the single file size) by this, e.g. 0.1 for a quick run')
+@click.option('--concurrency', type=click.IntRange(min=1), default=4, help='Files uploaded at once')
+@click.option('--compress/--no-compress', default=False, help='Let the client compress (data is random)')
+@click.option('--channel', is_flag=True, help='Send large files over the binary framed data channel')
+@click.option('--fsync', type=click.Choice(['always', 'finalize', 'never']), default='never',
+              help="Receiver's fsync policy")
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Where to write the JSON results (default: myshare-bench-<time>.json)')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Earlier results to compare against; exits non-zero on a regression')
+@click.option('--runs', type=click.IntRange(min=1), default=3,
+              help='Times each scenario is run; the median of each metric is reported')
+@click.option('--threshold', type=float, default=0.10, help='Relative change that counts as a regression')
+def bench(scenarios, scale, concurrency, compress, channel, fsync, output, baseline, runs, threshold):
+    """Benchmark transfers over loopback against a throwaway local receiver."""
+    from . import bench as benchmarks
+
+    names = [name.strip() for name in scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in benchmarks.SCENARIOS]
+    if unknown:
+        raise click.BadParameter(f"Unknown scenario(s): {', '.join(unknown)}", param_hint='--scenarios')
+
+    def progress(name, result):
+        if 'error' in result:
+            click.echo(f"{name:<7} failed: {result['error']}")
+            return
+        click.echo(f"{name:<7} {result['files']:>6} file(s) {format_size(result['bytes']):>9}  "
+                   f"{result['seconds']:7.2f}s  {result['mb_per_s']:8.1f} MB/s  {result['files_per_s']:8.0f} files/s  "
+                   f"p50 {result['latency_p50'] * 1000:7.1f} ms  p99 {result['latency_p99'] * 1000:7.1f} ms")
+        click.echo(f"        client {result['client_cpu_seconds']:6.2f} CPU s, {result['client_peak_rss_mb']:6.0f} MB peak  "
+                   f"server {result['server_cpu_seconds']:6.2f} CPU s, {result['server_peak_rss_mb']:6.0f} MB peak"
+                   + (f"  {result['failed']} failed" if result['failed'] else ""))
+
+    results = benchmarks.run_benchmarks(names, scale, concurrency, compress, channel, fsync, progress, runs)
+    output = output or time.strftime('myshare-bench-%Y%m%d-%H%M%S.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    click.echo(f"Results written to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)
+        regressions = 0
+        for name, metric, before, after, change, regressed in benchmarks.compare(results, previous, threshold):
+            regressions += regressed
+            click.echo(f"{name:<7} {metric:<19} {before:12.4g} -> {after:12.4g}  {change:+7.1%}"
+                       + ("  REGRESSION" if regressed else ""))
+        if regressions:
+            raise SystemExit(1)
+
+def format_size(num_bytes):
+    """Format a byte count for humans, e.g. 1.5 MB."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}" if unit != 'B' else f"{int(num_bytes)} B"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+def format_addresses(device):
+    """Format a device's addresses, e.g. 192.168.1.5:8080, [fd00::5]:8080."""
+    from .transfer.paths import url_host
+    return ", ".join(f"{url_host(address)}:{device['port']}"
+                     for address in device.get('addresses') or [device['address']])
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,7 +1,28 @@
+import collections
+import hashlib
+import hmac
+import secrets
+import time
 from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives import serialization
+
+SESSION_TTL = 3600  # Seconds a session key is accepted
+MAX_SESSIONS = 4096  # Session keys a receiver keeps; the least recently used go first
+KEY_INFO = b'myshare-session1'
 
 class Handshake:
-    """Handle cryptographic handshake operations."""
+    """Handle cryptographic handshake operations.
+
+    Besides plain signatures, this runs the session handshake. Each side
+    contributes an ephemeral X25519 key and signs the exchange with its
+    Ed25519 identity key. Both then derive the same session key with
+    HKDF-SHA256, bound to both ephemeral keys and both device IDs.
+    Requests inside the session carry an HMAC-SHA256 under that key
+    instead of a signature.
+    """
 
     def __init__(self, identity):
         self.identity = identity
@@ -16,4 +37,70 @@ class Handshake:
             pubkey.verify(signature, message)
             return True
         except InvalidSignature:
-            return False
\ No newline at end of file
+            return False
+
+    def ephemeral_key(self):
+        """Return a fresh X25519 private key and its raw public bytes."""
+        private_key = X25519PrivateKey.generate()
+        public_bytes = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        return private_key, public_bytes
+
+    def offer_hash(self, client_public: bytes) -> str:
+        """What the client signs, in place of a file hash, to open a session."""
+        return hashlib.sha256(KEY_INFO + client_public).hexdigest()
+
+    def transcript_hash(self, client_public: bytes, server_public: bytes, session_id: str) -> str:
+        """What the receiver signs to prove it took part in the exchange."""
+        return hashlib.sha256(KEY_INFO + client_public + server_public + session_id.encode()).hexdigest()
+
+    def derive_key(self, private_key, peer_public: bytes, client_public: bytes, server_public: bytes,
+                   sender_id: str, receiver_id: str) -> bytes:
+        """Derive the 32-byte session key both sides share."""
+        shared = private_key.exchange(X25519PublicKey.from_public_bytes(peer_public))
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=client_public + server_public,
+            info=KEY_INFO + f":{sender_id}:{receiver_id}".encode(),
+        ).derive(shared)
+
+    def mac(self, key: bytes, message: bytes) -> str:
+        return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+    def verify_mac(self, key: bytes, message: bytes, mac_hex: str) -> bool:
+        return hmac.compare_digest(self.mac(key, message), mac_hex or '')
+
+
+class SessionKeys:
+    """Session keys a receiver has agreed on, bounded in number and lifetime."""
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()  # session_id -> session dict
+
+    def issue(self, key, sender_id, receiver_id):
+        session_id = secrets.token_hex(16)
+        self.sessions[session_id] = {
+            'key': key,
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'expires': time.time() + self.ttl,
+        }
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return session_id
+
+    def get(self, session_id):
+        """Return a live session, or None if unknown or expired."""
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        if session['expires'] < time.time():
+            del self.sessions[session_id]
+            return None
+        self.sessions.move_to_end(session_id)
+        return session
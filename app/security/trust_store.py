@@ -1,6 +1,29 @@
+"""Trusted devices and their public keys, kept in a SQLite database.
+
+Keys are stored as PEM bytes and only turned into key objects when a
+signature from that device is checked, so commands that never verify
+anything neither decode every trusted key nor import cryptography.
+Adding a device writes one row. The listener auto-trusting senders and
+a `myshare trust` command can therefore write at the same time without
+either losing the other's change. A trust.json from earlier versions
+is imported on first use.
+"""
+import contextlib
 import json
+import os
 import pathlib
-from cryptography.hazmat.primitives import serialization
+import sqlite3
+import threading
+
+BUSY_TIMEOUT = 10  # Seconds to wait for another process's write to finish
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trusted (
+    device_id TEXT PRIMARY KEY,
+    device_name TEXT,
+    pubkey BLOB NOT NULL  -- SubjectPublicKeyInfo PEM
+);
+"""
 
 class TrustStore:
     """Manage trusted devices."""
@@ -8,42 +31,72 @@ class TrustStore:
     def __init__(self):
         self.config_dir = pathlib.Path.home() / '.myshare'
         self.config_dir.mkdir(exist_ok=True)
-        self.trust_file = self.config_dir / 'trust.json'
-        self.trusted = {}
-        if self.trust_file.exists():
-            with open(self.trust_file) as f:
+        self.trust_file = self.config_dir / 'trust.db'
+        self.legacy_file = self.config_dir / 'trust.json'
+        # Shared by the server's event loop and its I/O threads, so every use holds the lock
+        self.db = sqlite3.connect(self.trust_file, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.keys = {}  # device_id -> decoded public key, for devices whose key was needed
+        self.data_version = None  # Changes when another process writes; then the keys are looked up again
+        if self.legacy_file.exists():
+            self.import_legacy()
+
+    def import_legacy(self):
+        """Move the devices in a trust.json into the database."""
+        try:
+            with open(self.legacy_file) as f:
                 data = json.load(f)
-                for device_id, info in data.items():
-                    pubkey_pem = info['pubkey']
-                    pubkey = serialization.load_pem_public_key(pubkey_pem.encode())
-                    self.trusted[device_id] = {
-                        'device_name': info['device_name'],
-                        'pubkey': pubkey
-                    }
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO trusted (device_id, device_name, pubkey) VALUES (?, ?, ?)',
+                                [(device_id, info['device_name'], info['pubkey'].encode())
+                                 for device_id, info in data.items()])
+        with contextlib.suppress(FileNotFoundError):  # Another process imported it at the same time
+            os.replace(self.legacy_file, self.legacy_file.with_suffix('.json.imported'))
 
     def add_device(self, device_id, device_name, pubkey):
-        self.trusted[device_id] = {
-            'device_name': device_name,
-            'pubkey': pubkey
-        }
-        self.save()
+        from cryptography.hazmat.primitives import serialization
+
+        pem = pubkey.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO trusted (device_id, device_name, pubkey) VALUES (?, ?, ?) '
+                'ON CONFLICT (device_id) DO UPDATE SET device_name = excluded.device_name, pubkey = excluded.pubkey',
+                (device_id, device_name, pem))
+            self.keys[device_id] = pubkey
 
     def is_trusted(self, device_id):
-        return device_id in self.trusted
+        with self.lock:
+            self.check_version()
+            if device_id in self.keys:
+                return True
+            return self.db.execute('SELECT 1 FROM trusted WHERE device_id = ?', (device_id,)).fetchone() is not None
 
     def get_pubkey(self, device_id):
-        return self.trusted.get(device_id, {}).get('pubkey')
+        with self.lock:
+            self.check_version()
+            pubkey = self.keys.get(device_id)
+            if pubkey is None:
+                row = self.db.execute('SELECT pubkey FROM trusted WHERE device_id = ?', (device_id,)).fetchone()
+                if row is None:
+                    return None
+                from cryptography.hazmat.primitives import serialization
+                pubkey = self.keys[device_id] = serialization.load_pem_public_key(row[0])
+            return pubkey
+
+    def check_version(self):
+        """Forget decoded keys if another process changed the database since they were read."""
+        version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        if version != self.data_version:
+            self.keys.clear()
+            self.data_version = version
 
     def save(self):
-        data = {}
-        for device_id, info in self.trusted.items():
-            pubkey_pem = info['pubkey'].public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            ).decode()
-            data[device_id] = {
-                'device_name': info['device_name'],
-                'pubkey': pubkey_pem
-            }
-        with open(self.trust_file, 'w') as f:
-            json.dump(data, f, indent=2)
\ No newline at end of file
+        """Changes are written as they are made, so nothing to do."""
@@ -1,14 +1,19 @@
 import time
 from cryptography.exceptions import InvalidSignature
+from ..security.handshake import Handshake
+from .nonce_store import NonceStore
 
 class Auth:
     """Handle authentication for transfers."""
 
-    def __init__(self, identity, trust_store):
+    def __init__(self, identity, trust_store, nonce_file=None, metrics=None):
         self.identity = identity
         self.trust_store = trust_store
-        self.nonce_cache = set()
         self.timestamp_window = 300  # 5 minutes
+        # Only receivers check nonces; they pass a file so replays stay refused across restarts
+        self.nonce_cache = NonceStore(nonce_file, self.timestamp_window)
+        self.handshake = Handshake(identity)
+        self.metrics = metrics  # Receivers count why requests were refused
 
     def create_auth_header(self, file_hash, nonce, timestamp, sender_id, receiver_id):
         """Create signature for the message."""
@@ -16,18 +21,44 @@ class Auth:
         signature = self.identity.private_key.sign(message)
         return signature.hex()
 
+    def create_session_mac(self, key, file_hash, nonce, timestamp, sender_id, receiver_id):
+        """Authenticate the same message as create_auth_header with a session key."""
+        message = f"{file_hash}:{nonce}:{timestamp}:{sender_id}:{receiver_id}".encode()
+        return self.handshake.mac(key, message)
+
+    def check_fresh(self, nonce, timestamp):
+        """Whether a request's timestamp is inside the window and its nonce unused."""
+        now = time.time()
+        if not abs(now - timestamp) <= self.timestamp_window:  # Also refuses NaN
+            return self.rejected('stale_timestamp')
+        if self.nonce_cache.seen(nonce, timestamp):
+            return self.rejected('replay')
+        return True
+
+    def rejected(self, reason):
+        if self.metrics is not None:
+            self.metrics.auth_failed(reason)
+        return False
+
     def verify_auth(self, file_hash, nonce, timestamp, sender_id, receiver_id, signature_hex, pubkey):
         """Verify the authentication."""
-        if nonce in self.nonce_cache:
-            return False
-        now = time.time()
-        if abs(now - timestamp) > self.timestamp_window:
+        if not self.check_fresh(nonce, timestamp):
             return False
         message = f"{file_hash}:{nonce}:{timestamp}:{sender_id}:{receiver_id}".encode()
         signature = bytes.fromhex(signature_hex)
         try:
             pubkey.verify(signature, message)
-            self.nonce_cache.add(nonce)
+            self.nonce_cache.add(nonce, timestamp)
             return True
         except InvalidSignature:
-            return False
\ No newline at end of file
+            return self.rejected('bad_signature')
+
+    def verify_session_mac(self, key, file_hash, nonce, timestamp, sender_id, receiver_id, mac_hex):
+        """Verify a session MAC with the same replay checks as a signature."""
+        if not self.check_fresh(nonce, timestamp):
+            return False
+        message = f"{file_hash}:{nonce}:{timestamp}:{sender_id}:{receiver_id}".encode()
+        if not self.handshake.verify_mac(key, message, mac_hex):
+            return self.rejected('bad_mac')
+        self.nonce_cache.add(nonce, timestamp)
+        return True
\ No newline at end of file
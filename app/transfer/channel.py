@@ -0,0 +1,124 @@
+"""Binary framed data channel for upload sessions.
+
+An upload is negotiated over HTTPS as usual (/upload/init, signed). The raw
+bytes then travel over a dedicated connection to the receiver's channel
+port instead of multipart or PUT bodies:
+
+    hello:  MAGIC (4 bytes) + upload_id (32 ASCII hex chars)
+    frame:  offset (u64) + length (u32) + length raw bytes
+    end:    a frame header with length 0
+    reply:  b'OK' or b'ER' + offset of the contiguous prefix received (u64)
+
+The upload is then finalized over HTTPS, which verifies the signed hash.
+On the sending side frame payloads go out with loop.sendfile() (os.sendfile)
+when the connection is plain TCP. TLS connections cannot use it, so the
+payload is written from an mmap of the file instead of being read() into
+intermediate buffers.
+"""
+import asyncio
+import mmap
+import os
+import struct
+from .uploads import ChunkVerificationError, RangeWriter
+
+MAGIC = b'MSC1'
+FRAME_HEADER = struct.Struct('!QI')
+REPLY = struct.Struct('!2sQ')
+UPLOAD_ID_LENGTH = 32
+WRITE_SIZE = 1024 * 1024  # Bytes handed to the transport before waiting for it to drain
+
+
+async def send_frames(reader, writer, file_path, upload_id, segments):
+    """Send segments of file_path as frames; return the receiver's contiguous offset."""
+    loop = asyncio.get_running_loop()
+    writer.write(MAGIC + upload_id.encode('ascii'))
+    with open(file_path, 'rb') as f:
+        use_sendfile = writer.get_extra_info('sslcontext') is None
+        mapped = None
+        try:
+            for offset, length in segments:
+                writer.write(FRAME_HEADER.pack(offset, length))
+                await writer.drain()
+                if use_sendfile:
+                    try:
+                        await loop.sendfile(writer.transport, f, offset, length, fallback=False)
+                        continue
+                    except (asyncio.SendfileNotAvailableError, NotImplementedError):
+                        use_sendfile = False
+                if mapped is None:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(mapped)
+                try:
+                    for start in range(offset, offset + length, WRITE_SIZE):
+                        writer.write(view[start:min(start + WRITE_SIZE, offset + length)])
+                        await writer.drain()
+                finally:
+                    view.release()
+        finally:
+            if mapped is not None:
+                mapped.close()
+    writer.write(FRAME_HEADER.pack(0, 0))
+    await writer.drain()
+    status, received = REPLY.unpack(await reader.readexactly(REPLY.size))
+    if status != b'OK':
+        raise Exception("Receiver rejected the data channel")
+    return received
+
+
+async def receive_frames(reader, writer, get_session, chunk_size, run_io, sync=True, received=None):
+    """Write incoming frames into the upload session named by the hello.
+
+    Blocking file work goes through run_io(func, *args), which runs it off
+    the event loop; with sync the part file is fsynced before the reply.
+    received(count), if given, is called with the size of each piece of
+    frame payload read.
+    """
+    hello = await reader.readexactly(len(MAGIC) + UPLOAD_ID_LENGTH)
+    session = None
+    if hello[:len(MAGIC)] == MAGIC:
+        session = get_session(hello[len(MAGIC):].decode('ascii', 'replace'))
+    if session is None or session.lock.locked():
+        writer.write(REPLY.pack(b'ER', 0))
+        await writer.drain()
+        return
+
+    status = b'ER'
+    f = await run_io(open, session.part_path, 'r+b')
+    try:
+        while True:
+            offset, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+            if length == 0:
+                status = b'OK'
+                break
+            if offset + length > session.size:
+                break
+            range_writer = RangeWriter(session, f, offset)
+            remaining = length
+            try:
+                while remaining:
+                    data = await reader.read(min(chunk_size, remaining))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    if received is not None:
+                        received(len(data))
+                    await run_io(range_writer.write, data)
+                    remaining -= len(data)
+            finally:
+                # Keep whatever verified part of the frame arrived
+                range_writer.close()
+    except ChunkVerificationError:
+        pass  # Reply ER; the sender re-sends the missing ranges
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return
+    finally:
+        await run_io(_close, f, sync)
+        await run_io(session.save)
+    writer.write(REPLY.pack(status, session.offset))
+    await writer.drain()
+
+
+def _close(f, sync):
+    f.flush()
+    if sync:
+        os.fsync(f.fileno())
+    f.close()
@@ -1,24 +1,231 @@
+import asyncio
+import collections
+import contextlib
 import hashlib
+import os
 import pathlib
+import queue
+import threading
 import time
 import uuid
-from aiohttp import FormData, ClientSession
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import ClientError, ClientSession, TCPConnector
+from yarl import URL
 from cryptography.hazmat.primitives import serialization
 from .auth import Auth
+from .channel import send_frames
+from .compression import choose_codec, make_compressor
+from .fanout import SharedReads
+from .hashing import MERKLE_PREFIX, MerkleHasher, merkle_chunk_size, merkle_file, parse_merkle_hash, sha256_file
+from .pack import encode_manifest, manifest_hash
+from .paths import PathStats, race, url_host
+from .swarm import SWARM_MIN_SIZE, SWARM_POLL, SWARM_STALL, Swarm, held_chunks
+from .tls import client_context
+
+CHUNK_SIZE = 1024 * 1024  # 1 MiB per read, independent of file size
+RESUMABLE_THRESHOLD = 64 * 1024 * 1024  # Files this large use a resumable upload session
+SEGMENT_SIZE = 64 * 1024 * 1024  # Bytes sent per append request in a resumable upload
+MAX_RESUME_ATTEMPTS = 8  # Consecutive failed attempts without progress before giving up
+FINALIZE_RETRY_DELAY = 1  # Seconds before re-checking an upload the server was not ready to finalize
+PARALLEL_STREAM_SIZE = 256 * 1024 * 1024  # One extra connection per this many bytes
+MAX_STREAMS = 8
+DEFAULT_CONCURRENCY = 4  # Uploads in flight at once when sending many files
+HAVE_BATCH_SIZE = 1000  # Content hashes per "do you have these?" query
+HASH_BATCH_FILES = 64  # Files hashed per executor call when sending many files
+SESSION_RENEW_MARGIN = 60  # Seconds before expiry at which a session key is renegotiated
+CODEC_HEADER = 'X-MyShare-Codec'
+MAX_BUSY_RETRIES = 12  # Times a busy receiver (503) is retried before a file fails
+PACK_FILE_SIZE = 64 * 1024  # Files up to this size travel in packs when a send has many of them
+PACK_MIN_FILES = 16  # Fewer small files than this are sent one request each
+PACK_MAX_FILES = 4096  # Files per pack request
+PACK_MAX_BYTES = 32 * 1024 * 1024  # Bytes per pack request
+PACK_READ_FILES = 256  # Files read from disk in one executor call while streaming a pack
+PEER_INFO_TTL = 300  # Seconds a receiver's /info is trusted before it is fetched again
+MAX_CACHED_HASHES = 10000  # File hashes kept for files sent again; the least recently used go first
+
+
+class ReceiverBusy(Exception):
+    """The receiver has no free upload slot; retry after retry_after seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Receiver busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def retry_after(resp):
+    try:
+        return max(1, int(resp.headers.get('Retry-After', 5)))
+    except ValueError:
+        return 5
+
+
+class HashCache:
+    """File hashes by (path, size, mtime, merkle), keeping the max_entries most recently used.
+
+    Filled from executor threads: one thread hashes a file while others
+    asking for the same version of it wait for its result.
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_HASHES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # key -> (file_hash, chunk digests or None)
+        self.pending = {}  # key -> [lock held while hashing, threads using it], while being hashed
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """The cached result for key, calling compute() (blocking) to fill it on a miss."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            pending = self.pending.setdefault(key, [threading.Lock(), 0])
+            pending[1] += 1
+        try:
+            with pending[0]:
+                with self.lock:
+                    if key in self.entries:
+                        return self.entries[key]
+                result = compute()
+                with self.lock:
+                    self.entries[key] = result
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+                return result
+        finally:
+            with self.lock:
+                pending[1] -= 1
+                if not pending[1]:
+                    del self.pending[key]
+
+
+def read_packed(files):
+    """Read (path, size) files into one buffer, each cut or padded to its listed size (blocking).
+
+    A file that changed or vanished since it was hashed no longer matches
+    its hash; the receiver reports it and it is sent again on its own.
+    """
+    parts = []
+    for file_path, size in files:
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read(size)
+        except OSError:
+            data = b''
+        parts.append(data.ljust(size, b'\0'))
+    return b''.join(parts)
+
+
+def collect_files(paths):
+    """Expand files and directories into (path, relpath) pairs.
+
+    A directory's files keep their layout under the directory's own name,
+    so sending `photos/` produces `photos/2024/img.jpg` on the receiver.
+    """
+    files = []
+    for path in paths:
+        path = pathlib.Path(path)
+        if path.is_dir():
+            base = pathlib.PurePosixPath(path.resolve().name)
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    file_path = pathlib.Path(root) / name
+                    if file_path.is_file():
+                        relpath = base / file_path.relative_to(path).as_posix()
+                        files.append((file_path, str(relpath)))
+        elif path.exists():
+            files.append((path, path.name))
+        else:
+            raise FileNotFoundError(f"File {path} not found")
+    return files
+
+
+def auto_streams(size):
+    """Pick a connection count for a file: one per PARALLEL_STREAM_SIZE, bounded by cores."""
+    return max(1, min(MAX_STREAMS, os.cpu_count() or 1, size // PARALLEL_STREAM_SIZE))
+
+
+def missing_ranges(ranges, size):
+    """Return the [start, end) gaps left in [0, size) by sorted, merged ranges."""
+    missing = []
+    position = 0
+    for start, end in ranges:
+        if start > position:
+            missing.append((position, start))
+        position = max(position, end)
+    if position < size:
+        missing.append((position, size))
+    return missing
+
+
+def split_segments(ranges, segment_size):
+    """Cut ranges into (offset, length) pieces of at most segment_size bytes."""
+    segments = []
+    for start, end in ranges:
+        for offset in range(start, end, segment_size):
+            segments.append((offset, min(segment_size, end - offset)))
+    return segments
+
+
+def _form_part(boundary, name, value=None, filename=None):
+    """Encode one multipart/form-data part header (and value, if given)."""
+    disposition = f'form-data; name="{name}"'
+    if filename is not None:
+        safe_name = filename.replace('"', '%22').replace('\r', '').replace('\n', '')
+        disposition += f'; filename="{safe_name}"'
+    head = f'--{boundary}\r\nContent-Disposition: {disposition}\r\n'
+    if filename is not None:
+        head += 'Content-Type: application/octet-stream\r\n'
+    head += '\r\n'
+    if value is None:
+        return head.encode()
+    return head.encode() + value.encode() + b'\r\n'
+
 
 class TransferClient:
     """Client for sending files over HTTPS."""
 
-    def __init__(self, identity, trust_store):
+    def __init__(self, identity, trust_store, compress=True, use_channel=False):
         self.identity = identity
         self.trust_store = trust_store
         self.auth = Auth(identity, trust_store)
+        self.compress = compress
+        self.use_channel = use_channel
+        self.peer_info = {}  # base URL -> (expiry, /info response); dropped when a send to the peer fails
+        self.info_requests = {}  # base URL -> in-flight /info request
+        self.hashes = HashCache()
+        self.shared_reads = None  # SharedReads while sending the same files to several receivers
+        self.swarm = None  # Swarm while those receivers also pass large files' chunks to each other
+        self.tls_context = client_context()  # Shared per process so TLS sessions are resumed
+        self.auth_sessions = {}  # receiver_id -> session key agreed in the handshake
+        self.session_requests = {}  # receiver_id -> in-flight handshake
+        self.paths = PathStats(identity.config_dir / 'path_stats.json')  # Throughput per receiver address
+
+    async def choose_addresses(self, devices):
+        """Pick the address to send to for each of {key: device info}; returns copies with 'address' set.
+
+        A device with several addresses (see device_registry) gets them
+        raced, fastest remembered path first (see transfer.paths). When
+        none connects, the device keeps its primary address and the send
+        reports the error.
+        """
+        async def choose(device_info):
+            addresses = device_info.get('addresses') or [device_info['address']]
+            if len(addresses) == 1:
+                return dict(device_info, address=addresses[0])
+            winner, failed = await race(self.paths.order(device_info['device_id'], addresses), device_info['port'])
+            for address in failed:
+                self.paths.failed(device_info['device_id'], address)
+            return dict(device_info, address=winner or device_info['address'])
+
+        chosen = await asyncio.gather(*[choose(device_info) for device_info in devices.values()])
+        return dict(zip(devices, chosen))
 
     async def get_pubkey(self, address, port):
         """Fetch public key from server."""
-        url = f"https://{address}:{port}/pubkey"
+        url = f"https://{url_host(address)}:{port}/pubkey"
         async with ClientSession() as session:
-            async with session.get(url, ssl=False) as resp:
+            async with session.get(url, ssl=self.tls_context) as resp:
                 if resp.status == 200:
                     pem = await resp.text()
                     pubkey = serialization.load_pem_public_key(pem.encode())
@@ -26,45 +233,841 @@ class TransferClient:
                 else:
                     raise Exception("Failed to get pubkey")
 
-    async def send_file(self, address, port, file_path, receiver_id):
-        """Send a file to the server."""
+    async def send_file(self, address, port, file_path, receiver_id, streams=None, relpath=None, session=None,
+                        check_existing=True):
+        """Send a file to the server, streaming it in fixed-size chunks.
+
+        Large files, or any file when more than one stream is requested, go
+        through a resumable upload session instead of a single POST. `relpath`
+        places the file in a subdirectory of the receiver's incoming folder,
+        and `session` lets several sends share one keep-alive ClientSession.
+        With `check_existing`, the receiver is first asked to build the file
+        from content it already holds. Returns True if the file's bytes were
+        uploaded, False if the receiver already had them. Raises on failure.
+        """
         file_path = pathlib.Path(file_path)
         if not file_path.exists():
             raise FileNotFoundError(f"File {file_path} not found")
+        relpath = relpath or file_path.name
+        base_url = f"https://{url_host(address)}:{port}"
 
-        with open(file_path, 'rb') as f:
-            content = f.read()
+        async with self._session(session) as session:
+            await self._auth_session(session, base_url, receiver_id)
+            file_hash = None
+            if check_existing:
+                file_hash, _ = await self.hash_file(session, base_url, file_path)
+                if await self._materialize(session, base_url, file_path.name, relpath, file_hash, receiver_id):
+                    return False
+
+            if self.swarm is not None and file_path.stat().st_size >= SWARM_MIN_SIZE:
+                info = await self._peer_info(session, base_url)
+                if info.get('swarm') and MERKLE_PREFIX in info.get('hash_types', ()):
+                    await self.send_file_swarm(address, port, file_path, receiver_id, relpath, session)
+                    return True
+
+            if self.use_channel and file_path.stat().st_size >= RESUMABLE_THRESHOLD:
+                info = await self._peer_info(session, base_url)
+                if info.get('channel_port'):
+                    await self.send_file_channel(address, port, file_path, receiver_id, relpath, session)
+                    return True
+
+            codec = await self._choose_codec(session, base_url, file_path)
+            if file_path.stat().st_size >= RESUMABLE_THRESHOLD or (streams or 1) > 1:
+                await self.send_file_resumable(address, port, file_path, receiver_id, streams, relpath,
+                                               session, codec)
+                return True
+
+            nonce = str(uuid.uuid4())
+            timestamp = time.time()
+            sender_id = self.identity.device_id
+
+            fields = {
+                'filename': file_path.name,
+                'relpath': relpath,
+                'nonce': nonce,
+                'timestamp': str(timestamp),
+                'sender_id': sender_id,
+                'sender_name': self.identity.device_id[:8],  # Short form for display
+                'receiver_id': receiver_id,
+                'size': str(file_path.stat().st_size),  # Lets the receiver preallocate
+            }
+            if codec:
+                fields['codec'] = codec
+            hasher = None
+            if await self._peer_supports_merkle(session, base_url):
+                hasher = MerkleHasher(merkle_chunk_size(file_path.stat().st_size))
+                fields['hash_type'] = f'{MERKLE_PREFIX}-{hasher.chunk_size}'
+            if file_hash is None and self.shared_reads is not None:
+                # Hashed once for all receivers instead of once per upload
+                file_hash, _ = await self.hash_file(session, base_url, file_path)
+            known_hash = None
+            # Reuse a hash computed above rather than reading and hashing the file again while streaming
+            if file_hash is not None and parse_merkle_hash(file_hash) == (hasher and hasher.chunk_size):
+                known_hash = file_hash
+
+            auth_used = {}
+            relogged = False
+
+            def trailer(file_hash):
+                # The hash is only known once the last chunk has gone out, so the
+                # hash and signature (or session MAC) travel after the file part.
+                auth_used.clear()
+                auth_used.update(self.auth_fields(file_hash, nonce, timestamp, receiver_id))
+                return dict(auth_used, file_hash=file_hash)
+
+            for attempt in range(MAX_BUSY_RETRIES + 1):
+                if attempt:
+                    # A fresh nonce and timestamp, so long waits stay inside the auth window
+                    nonce = fields['nonce'] = str(uuid.uuid4())
+                    timestamp = time.time()
+                    fields['timestamp'] = str(timestamp)
+                if hasher is not None:
+                    hasher = MerkleHasher(hasher.chunk_size)
+                boundary = uuid.uuid4().hex
+                headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+                body = self._upload_body(boundary, file_path, fields, trailer, codec, hasher, known_hash)
+                async with session.post(f"{base_url}/upload", data=body, headers=headers, ssl=self.tls_context) as resp:
+                    if resp.status == 503 and attempt < MAX_BUSY_RETRIES:
+                        delay = retry_after(resp)
+                    elif resp.status == 401 and 'session_id' in auth_used and not relogged and attempt < MAX_BUSY_RETRIES:
+                        # Receiver forgot our session (restarted); agree on a new one
+                        self.forget_session(receiver_id, auth_used['session_id'])
+                        relogged = True
+                        delay = 0
+                    elif resp.status != 200:
+                        raise Exception(await resp.text())
+                    else:
+                        return True
+                await asyncio.sleep(delay)
+                await self._auth_session(session, base_url, receiver_id)
+
+    async def send_files(self, address, port, paths, receiver_id, concurrency=DEFAULT_CONCURRENCY, streams=None,
+                         session=None):
+        """Send files and directory trees over one keep-alive session.
+
+        All files are hashed first and the receiver is asked, in batches,
+        which content it already has; those files are linked or copied on
+        the receiver instead of uploaded. When there are many small files and
+        the receiver supports it, they travel in packs of many files per
+        request (see transfer.pack). Up to `concurrency` transfers run at
+        once. Directory structure is kept relative to each directory
+        argument's parent. Returns a summary dict with counts of files and
+        bytes sent and skipped, the elapsed time and a list of
+        (relpath, error) for files that failed, plus the TLS handshakes
+        made and how many of them resumed a session. Pass `session` to
+        reuse connections that are already open to the receiver.
+        """
+        if session is None:
+            async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+                return await self.send_files(address, port, paths, receiver_id, concurrency, streams, session)
+
+        files = await asyncio.get_running_loop().run_in_executor(None, collect_files, paths)
+        semaphore = asyncio.Semaphore(concurrency)
+        summary = {'files': 0, 'bytes': 0, 'skipped': 0, 'skipped_bytes': 0, 'failed': []}
+        base_url = f"https://{url_host(address)}:{port}"
+
+        async def send_one(session, file_path, relpath, file_hash, present):
+            async with semaphore:
+                try:
+                    size = file_path.stat().st_size
+                    uploaded = True
+                    if present:
+                        uploaded = not await self._materialize(
+                            session, base_url, file_path.name, relpath, file_hash, receiver_id)
+                    if uploaded:
+                        await self.send_file(address, port, file_path, receiver_id, streams, relpath, session,
+                                             check_existing=False)
+                except Exception as e:
+                    summary['failed'].append((relpath, str(e) or type(e).__name__))
+                    # The receiver may have restarted with another channel port or other features
+                    self.forget_peer(base_url)
+                    return
+                if uploaded:
+                    summary['files'] += 1
+                    summary['bytes'] += size
+                else:
+                    summary['skipped'] += 1
+                    summary['skipped_bytes'] += size
+
+        async def send_pack(session, entries):
+            async with semaphore:
+                try:
+                    resend = set(await self._send_pack(session, base_url, entries, receiver_id))
+                except Exception:
+                    resend = None  # Fall back to one request per file
+            if resend is None:
+                await asyncio.gather(*[send_one(session, file_path, relpath, file_hash, present)
+                                       for file_path, relpath, file_hash, _, present in entries])
+                return
+            for file_path, relpath, file_hash, size, present in entries:
+                if relpath in resend:
+                    continue
+                if present:
+                    summary['skipped'] += 1
+                    summary['skipped_bytes'] += size
+                else:
+                    summary['files'] += 1
+                    summary['bytes'] += size
+            # Changed since hashing, or no longer stored on the receiver
+            await asyncio.gather(*[send_one(session, file_path, relpath, file_hash, False)
+                                   for file_path, relpath, file_hash, _, _ in entries if relpath in resend])
+
+        start = time.monotonic()
+        tls_before = self.tls_context.stats.as_dict()
+        await self._auth_session(session, base_url, receiver_id)
+        hashed = await self.hash_files(session, base_url, [file_path for file_path, _ in files])
+        present = await self._query_have(session, base_url, [file_hash for file_hash, _ in hashed], receiver_id)
+        singles, packs = await self._plan_packs(session, base_url, [
+            (file_path, relpath, file_hash, size, file_hash in present)
+            for (file_path, relpath), (file_hash, size) in zip(files, hashed)])
+        upload_start = time.monotonic()
+        await asyncio.gather(
+            *[send_one(session, file_path, relpath, file_hash, present)
+              for file_path, relpath, file_hash, _, present in singles],
+            *[send_pack(session, entries) for entries in packs])
+        summary['elapsed'] = time.monotonic() - start
+        summary['tls'] = self.tls_context.stats.since(tls_before)
+        # Only the uploads say how fast this path is; hashing and the /have round trip do not
+        self.paths.record(receiver_id, address, summary['bytes'], time.monotonic() - upload_start)
+        return summary
+
+    async def send_files_many(self, targets, paths, concurrency=DEFAULT_CONCURRENCY, streams=None, sessions=None,
+                              swarm=False):
+        """Send the same files and directory trees to several receivers at once.
+
+        targets is a list of (address, port, receiver_id). Files are hashed
+        once and each chunk is read from disk once for all receivers (see
+        SharedReads); every receiver still gets its own signatures, since
+        they cover its device ID. A receiver that fails or falls behind does
+        not hold up the rest. With `swarm`, large files are sent as a swarm
+        (see transfer.swarm): each chunk goes out once and the receivers
+        pass it on to each other. Pass `sessions`, keyed by base URL, to
+        reuse open connections. Returns ({receiver_id: summary or
+        {'error': message}}, {'disk_reads': ..., 'shared_reads': ...}),
+        plus 'seeded_bytes' in the second dict for a swarm.
+        """
+        shared = SharedReads(len(targets))
+        swarm = Swarm() if swarm and len(targets) > 1 else None
+        results = {}
+
+        async def send_to(address, port, receiver_id):
+            client = self.for_receiver(shared, swarm)
+            try:
+                results[receiver_id] = await client.send_files(
+                    address, port, paths, receiver_id, concurrency, streams,
+                    (sessions or {}).get(f"https://{url_host(address)}:{port}"))
+            except Exception as e:
+                results[receiver_id] = {'error': str(e) or type(e).__name__}
+
+        await asyncio.gather(*[send_to(address, port, receiver_id) for address, port, receiver_id in targets])
+        stats = shared.stats()
+        if swarm is not None:
+            stats.update(swarm.stats())
+        return results, stats
+
+    def for_receiver(self, shared_reads, swarm=None):
+        """A client for one receiver of a fan-out send, sharing this client's caches and the reads."""
+        client = TransferClient(self.identity, self.trust_store, self.compress, self.use_channel)
+        client.auth = self.auth
+        client.peer_info = self.peer_info
+        client.info_requests = self.info_requests
+        client.hashes = self.hashes
+        client.auth_sessions = self.auth_sessions
+        client.session_requests = self.session_requests
+        client.paths = self.paths
+        client.shared_reads = shared_reads
+        client.swarm = swarm
+        return client
+
+    async def _plan_packs(self, session, base_url, files):
+        """Split (path, relpath, hash, size, present) tuples into single sends and packs of small files."""
+        small = [entry for entry in files if entry[3] <= PACK_FILE_SIZE]
+        if len(small) < PACK_MIN_FILES or not (await self._peer_info(session, base_url)).get('pack'):
+            return files, []
+        packs = []
+        entries, pack_bytes = [], 0
+        for entry in small:
+            if entries and (len(entries) >= PACK_MAX_FILES or pack_bytes + entry[3] > PACK_MAX_BYTES):
+                packs.append(entries)
+                entries, pack_bytes = [], 0
+            entries.append(entry)
+            pack_bytes += 0 if entry[4] else entry[3]
+        packs.append(entries)
+        return [entry for entry in files if entry[3] > PACK_FILE_SIZE], packs
+
+    async def _send_pack(self, session, base_url, entries, receiver_id):
+        """Send small files in one pack request; return the relpaths the receiver did not store.
+
+        Files the receiver already has go without their bytes. Raises if the
+        pack as a whole failed.
+        """
+        manifest_entries = [[relpath, size, file_hash, not present]
+                            for _, relpath, file_hash, size, present in entries]
+        file_hash = manifest_hash(manifest_entries)
+        data_files = [(file_path, size) for file_path, _, _, size, present in entries if not present]
+        relogged = False
+        for attempt in range(MAX_BUSY_RETRIES + 1):
+            fields = dict(self.signed_fields(file_hash, receiver_id), entries=manifest_entries)
+            body = self._pack_body(encode_manifest(fields), data_files)
+            headers = {'Content-Type': 'application/octet-stream'}
+            async with session.post(f"{base_url}/upload/pack", data=body, headers=headers,
+                                    ssl=self.tls_context) as resp:
+                if resp.status == 503 and attempt < MAX_BUSY_RETRIES:
+                    delay = retry_after(resp)
+                elif resp.status == 401 and 'session_id' in fields and not relogged and attempt < MAX_BUSY_RETRIES:
+                    self.forget_session(receiver_id, fields['session_id'])
+                    relogged = True
+                    delay = 0
+                elif resp.status != 200:
+                    raise Exception(await resp.text())
+                else:
+                    result = await resp.json()
+                    return result['failed'] + result['missing']
+            await asyncio.sleep(delay)
+            await self._auth_session(session, base_url, receiver_id)
+
+    async def _pack_body(self, manifest, files):
+        """Yield the manifest, then the files' bytes, read in batches off the event loop."""
+        yield manifest
+        loop = asyncio.get_running_loop()
+        for i in range(0, len(files), PACK_READ_FILES):
+            yield await loop.run_in_executor(None, read_packed, files[i:i + PACK_READ_FILES])
+
+    async def _query_have(self, session, base_url, hashes, receiver_id):
+        """Return the subset of hashes the receiver already stores."""
+        present = set()
+        unique = sorted(set(hashes))
+        for i in range(0, len(unique), HAVE_BATCH_SIZE):
+            batch = unique[i:i + HAVE_BATCH_SIZE]
+            list_hash = hashlib.sha256('\n'.join(batch).encode()).hexdigest()
+            async with await self._post_signed(session, f"{base_url}/have", list_hash, receiver_id,
+                                               hashes=batch) as resp:
+                if resp.status == 404:
+                    return present  # Receiver predates the content index
+                if resp.status != 200:
+                    raise Exception(await resp.text())
+                present.update((await resp.json())['have'])
+        return present
+
+    async def _materialize(self, session, base_url, filename, relpath, file_hash, receiver_id):
+        """Ask the receiver to create the file from content it already has."""
+        async with await self._post_signed(session, f"{base_url}/materialize", file_hash, receiver_id,
+                                           filename=filename, relpath=relpath) as resp:
+            if resp.status == 404:
+                return False
+            if resp.status != 200:
+                raise Exception(await resp.text())
+            return True
+
+    async def hash_file(self, session, base_url, file_path):
+        """Return (file_hash, chunk digests) in the form the receiver understands.
+
+        Receivers that advertise merkle hashing get a chunk-tree root, hashed
+        on all cores; older receivers get a flat SHA-256 and no chunk
+        digests. Results are cached per file version.
+        """
+        merkle = await self._peer_supports_merkle(session, base_url)
+        loop = asyncio.get_running_loop()
+        return (await loop.run_in_executor(None, self._cached_hash, file_path, merkle))[0]
 
-        file_hash = hashlib.sha256(content).hexdigest()
+    async def hash_files(self, session, base_url, paths):
+        """Hash many files as hash_file does; return (file_hash, size) for each.
+
+        Files are handled in batches per executor call, so directories of
+        many small files are not bound by one event loop round trip each.
+        """
+        merkle = await self._peer_supports_merkle(session, base_url)
+        loop = asyncio.get_running_loop()
+
+        def hash_batch(batch):
+            results = []
+            for file_path in batch:
+                (file_hash, _), size = self._cached_hash(file_path, merkle)
+                results.append((file_hash, size))
+            return results
+
+        batches = await asyncio.gather(*[
+            loop.run_in_executor(None, hash_batch, paths[i:i + HASH_BATCH_FILES])
+            for i in range(0, len(paths), HASH_BATCH_FILES)])
+        return [result for batch in batches for result in batch]
+
+    def _cached_hash(self, file_path, merkle):
+        """Hash a file, or reuse the result cached for this version of it (blocking); return (result, size)."""
+        stat = file_path.stat()
+        key = (str(file_path.resolve()), stat.st_size, stat.st_mtime_ns, merkle)
+        if merkle:
+            return self.hashes.get(key, lambda: merkle_file(file_path)), stat.st_size
+        return self.hashes.get(key, lambda: (sha256_file(file_path), None)), stat.st_size
+
+    async def _peer_supports_merkle(self, session, base_url):
+        return MERKLE_PREFIX in (await self._peer_info(session, base_url)).get('hash_types', ())
+
+    def signed_fields(self, file_hash, receiver_id, use_session=True):
+        """Build the authentication fields for a request covering file_hash."""
         nonce = str(uuid.uuid4())
         timestamp = time.time()
+        fields = {
+            'file_hash': file_hash,
+            'nonce': nonce,
+            'timestamp': str(timestamp),
+            'sender_id': self.identity.device_id,
+            'sender_name': self.identity.device_id[:8],
+            'receiver_id': receiver_id,
+        }
+        fields.update(self.auth_fields(file_hash, nonce, timestamp, receiver_id, use_session))
+        return fields
+
+    def auth_fields(self, file_hash, nonce, timestamp, receiver_id, use_session=True):
+        """Authenticate a request: a MAC under the receiver's session key if one is agreed, else a signature."""
         sender_id = self.identity.device_id
+        auth_session = self.auth_sessions.get(receiver_id) if use_session else None
+        if auth_session is not None and auth_session['expires'] > time.time():
+            return {
+                'session_id': auth_session['session_id'],
+                'mac': self.auth.create_session_mac(auth_session['key'], file_hash, nonce, timestamp,
+                                                    sender_id, receiver_id),
+            }
+        return {
+            'signature': self.auth.create_auth_header(file_hash, nonce, timestamp, sender_id, receiver_id),
+            'pubkey_pem': self.pubkey_pem(),
+        }
+
+    async def _post_signed(self, session, url, file_hash, receiver_id, **extra):
+        """POST authenticated JSON; if the receiver forgot our session (restart), agree on a new one."""
+        for attempt in range(2):
+            payload = dict(self.signed_fields(file_hash, receiver_id), **extra)
+            resp = await session.post(url, json=payload, ssl=self.tls_context)
+            if resp.status == 401 and 'session_id' in payload and not attempt:
+                resp.release()
+                self.forget_session(receiver_id, payload['session_id'])
+                await self._auth_session(session, str(URL(url).origin()), receiver_id)
+                continue
+            return resp
+        return resp
+
+    def forget_session(self, receiver_id, session_id):
+        """Drop a session the receiver no longer knows, unless it was already replaced."""
+        auth_session = self.auth_sessions.get(receiver_id)
+        if auth_session is not None and auth_session['session_id'] == session_id:
+            del self.auth_sessions[receiver_id]
+
+    async def _auth_session(self, session, base_url, receiver_id):
+        """Agree on a session key with the receiver once, so later requests need no signature.
+
+        Concurrent callers share one handshake. Receivers that predate
+        session keys, or a failed handshake, leave requests signed.
+        """
+        auth_session = self.auth_sessions.get(receiver_id)
+        if auth_session is not None and auth_session['expires'] > time.time() + SESSION_RENEW_MARGIN:
+            return
+        request = self.session_requests.get(receiver_id)
+        if request is None:
+            request = self.session_requests[receiver_id] = asyncio.ensure_future(
+                self._open_auth_session(session, base_url, receiver_id))
+        try:
+            await request
+        except Exception as e:
+            print(f"Session handshake failed ({e}); signing each request instead")
+        finally:
+            self.session_requests.pop(receiver_id, None)
+
+    async def _open_auth_session(self, session, base_url, receiver_id):
+        if not (await self._peer_info(session, base_url)).get('session_auth'):
+            return
+        handshake = self.auth.handshake
+        client_key, client_public = handshake.ephemeral_key()
+        fields = self.signed_fields(handshake.offer_hash(client_public), receiver_id, use_session=False)
+        fields['client_key'] = client_public.hex()
+        async with session.post(f"{base_url}/session", json=fields, ssl=self.tls_context) as resp:
+            if resp.status != 200:
+                raise Exception(await resp.text())
+            reply = await resp.json()
+        server_public = bytes.fromhex(reply['server_key'])
+
+        # The receiver signs the exchange; check it with the trusted key when we have one
+        pubkey = await asyncio.get_running_loop().run_in_executor(None, self.trust_store.get_pubkey, receiver_id)
+        if pubkey is None:
+            async with session.get(f"{base_url}/pubkey", ssl=self.tls_context) as resp:
+                if resp.status != 200:
+                    raise Exception("Failed to get pubkey")
+                pubkey = serialization.load_pem_public_key((await resp.text()).encode())
+        transcript = handshake.transcript_hash(client_public, server_public, reply['session_id'])
+        message = f"{transcript}:{fields['nonce']}:{fields['timestamp']}:{receiver_id}:{fields['sender_id']}"
+        if not handshake.verify_message(message.encode(), bytes.fromhex(reply['signature']), pubkey):
+            raise Exception("Receiver's handshake signature is invalid")
+
+        self.auth_sessions[receiver_id] = {
+            'session_id': reply['session_id'],
+            'key': handshake.derive_key(client_key, server_public, client_public, server_public,
+                                        fields['sender_id'], receiver_id),
+            'expires': time.time() + reply['expires_in'],
+        }
+
+    @contextlib.asynccontextmanager
+    async def _session(self, session):
+        """Use the caller's ClientSession, or a private one for a single request."""
+        if session is not None:
+            yield session
+        else:
+            async with ClientSession() as own_session:
+                yield own_session
+
+    async def send_file_resumable(self, address, port, file_path, receiver_id, streams=None,
+                                  relpath=None, session=None, codec=None):
+        """Send a file through a resumable upload session.
+
+        The file is cut into SEGMENT_SIZE byte ranges that are sent over
+        `streams` parallel connections (chosen from the file size when None).
+        After a dropped connection the client asks the server which ranges
+        it already holds and sends only the rest. Because the server finds an
+        unfinished session by its signed file hash and destination path, a
+        new invocation also resumes where a previous one stopped.
+        """
+        file_path = pathlib.Path(file_path)
+        size = file_path.stat().st_size
+        base_url = f"https://{url_host(address)}:{port}/upload"
+        if streams is None:
+            streams = auto_streams(size)
+
+        upload_id = None
+        received = 0
+        failures = 0
+        async with self._session(session) as session:
+            file_hash, chunk_hashes = await self.hash_file(session, f"https://{url_host(address)}:{port}", file_path)
+            segment_size = max(SEGMENT_SIZE, parse_merkle_hash(file_hash) or 0)
+            while True:
+                try:
+                    if upload_id is None:
+                        upload_id, ranges = await self._init_upload(
+                            session, base_url, file_path.name, relpath or file_path.name,
+                            size, file_hash, chunk_hashes, receiver_id)
+                    else:
+                        ranges = await self._upload_ranges(session, base_url, upload_id)
+                        if ranges is None:
+                            # The server dropped the session; start a new one
+                            upload_id = None
+                            continue
+                    if sum(end - start for start, end in ranges) > received:
+                        failures = 0
+                    received = sum(end - start for start, end in ranges)
+
+                    segments = split_segments(missing_ranges(ranges, size), segment_size)
+                    if segments:
+                        await self._send_segments(session, base_url, upload_id, file_path, segments, streams, codec)
+                        continue  # Confirm with the server before finalizing
+                    if await self._finalize_upload(session, base_url, upload_id):
+                        return
+                    await asyncio.sleep(FINALIZE_RETRY_DELAY)
+                except ReceiverBusy as e:
+                    # Not a failure: the receiver asked us to wait for a free slot
+                    await asyncio.sleep(e.retry_after)
+                except (ClientError, asyncio.TimeoutError) as e:
+                    failures += 1
+                    if failures > MAX_RESUME_ATTEMPTS:
+                        raise
+                    delay = min(2 ** failures, 30)
+                    print(f"Connection lost at {received}/{size} bytes ({e}); resuming in {delay}s")
+                    await asyncio.sleep(delay)
+
+    async def send_file_swarm(self, address, port, file_path, receiver_id, relpath=None, session=None):
+        """Send a large file to one receiver of a swarm (see transfer.swarm).
+
+        Joins the file's swarm job and tells the receiver about the other
+        receivers that joined. Uploads only chunks no receiver has been
+        sent yet, one at a time, so the receivers split the seeding between
+        them; then waits while the receiver fetches the rest from its peers.
+        Whatever has not arrived after SWARM_STALL seconds without progress
+        is sent directly, as in a resumable upload.
+        """
+        file_path = pathlib.Path(file_path)
+        size = file_path.stat().st_size
+        base_url = f"https://{url_host(address)}:{port}"
+        relpath = relpath or file_path.name
+
+        async with self._session(session) as session:
+            file_hash, chunk_hashes = await self.hash_file(session, base_url, file_path)
+            upload_id, ranges = await self._init_upload(
+                session, f"{base_url}/upload", file_path.name, relpath, size, file_hash, chunk_hashes, receiver_id)
+            job = self.swarm.job(file_hash, size, parse_merkle_hash(file_hash))
+            job.peers.append(base_url)
+            announced = None
+
+            async def announce():
+                nonlocal announced
+                if announced != len(job.peers):
+                    announced = len(job.peers)
+                    await self._announce_swarm(session, base_url, upload_id, job, receiver_id)
+
+            try:
+                held = held_chunks(ranges, size, job.chunk_size)
+                while True:
+                    index = job.take(held)
+                    if index is None:
+                        break
+                    offset, length = job.chunk(index)
+                    try:
+                        await announce()
+                        await self._put_segment(session, f"{base_url}/upload", upload_id, file_path, offset, length)
+                    except BaseException:
+                        job.untake(index)
+                        raise
+                    self.swarm.seeded_bytes += length
+
+                received, progress_at = -1, time.monotonic()
+                while True:
+                    await announce()
+                    ranges = await self._upload_ranges(session, f"{base_url}/upload", upload_id)
+                    if ranges is None:
+                        break
+                    got = sum(end - start for start, end in ranges)
+                    if got == size and await self._finalize_upload(session, f"{base_url}/upload", upload_id):
+                        return
+                    if got > received:
+                        received, progress_at = got, time.monotonic()
+                    elif time.monotonic() - progress_at > SWARM_STALL:
+                        break
+                    await asyncio.sleep(SWARM_POLL)
+            except (ReceiverBusy, ClientError, asyncio.TimeoutError) as e:
+                print(f"Swarm upload of {relpath} interrupted ({e}); sending the rest directly")
+            # Nobody delivered the rest; resume the same upload session and send it ourselves
+            await self.send_file_resumable(address, port, file_path, receiver_id, None, relpath, session)
+
+    async def _announce_swarm(self, session, base_url, upload_id, job, receiver_id):
+        """Give the receiver the swarm's token and the other receivers' URLs."""
+        peers = [url for url in job.peers if url != base_url]
+        async with await self._post_signed(session, f"{base_url}/upload/{upload_id}/swarm", job.file_hash,
+                                           receiver_id, token=job.token, peers=peers) as resp:
+            if resp.status != 200:
+                raise Exception(await resp.text())
+
+    async def _init_upload(self, session, base_url, filename, relpath, size, file_hash, chunk_hashes, receiver_id):
+        extra = {'filename': filename, 'relpath': relpath, 'size': size}
+        if chunk_hashes is not None:
+            extra['chunk_hashes'] = chunk_hashes
+        async with await self._post_signed(session, f"{base_url}/init", file_hash, receiver_id, **extra) as resp:
+            if resp.status != 200:
+                raise Exception(await resp.text())
+            result = await resp.json()
+        return result['upload_id'], result['ranges']
 
-        signature = self.auth.create_auth_header(file_hash, nonce, timestamp, sender_id, receiver_id)
+    async def _upload_ranges(self, session, base_url, upload_id):
+        async with session.get(f"{base_url}/{upload_id}", ssl=self.tls_context) as resp:
+            if resp.status == 404:
+                return None
+            if resp.status != 200:
+                raise Exception(await resp.text())
+            return (await resp.json())['ranges']
 
-        # Serialize sender's public key
-        pubkey_pem = self.identity.public_key.public_bytes(
+    async def _send_segments(self, session, base_url, upload_id, file_path, segments, streams, codec=None):
+        """Send segments over `streams` connections, each driven by its own thread.
+
+        A single TLS connection is bound to one core, so with several streams
+        every connection gets its own thread and event loop; OpenSSL releases
+        the GIL while encrypting, letting the streams run in parallel. When
+        one stream fails or the send is cancelled, the others stop after
+        their current segment and this returns without waiting for them.
+        """
+        if streams <= 1:
+            for offset, length in segments:
+                await self._put_segment(session, base_url, upload_id, file_path, offset, length, codec)
+            return
+
+        work = queue.SimpleQueue()
+        for segment in segments:
+            work.put(segment)
+        stop = threading.Event()
+
+        def run_stream():
+            asyncio.run(self._stream_worker(base_url, upload_id, file_path, work, codec, stop))
+
+        loop = asyncio.get_running_loop()
+        pool = ThreadPoolExecutor(max_workers=streams)
+        futures = [loop.run_in_executor(pool, run_stream) for _ in range(streams)]
+        try:
+            await asyncio.gather(*futures)
+        except BaseException:
+            stop.set()
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            # Waiting for the threads here would block the event loop until their segments finish
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _stream_worker(self, base_url, upload_id, file_path, work, codec, stop):
+        async with ClientSession() as session:
+            while not stop.is_set():
+                try:
+                    offset, length = work.get_nowait()
+                except queue.Empty:
+                    return
+                await self._put_segment(session, base_url, upload_id, file_path, offset, length, codec)
+
+    async def _put_segment(self, session, base_url, upload_id, file_path, offset, length, codec=None):
+        body = self._read_range(file_path, offset, length)
+        headers = {}
+        if codec:
+            body = self._compress_stream(body, codec)
+            headers[CODEC_HEADER] = codec
+        url = f"{base_url}/{upload_id}?offset={offset}"
+        async with session.put(url, data=body, headers=headers, ssl=self.tls_context) as resp:
+            if resp.status == 409:
+                # Upload is being finalized; the caller re-checks its ranges
+                return
+            if resp.status == 503:
+                raise ReceiverBusy(retry_after(resp))
+            if resp.status != 200:
+                raise Exception(await resp.text())
+
+    async def _finalize_upload(self, session, base_url, upload_id):
+        """Ask the server to store a complete upload; False if it is not ready yet."""
+        async with session.post(f"{base_url}/{upload_id}/finalize", ssl=self.tls_context) as resp:
+            if resp.status == 409:
+                # Ranges are missing or another request holds the session; the caller re-checks its ranges
+                return False
+            if resp.status != 200:
+                raise Exception(await resp.text())
+            return True
+
+    async def _read_range(self, file_path, offset, length):
+        """Yield length bytes of a file starting at offset, in CHUNK_SIZE pieces."""
+        loop = asyncio.get_running_loop()
+        with open(file_path, 'rb') as f:
+            while length > 0:
+                chunk = await loop.run_in_executor(None, self._read_chunk, f, offset, min(CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                offset += len(chunk)
+                length -= len(chunk)
+                yield chunk
+
+    def _read_chunk(self, f, offset, length):
+        """Read from an open file at offset (blocking), sharing the read with other receivers when fanning out."""
+        if self.shared_reads is not None:
+            return self.shared_reads.read(f, offset, length)
+        f.seek(offset)
+        return f.read(length)
+
+    def pubkey_pem(self):
+        """Serialize the sender's public key for the receiver's first contact."""
+        return self.identity.public_key.public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ).decode('utf-8')  # Convert bytes to string
-
-        data = FormData()
-        data.add_field('file', content, filename=file_path.name)
-        data.add_field('filename', file_path.name)
-        data.add_field('file_hash', file_hash)
-        data.add_field('nonce', nonce)
-        data.add_field('timestamp', str(timestamp))
-        data.add_field('sender_id', sender_id)
-        data.add_field('sender_name', self.identity.device_id[:8])  # Short form for display
-        data.add_field('receiver_id', receiver_id)
-        data.add_field('signature', signature)
-        data.add_field('pubkey_pem', pubkey_pem)
-
-        url = f"https://{address}:{port}/upload"
-        async with ClientSession() as session:
-            async with session.post(url, data=data, ssl=False) as resp:
-                if resp.status == 200:
-                    print("File sent successfully")
-                else:
-                    error = await resp.text()
-                    print(f"Failed to send file: {error}")
\ No newline at end of file
+        ).decode('utf-8')
+
+    async def send_file_channel(self, address, port, file_path, receiver_id, relpath=None, session=None):
+        """Send a file through an upload session over the binary framed data channel.
+
+        The session is negotiated and finalized over HTTPS; only the bytes
+        travel over the channel, so a broken channel leaves a normal
+        resumable session behind.
+        """
+        file_path = pathlib.Path(file_path)
+        size = file_path.stat().st_size
+        base_url = f"https://{url_host(address)}:{port}"
+
+        async with self._session(session) as session:
+            info = await self._peer_info(session, base_url)
+            file_hash, chunk_hashes = await self.hash_file(session, base_url, file_path)
+            upload_id, ranges = await self._init_upload(
+                session, f"{base_url}/upload", file_path.name, relpath or file_path.name,
+                size, file_hash, chunk_hashes, receiver_id)
+            segment_size = max(SEGMENT_SIZE, parse_merkle_hash(file_hash) or 0)
+            segments = split_segments(missing_ranges(ranges, size), segment_size)
+            if segments:
+                ssl_context = self.tls_context if info.get('channel_tls', True) else None
+                try:
+                    reader, writer = await asyncio.open_connection(address, info['channel_port'], ssl=ssl_context)
+                    try:
+                        received = await send_frames(reader, writer, file_path, upload_id, segments)
+                    finally:
+                        writer.close()
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+                    # Channel unreachable, refused its TLS handshake or dropped, e.g. the receiver was
+                    # busy (OSError covers ConnectionError and ssl.SSLError); the session resumes over HTTPS.
+                    # The port may be stale after a restart, so the next file asks /info again.
+                    self.forget_peer(base_url)
+                    await self.send_file_resumable(address, port, file_path, receiver_id, None, relpath, session)
+                    return
+                if received != size:
+                    raise Exception(f"Data channel delivered {received}/{size} bytes")
+            if not await self._finalize_upload(session, f"{base_url}/upload", upload_id):
+                # Not complete after all; the resumable path sends whatever is missing
+                await self.send_file_resumable(address, port, file_path, receiver_id, None, relpath, session)
+
+    async def _peer_info(self, session, base_url):
+        """Fetch the receiver's /info once per PEER_INFO_TTL, sharing one request among concurrent callers."""
+        cached = self.peer_info.get(base_url)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        request = self.info_requests.get(base_url)
+        if request is None:
+            request = self.info_requests[base_url] = asyncio.ensure_future(self._fetch_info(session, base_url))
+        try:
+            info = await request
+        finally:
+            self.info_requests.pop(base_url, None)
+        self.peer_info[base_url] = (time.monotonic() + PEER_INFO_TTL, info)
+        return info
+
+    def forget_peer(self, base_url):
+        """Drop a receiver's cached /info, e.g. after a failed send; it is fetched again when next needed."""
+        self.peer_info.pop(base_url, None)
+
+    async def _fetch_info(self, session, base_url):
+        async with session.get(f"{base_url}/info", ssl=self.tls_context) as resp:
+            # Receivers without /info predate compression, merkle hashing and the data channel
+            return await resp.json() if resp.status == 200 else {}
+
+    async def _choose_codec(self, session, base_url, file_path):
+        """Negotiate a compression codec for this file with the receiver, or None."""
+        if not self.compress:
+            return None
+        peer_codecs = (await self._peer_info(session, base_url)).get('codecs')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, choose_codec, file_path, peer_codecs)
+
+    async def _compress_stream(self, chunks, codec):
+        compressor = make_compressor(codec)
+        async for chunk in chunks:
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+        yield compressor.flush()
+
+    async def _upload_body(self, boundary, file_path, fields, trailer, codec=None, hasher=None, file_hash=None):
+        """Yield the multipart body, hashing the file as its chunks are sent.
+
+        The hash (SHA-256 unless another hasher is given) covers the original
+        bytes; with a codec, the file part carries the compressed stream.
+        A file_hash computed beforehand is sent as is, without hashing again.
+        """
+        loop = asyncio.get_running_loop()
+        hasher = hasher or hashlib.sha256()
+        compressor = make_compressor(codec) if codec else None
+
+        for name, value in fields.items():
+            yield _form_part(boundary, name, value)
+
+        yield _form_part(boundary, 'file', filename=file_path.name)
+        offset = 0
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk = await loop.run_in_executor(None, self._read_chunk, f, offset, CHUNK_SIZE)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                if file_hash is None:
+                    hasher.update(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+        if compressor:
+            yield compressor.flush()
+        yield b'\r\n'
+
+        for name, value in trailer(file_hash or hasher.hexdigest()).items():
+            yield _form_part(boundary, name, value)
+        yield f'--{boundary}--\r\n'.encode()
@@ -0,0 +1,143 @@
+"""Streaming compression codecs negotiated between sender and receiver.
+
+zlib is always available. zstd (Python 3.14+ stdlib) and lz4 (the optional
+`lz4` package) are offered when importable and preferred because they are
+much faster at similar ratios. The content hash always covers the original
+bytes, so compression is invisible to signature checks.
+"""
+import collections
+import math
+import zlib
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+SAMPLE_SIZE = 64 * 1024  # Bytes read at each of the start, middle and end of a file
+MIN_COMPRESS_SIZE = 16 * 1024  # Smaller files are not worth a codec
+MAX_ENTROPY = 7.5  # Bits per byte above which a sample is treated as incompressible
+OUTPUT_LIMIT = 1024 * 1024  # Largest piece produced by one decompression step
+
+# Formats that are already compressed; sending them through a codec only burns CPU
+INCOMPRESSIBLE_SUFFIXES = {
+    '.7z', '.aac', '.apk', '.avi', '.avif', '.br', '.bz2', '.deb', '.dmg', '.docx', '.epub',
+    '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg', '.lz4', '.m4a', '.m4v', '.mkv',
+    '.mov', '.mp3', '.mp4', '.ogg', '.opus', '.png', '.pptx', '.rar', '.rpm', '.tgz', '.webm',
+    '.webp', '.whl', '.xlsx', '.xz', '.zip', '.zst',
+}
+
+
+def available_codecs():
+    """Codec names this side can use, most preferred first."""
+    codecs = []
+    if zstd is not None:
+        codecs.append('zstd')
+    if lz4_frame is not None:
+        codecs.append('lz4')
+    codecs.append('zlib')
+    return codecs
+
+
+def make_compressor(codec):
+    """Return an object with compress(data) and flush() for the codec."""
+    if codec == 'zstd' and zstd is not None:
+        return zstd.ZstdCompressor(level=1)
+    if codec == 'lz4' and lz4_frame is not None:
+        return _Lz4Compressor()
+    if codec == 'zlib':
+        return zlib.compressobj(1)
+    raise ValueError(f"Unsupported codec: {codec}")
+
+
+class _Lz4Compressor:
+    def __init__(self):
+        self.compressor = lz4_frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        out = self.header + self.compressor.compress(data)
+        self.header = b''
+        return out
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+class StreamDecompressor:
+    """Incremental decompressor whose output per step is bounded by OUTPUT_LIMIT.
+
+    Bounding the output keeps a small, highly compressed input from
+    expanding into a large allocation before it reaches the disk.
+    """
+
+    def __init__(self, codec):
+        if codec == 'zstd' and zstd is not None:
+            self.decompressor = zstd.ZstdDecompressor()
+        elif codec == 'lz4' and lz4_frame is not None:
+            self.decompressor = lz4_frame.LZ4FrameDecompressor()
+        elif codec == 'zlib':
+            self.decompressor = zlib.decompressobj()
+        else:
+            raise ValueError(f"Unsupported codec: {codec}")
+        self.is_zlib = codec == 'zlib'
+
+    @property
+    def eof(self):
+        return self.decompressor.eof
+
+    def feed(self, data):
+        """Yield the decompressed output for data, piece by piece."""
+        if self.is_zlib:
+            while data:
+                out = self.decompressor.decompress(data, OUTPUT_LIMIT)
+                data = self.decompressor.unconsumed_tail
+                if out:
+                    yield out
+            return
+        if self.decompressor.eof:
+            return
+        out = self.decompressor.decompress(data, OUTPUT_LIMIT)
+        if out:
+            yield out
+        while not self.decompressor.needs_input and not self.decompressor.eof:
+            out = self.decompressor.decompress(b'', OUTPUT_LIMIT)
+            if not out:
+                break
+            yield out
+
+
+def sample_entropy(path, size):
+    """Shannon entropy, in bits per byte, of samples from a file's start, middle and end."""
+    counts = collections.Counter()
+    total = 0
+    with open(path, 'rb') as f:
+        for offset in {0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)}:
+            f.seek(offset)
+            sample = f.read(SAMPLE_SIZE)
+            counts.update(sample)
+            total += len(sample)
+    if not total:
+        return 0.0
+    return -sum(n / total * math.log2(n / total) for n in counts.values())
+
+
+def choose_codec(path, peer_codecs):
+    """Pick a codec both sides support, or None when the file would not shrink.
+
+    Blocking (reads samples of the file); run it in an executor.
+    """
+    common = [codec for codec in available_codecs() if codec in (peer_codecs or ())]
+    if not common:
+        return None
+    if path.suffix.lower() in INCOMPRESSIBLE_SUFFIXES:
+        return None
+    size = path.stat().st_size
+    if size < MIN_COMPRESS_SIZE or sample_entropy(path, size) > MAX_ENTROPY:
+        return None
+    return common[0]
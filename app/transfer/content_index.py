@@ -0,0 +1,87 @@
+"""Persistent index from content hash to a received file under the incoming directory."""
+import json
+import os
+import pathlib
+import threading
+from .hashing import merkle_file
+
+
+class ContentIndex:
+    """Map content hashes to files already stored in the incoming directory.
+
+    Entries record the file's size and mtime so a file that was edited,
+    moved or deleted after it was indexed is never served as a match.
+    """
+
+    def __init__(self, index_file, root_dir):
+        self.index_file = index_file
+        self.root_dir = root_dir
+        self.entries = {}
+        self.dirty = False
+        self.save_lock = threading.Lock()
+        if self.index_file.exists():
+            try:
+                with open(self.index_file) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def add(self, file_hash, path, stat=None):
+        """Record that path (inside root_dir) holds content with this hash.
+
+        Pass the file's stat result if the caller already has it.
+        """
+        if stat is None:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                return
+        self.entries[file_hash] = {
+            'path': path.relative_to(self.root_dir).as_posix(),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+        }
+        self.dirty = True
+
+    def lookup(self, file_hash):
+        """Return the path of an unchanged file with this hash, or None."""
+        entry = self.entries.get(file_hash)
+        if entry is None:
+            return None
+        path = self.root_dir / entry['path']
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_size != entry['size'] or stat.st_mtime != entry['mtime']:
+            del self.entries[file_hash]
+            self.dirty = True
+            return None
+        return path
+
+    def refresh(self):
+        """Hash files under root_dir that are not indexed yet (blocking; run in an executor)."""
+        known = {entry['path'] for entry in list(self.entries.values())}
+        for root, dirs, names in os.walk(self.root_dir):
+            # Skip hidden directories such as .partial
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in names:
+                path = pathlib.Path(root) / name
+                if name.startswith('.') or path.relative_to(self.root_dir).as_posix() in known:
+                    continue
+                try:
+                    self.add(merkle_file(path)[0], path)
+                except OSError:
+                    continue
+
+    def save(self):
+        """Write the index if it changed (blocking; safe to call from executor threads)."""
+        with self.save_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            entries = dict(self.entries)
+            tmp_path = self.index_file.with_suffix('.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.index_file)
@@ -0,0 +1,84 @@
+"""Shared file reads for sending the same files to several receivers at once."""
+import collections
+import threading
+
+FANOUT_WINDOW = 128 * 1024 * 1024  # Bytes of read chunks kept for receivers that have not sent them yet
+
+
+class SharedReads:
+    """File chunks read from disk once and handed to every receiver of a fan-out send.
+
+    Each receiver's upload asks for the same (file, offset, length) chunks
+    in the same order, at its own pace. The first to ask reads the chunk,
+    and the others get the same bytes. A chunk stays in memory until every
+    other receiver has taken it, or until more than `window` bytes are held;
+    then the oldest chunks are dropped, and a receiver that still needs one
+    reads it from disk itself. A slow receiver costs extra reads, and never
+    stalls the others or grows memory without bound.
+
+    Thread-safe, since uploads over several streams read from their own threads.
+    """
+
+    def __init__(self, receivers, window=FANOUT_WINDOW):
+        self.receivers = receivers
+        self.window = window
+        self.chunks = collections.OrderedDict()  # (path, offset, length) -> [bytes or None, takers left, Event]
+        self.held = 0
+        self.lock = threading.Lock()
+        self.disk_reads = 0
+        self.shared_reads = 0
+
+    def read(self, f, offset, length):
+        """Return up to length bytes of the open file f at offset (blocking)."""
+        if self.receivers <= 1:
+            return self.read_file(f, offset, length)
+        key = (f.name, offset, length)
+        with self.lock:
+            entry = self.chunks.get(key)
+            if entry is None:
+                entry = self.chunks[key] = [None, self.receivers - 1, threading.Event()]
+                reader = True
+            else:
+                reader = False
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    self.drop(key)
+
+        if reader:
+            data = None
+            try:
+                data = self.read_file(f, offset, length)
+                return data
+            finally:
+                with self.lock:
+                    entry[0] = data
+                    if self.chunks.get(key) is entry:
+                        if data is None:
+                            self.drop(key)  # Failed; whoever needs it reads it again
+                        else:
+                            self.held += len(data)
+                            while self.held > self.window and self.chunks:
+                                self.drop(next(iter(self.chunks)))
+                entry[2].set()
+
+        entry[2].wait()
+        if entry[0] is None:
+            return self.read_file(f, offset, length)
+        with self.lock:
+            self.shared_reads += 1
+        return entry[0]
+
+    def read_file(self, f, offset, length):
+        f.seek(offset)
+        data = f.read(length)
+        with self.lock:
+            self.disk_reads += 1
+        return data
+
+    def drop(self, key):
+        entry = self.chunks.pop(key)
+        if entry[0] is not None:
+            self.held -= len(entry[0])
+
+    def stats(self):
+        return {'disk_reads': self.disk_reads, 'shared_reads': self.shared_reads}
@@ -0,0 +1,139 @@
+"""File hashing helpers shared by the transfer client and server.
+
+Files are identified by a two-level hash tree: the file is cut into
+fixed-size chunks, every chunk gets its own SHA-256, and the root is the
+SHA-256 over the chunk size and the concatenated chunk digests. The root is
+what gets signed, written as ``merkle1-<chunk_size>-<hex root>``. Chunk
+digests can be computed on all cores at once, and a receiver that knows
+them can verify and reject each chunk on arrival. Plain 64-character
+SHA-256 hex digests from older senders are still understood.
+"""
+import hashlib
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_CHUNK_SIZE = 1024 * 1024
+MERKLE_PREFIX = 'merkle1'
+MIN_MERKLE_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_MERKLE_CHUNKS = 4096  # Chunk size doubles until a file fits in this many chunks
+
+_hash_pool = None
+
+
+def _pool():
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='myshare-hash')
+    return _hash_pool
+
+
+def sha256_file(path, chunk_size=HASH_CHUNK_SIZE):
+    """Return the hex SHA-256 of a file, reading it in fixed-size chunks."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def merkle_chunk_size(size):
+    """Chunk size used for a file of the given size."""
+    chunk_size = MIN_MERKLE_CHUNK_SIZE
+    while size > chunk_size * MAX_MERKLE_CHUNKS:
+        chunk_size *= 2
+    return chunk_size
+
+
+def merkle_chunk_count(size, chunk_size):
+    return math.ceil(size / chunk_size)
+
+
+def merkle_root(chunk_digests, chunk_size):
+    """Combine raw chunk digests into a file hash string."""
+    hasher = hashlib.sha256(b'myshare-merkle1')
+    hasher.update(chunk_size.to_bytes(8, 'big'))
+    for digest in chunk_digests:
+        hasher.update(digest)
+    return f'{MERKLE_PREFIX}-{chunk_size}-{hasher.hexdigest()}'
+
+
+def parse_merkle_hash(file_hash):
+    """Return the chunk size of a merkle file hash, or None for a flat SHA-256."""
+    parts = file_hash.split('-')
+    if len(parts) == 3 and parts[0] == MERKLE_PREFIX and parts[1].isdigit() and int(parts[1]) > 0:
+        return int(parts[1])
+    return None
+
+
+def _hash_chunk(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return hashlib.sha256(f.read(length)).digest()
+
+
+def merkle_file(path):
+    """Hash a file's chunks in parallel; return (file_hash, [hex chunk digests]).
+
+    Blocking; hashlib releases the GIL on large buffers, so the chunks are
+    hashed on all cores by a shared thread pool.
+    """
+    size = os.path.getsize(path)
+    chunk_size = merkle_chunk_size(size)
+    offsets = range(0, size, chunk_size)
+    if len(offsets) <= 1:
+        digests = [_hash_chunk(path, offset, chunk_size) for offset in offsets]
+    else:
+        digests = list(_pool().map(lambda offset: _hash_chunk(path, offset, chunk_size), offsets))
+    return merkle_root(digests, chunk_size), [digest.hex() for digest in digests]
+
+
+def file_digest(path, file_hash):
+    """Hash a file the same way file_hash was computed, for comparison with it."""
+    if parse_merkle_hash(file_hash) is not None:
+        return merkle_file(path)[0]
+    return sha256_file(path)
+
+
+class MerkleHasher:
+    """Incremental merkle hashing for data that arrives as a stream."""
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.digests = []
+        self.current = hashlib.sha256()
+        self.current_size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.chunk_size - self.current_size)
+            self.current.update(view[:take])
+            self.current_size += take
+            view = view[take:]
+            if self.current_size == self.chunk_size:
+                self.digests.append(self.current.digest())
+                self.current = hashlib.sha256()
+                self.current_size = 0
+
+    def hexdigest(self):
+        digests = list(self.digests)
+        if self.current_size:
+            digests.append(self.current.digest())
+        return merkle_root(digests, self.chunk_size)
+
+
+def new_hasher(hash_type):
+    """Return a streaming hasher for a hash type announced by the sender.
+
+    hash_type is ``merkle1-<chunk_size>``, or empty for a flat SHA-256.
+    """
+    if not hash_type:
+        return hashlib.sha256()
+    prefix, _, chunk_size = hash_type.partition('-')
+    if prefix != MERKLE_PREFIX or not chunk_size.isdigit() or int(chunk_size) <= 0:
+        raise ValueError(f"Unsupported hash type: {hash_type}")
+    return MerkleHasher(int(chunk_size))
@@ -0,0 +1,247 @@
+"""Cheap in-process metrics for the receiver, served in the Prometheus text format.
+
+Metrics are plain counters and fixed-bucket histograms updated in place.
+An update costs a dict lookup, a bisect and an uncontended lock, so they
+stay on in production. Nothing is computed until /metrics is scraped.
+"""
+import asyncio
+import bisect
+import contextlib
+import hmac
+import math
+import os
+import secrets
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+LOOP_LAG_INTERVAL = 0.5  # Seconds between event loop lag probes
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = {}  # label values tuple -> value
+        self.lock = threading.Lock()  # Also updated from I/O threads
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+
+    def labels_text(self, labels, extra=None):
+        pairs = list(zip(self.labelnames, labels))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(str(value))}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{self.labels_text(labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        if not labelnames:
+            self.values[()] = 0  # Reported before the first increment
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function  # Read at scrape time instead of being set
+        if not labelnames:
+            self.values[()] = 0
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                # Per-bucket counts (the last is +Inf), sum, count
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            values = sorted((labels, ([*counts], total, count)) for labels, (counts, total, count)
+                            in self.values.items())
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self.labels_text(labels, ('le', format_value(bound)))} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_sum{self.labels_text(labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{self.labels_text(labels)} {count}")
+        return lines
+
+
+class RequestPhases:
+    """Time spent in each phase of one request, summed and observed once when it ends."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.totals[phase] = self.totals.get(phase, 0.0) + elapsed
+
+    def wrap(self, phase, func):
+        """func, timed into phase on whichever thread calls it."""
+        def timed(*args):
+            with self.time(phase):
+                return func(*args)
+        return timed
+
+    def observe(self):
+        for phase, total in self.totals.items():
+            self.histogram.observe(total, phase)
+        self.totals.clear()
+
+
+class TransferMetrics:
+    """Everything a TransferServer reports on /metrics."""
+
+    def __init__(self):
+        self.metrics = []
+        self.received_bytes = self.add(Counter(
+            'myshare_received_bytes_total', 'File bytes received, by data path (swarm: from other receivers)', ('path',)))
+        self.active_uploads = self.add(Gauge(
+            'myshare_active_uploads', 'Uploads holding a slot and receiving data'))
+        self.waiting_uploads = self.add(Gauge(
+            'myshare_waiting_uploads', 'Uploads waiting for a free slot'))
+        self.busy_rejections = self.add(Counter(
+            'myshare_busy_rejections_total', 'Uploads told to retry because no slot freed up'))
+        self.requests = self.add(Histogram(
+            'myshare_request_seconds', 'HTTP request latency, by route', ('route',)))
+        self.phases = self.add(Histogram(
+            'myshare_request_phase_seconds',
+            'Time a request spent in each phase: multipart_parse, pubkey_load, signature_verify, '
+            'mac_verify, disk_write, trust_store_save', ('phase',)))
+        self.loop_lag = self.add(Histogram(
+            'myshare_event_loop_lag_seconds', 'How late the event loop ran a timer', buckets=LOOP_LAG_BUCKETS))
+        self.auth_failures = self.add(Counter(
+            'myshare_auth_failures_total', 'Requests refused authentication, by reason (replays excluded)',
+            ('reason',)))
+        self.replay_rejections = self.add(Counter(
+            'myshare_replay_rejections_total', 'Requests refused for a reused nonce or a timestamp below the floor'))
+        self.swarm_served_bytes = self.add(Counter(
+            'myshare_swarm_served_bytes_total', 'File bytes served to other receivers of a swarm send'))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def auth_failed(self, reason):
+        if reason == 'replay':
+            self.replay_rejections.inc()
+        else:
+            self.auth_failures.inc(reason)
+
+    def request_phases(self):
+        return RequestPhases(self.phases)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    async def watch_loop_lag(self, loop):
+        """Probe how late timers fire; the gap is time the loop spent blocked."""
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+
+def load_token(path):
+    """Return the bearer token that guards /metrics, creating it (mode 0600) on first use."""
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except FileNotFoundError:
+        pass
+    token = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+    return token
+
+
+def check_token(header, token):
+    scheme, _, credentials = (header or '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return '+Inf' if value == math.inf else str(value)
@@ -0,0 +1,160 @@
+"""Bounded, expiring and persistent memory of nonces used in signed requests."""
+import hashlib
+import os
+import struct
+import time
+
+MAGIC = b'MSN1'
+RECORD = struct.Struct('!dQ')  # Request timestamp, 64-bit nonce digest; digest 0 marks a floor
+BUCKET_SECONDS = 10
+MAX_NONCES = 1_000_000  # Live nonces kept in memory, roughly 70 bytes each
+COMPACT_MIN_RECORDS = 100_000  # Journal length below which it is never rewritten
+
+
+class NonceStore:
+    """Nonces seen within the timestamp window, bucketed by request timestamp.
+
+    Accepted requests carry a signed timestamp within `window` seconds of
+    now, and a replay must carry the same timestamp, so it lands in the same
+    bucket as the original. Whole buckets are dropped once their time range
+    falls out of the window. If more than max_nonces are live, the oldest
+    buckets are dropped early and `floor` rises past them. Requests stamped
+    before the floor are refused, so memory stays bounded without forgetting
+    a nonce that could still be replayed.
+
+    With a path, accepted nonces are appended to a journal of 16-byte
+    records and reloaded on start, so a restart does not reopen the replay
+    window. The journal is rewritten with only the live nonces when it
+    grows to twice their number.
+    """
+
+    def __init__(self, path=None, window=300, bucket_seconds=BUCKET_SECONDS, max_nonces=MAX_NONCES):
+        self.path = path
+        self.window = window
+        self.bucket_seconds = bucket_seconds
+        self.max_nonces = max_nonces
+        self.buckets = {}  # bucket index -> set of nonce digests
+        self.count = 0
+        self.floor = 0.0
+        self.oldest = self.bucket(time.time() - window)  # Buckets below this index are expired
+        self.journal = None
+        self.journal_records = 0
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return self.count
+
+    def bucket(self, timestamp):
+        return int(timestamp // self.bucket_seconds)
+
+    def digest(self, nonce):
+        digest = int.from_bytes(hashlib.blake2b(nonce.encode(), digest_size=8).digest(), 'big')
+        return digest or 1  # 0 is reserved for floor records
+
+    def seen(self, nonce, timestamp):
+        """True if the nonce was already used, or is stamped too early to tell."""
+        self.expire()
+        if timestamp < self.floor:
+            return True
+        bucket = self.buckets.get(self.bucket(timestamp))
+        return bucket is not None and self.digest(nonce) in bucket
+
+    def add(self, nonce, timestamp):
+        """Remember a nonce until its timestamp leaves the window."""
+        digest = self.digest(nonce)
+        if not self.insert(timestamp, digest):
+            return
+        self.write(timestamp, digest)
+        if self.count > self.max_nonces:
+            self.shrink()
+        if self.journal is not None and self.journal_records > max(2 * self.count, COMPACT_MIN_RECORDS):
+            self.compact()
+
+    def insert(self, timestamp, digest):
+        index = self.bucket(timestamp)
+        if index < self.oldest or timestamp < self.floor:
+            return False
+        bucket = self.buckets.setdefault(index, set())
+        if digest in bucket:
+            return False
+        bucket.add(digest)
+        self.count += 1
+        return True
+
+    def drop(self, index):
+        bucket = self.buckets.pop(index, None)
+        if bucket is not None:
+            self.count -= len(bucket)
+
+    def expire(self, now=None):
+        """Drop buckets that ended before the window; amortized O(1) per bucket."""
+        cutoff = self.bucket((now or time.time()) - self.window)
+        if cutoff <= self.oldest:
+            return
+        if cutoff - self.oldest > len(self.buckets):
+            # Idle for a long time; cheaper to scan the few buckets left
+            for index in [index for index in self.buckets if index < cutoff]:
+                self.drop(index)
+        else:
+            for index in range(self.oldest, cutoff):
+                self.drop(index)
+        self.oldest = cutoff
+
+    def shrink(self):
+        """Drop the oldest buckets until within max_nonces, raising the floor past them."""
+        while self.count > self.max_nonces and len(self.buckets) > 1:
+            index = min(self.buckets)
+            self.drop(index)
+            self.oldest = max(self.oldest, index + 1)
+            self.floor = max(self.floor, (index + 1) * self.bucket_seconds)
+        self.write(self.floor, 0)
+
+    def write(self, timestamp, digest):
+        if self.journal is not None:
+            self.journal.write(RECORD.pack(timestamp, digest))
+            self.journal.flush()  # Into the OS, so a crashed listener does not lose it
+            self.journal_records += 1
+
+    def load(self):
+        """Read the journal, keeping what is still inside the window, and compact it."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        if data[:len(MAGIC)] == MAGIC:
+            body = memoryview(data)[len(MAGIC):]
+            body = body[:len(body) - len(body) % RECORD.size]  # Torn final record
+            for timestamp, digest in RECORD.iter_unpack(body):
+                if digest == 0:
+                    self.floor = max(self.floor, timestamp)
+                else:
+                    self.insert(timestamp, digest)
+            if self.count > self.max_nonces:
+                self.shrink()
+        self.compact()
+
+    def compact(self):
+        """Rewrite the journal with only the floor and the live nonces."""
+        if self.path is None:
+            return
+        if self.journal is not None:
+            self.journal.close()
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(RECORD.pack(self.floor, 0))
+            for index, bucket in self.buckets.items():
+                # Any timestamp inside the bucket maps back to the same bucket on load
+                timestamp = (index + 0.5) * self.bucket_seconds
+                f.write(b''.join(RECORD.pack(timestamp, digest) for digest in bucket))
+        os.replace(tmp_path, self.path)
+        self.journal = open(self.path, 'ab')
+        self.journal_records = self.count + 1
+
+    def close(self):
+        if self.journal is not None:
+            self.compact()
+            self.journal.close()
+            self.journal = None
@@ -0,0 +1,55 @@
+"""Small-file packs: many small files in one streamed request body.
+
+Sending thousands of small files one request each is bound by per-request
+overhead (authentication, multipart parsing, a temp file and a rename per
+request round trip), not by bandwidth. A pack carries them in one POST to
+/upload/pack:
+
+    header:   manifest length (u32) + manifest JSON
+    entries:  the bytes of each data entry, back to back, in manifest order
+
+The manifest holds the usual authentication fields plus `entries`, a list
+of [relpath, size, file_hash, data]. Its file_hash is the SHA-256 of the
+canonical JSON of that list, so one signature or MAC covers every entry,
+and each entry's bytes are checked against their own hash. Entries with
+data false carry no bytes; the receiver builds them from content it
+already stores, as /materialize does.
+"""
+import hashlib
+import json
+import struct
+from .hashing import MERKLE_PREFIX, new_hasher, parse_merkle_hash
+
+MANIFEST_HEADER = struct.Struct('!I')
+MAX_MANIFEST_SIZE = 16 * 1024 * 1024
+MAX_ENTRY_SIZE = 1024 * 1024  # Largest file a receiver accepts inside a pack
+
+
+def manifest_hash(entries):
+    """What the sender signs, in place of a file hash, for a pack."""
+    return hashlib.sha256(json.dumps(entries, separators=(',', ':')).encode()).hexdigest()
+
+
+def encode_manifest(fields):
+    manifest = json.dumps(fields, separators=(',', ':')).encode()
+    return MANIFEST_HEADER.pack(len(manifest)) + manifest
+
+
+def parse_entries(entries):
+    """Validate a manifest's entry list; return (relpath, size, file_hash, data) tuples."""
+    parsed = []
+    for relpath, size, file_hash, data in entries:
+        if not isinstance(relpath, str) or not isinstance(file_hash, str) or not isinstance(data, bool):
+            raise ValueError("Invalid pack entry")
+        if not isinstance(size, int) or not 0 <= size <= MAX_ENTRY_SIZE:
+            raise ValueError(f"Invalid pack entry size: {relpath}")
+        parsed.append((relpath, size, file_hash, data))
+    return parsed
+
+
+def data_digest(data, file_hash):
+    """Hash bytes the same way file_hash was computed, for comparison with it."""
+    chunk_size = parse_merkle_hash(file_hash)
+    hasher = new_hasher(f'{MERKLE_PREFIX}-{chunk_size}' if chunk_size else None)
+    hasher.update(data)
+    return hasher.hexdigest()
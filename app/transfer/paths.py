@@ -0,0 +1,109 @@
+"""Choosing between a peer's addresses: connection racing and remembered throughput.
+
+A device advertises every usable address it has: wired and Wi-Fi, IPv4
+and IPv6. Before a send, the sender tries them in order of how fast each
+path was last time, starting the next attempt CONNECT_DELAY seconds
+after the previous one or as soon as it fails (happy eyeballs, RFC
+8305), and sends over whichever connects first. A path that has never
+been measured is tried first, so every path gets measured once; after
+that the one that moved data fastest, usually the wired link, leads.
+"""
+import asyncio
+import json
+import os
+
+CONNECT_DELAY = 0.25  # Seconds before racing the next address while earlier ones are still connecting
+CONNECT_TIMEOUT = 3  # Seconds to wait for any address to connect
+SMOOTHING = 0.5  # Weight of the newest throughput sample against the remembered one
+MIN_SAMPLE_BYTES = 4 * 1024 * 1024  # Sends smaller than this say more about latency than throughput
+
+
+def url_host(address):
+    """address as it goes in a URL: IPv6 addresses are bracketed."""
+    return f"[{address}]" if ':' in address else address
+
+
+class PathStats:
+    """Throughput measured per (receiver, address), kept in the config directory between runs."""
+
+    def __init__(self, stats_file):
+        self.stats_file = stats_file
+        self.stats = self.load()  # receiver_id -> {address: bytes per second, 0 after a failed connect}
+
+    def load(self):
+        try:
+            with open(self.stats_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        tmp_file = self.stats_file.with_suffix('.json.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(self.stats, f, indent=2)
+        os.replace(tmp_file, self.stats_file)
+
+    def order(self, receiver_id, addresses):
+        """addresses in the order to race them: unmeasured first, then fastest first."""
+        known = self.stats.get(receiver_id, {})
+        return sorted(addresses, key=lambda address: (address in known, -known.get(address, 0)))
+
+    def record(self, receiver_id, address, nbytes, seconds):
+        """Fold one send's throughput into the path's estimate."""
+        if nbytes < MIN_SAMPLE_BYTES or seconds <= 0:
+            return
+        self.update(receiver_id, address, nbytes / seconds)
+
+    def failed(self, receiver_id, address):
+        """Rank a path that did not connect below every path that did."""
+        self.update(receiver_id, address, 0)
+
+    def update(self, receiver_id, address, rate):
+        known = self.stats.setdefault(receiver_id, {})
+        if address in known and rate:
+            rate = SMOOTHING * rate + (1 - SMOOTHING) * known[address]
+        known[address] = rate
+        try:
+            self.save()
+        except OSError:
+            pass  # Only a hint for next time
+
+
+async def race(addresses, port, delay=CONNECT_DELAY, timeout=CONNECT_TIMEOUT):
+    """Connect to addresses in order, overlapping slow attempts; return (winner or None, failed addresses).
+
+    The connection is only a probe and is closed again; the send then
+    opens its own to the winning address.
+    """
+    loop = asyncio.get_running_loop()
+    remaining = list(addresses)
+    attempts = {}  # connect task -> address
+    failed = []
+    winner = None
+    deadline = loop.time() + timeout
+    try:
+        while winner is None and (remaining or attempts):
+            if remaining:
+                address = remaining.pop(0)
+                attempts[asyncio.ensure_future(asyncio.open_connection(address, port))] = address
+            wait = deadline - loop.time()
+            if remaining:
+                wait = min(wait, delay)
+            if wait <= 0:
+                break
+            done, _ = await asyncio.wait(attempts, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                address = attempts.pop(task)
+                if task.exception() is not None:
+                    failed.append(address)
+                    continue
+                task.result()[1].close()
+                if winner is None:
+                    winner = address
+    finally:
+        for task in attempts:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                task.result()[1].close()
+    return winner, failed
@@ -1,39 +1,133 @@
 import asyncio
+import contextlib
+import hashlib
+import hmac
+import json
+import os
 import pathlib
+import random
 import re
-import ssl
-from aiohttp import web
+import shutil
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
 from cryptography.hazmat.primitives import serialization
+from ..security.handshake import SESSION_TTL, SessionKeys
 from .auth import Auth
+from .channel import receive_frames
+from .compression import StreamDecompressor, available_codecs
+from .content_index import ContentIndex
+from .hashing import (MERKLE_PREFIX, file_digest, merkle_chunk_count, merkle_chunk_size, merkle_root, new_hasher,
+                      parse_merkle_hash)
+from .metrics import CONTENT_TYPE, Gauge, TransferMetrics, check_token, load_token
+from .pack import MANIFEST_HEADER, MAX_MANIFEST_SIZE, data_digest, manifest_hash, parse_entries
+from .swarm import SWARM_POLL, SWARM_PULLS, SWARM_TTL, TOKEN_HEADER, held_chunks, rarest_first
+from .tls import client_context, server_context
+from .uploads import ChunkVerificationError, RangeWriter, UploadSessionStore, preallocate
+
+CHUNK_SIZE = 1024 * 1024  # 1 MiB per disk write, independent of file size
+MAX_FIELD_SIZE = 64 * 1024  # Upper bound for non-file form fields
+CODEC_HEADER = 'X-MyShare-Codec'  # Compression codec of a range upload body
+IO_WORKERS = 4  # Threads for disk writes, key parsing and other blocking work
+MAX_UPLOADS = 8  # Uploads receiving data at the same time; the rest wait
+UPLOAD_WAIT = 30  # Seconds an upload waits for a slot before getting 503
+RETRY_AFTER = 5  # Seconds a rejected sender is told to wait
+MAX_REQUEST_SIZE = 8 * 1024 * 1024  # Non-streamed request bodies (JSON); file data is streamed and unaffected
+FSYNC_POLICIES = ('always', 'finalize', 'never')
+PACK_BATCH_SIZE = 1024 * 1024  # Bytes of packed files handed to one I/O thread at a time
+PACK_BATCH_FILES = 256  # ...or this many files, whichever comes first
 
 class TransferServer:
     """HTTPS server for receiving files."""
 
-    def __init__(self, identity, trust_store, port):
+    def __init__(self, identity, trust_store, port, channel_port=0, channel_tls=True,
+                 max_uploads=MAX_UPLOADS, fsync='always'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
         self.identity = identity
         self.trust_store = trust_store
         self.port = port
-        self.auth = Auth(identity, trust_store)
+        self.channel_port = channel_port  # 0 picks a free port, advertised through /info
+        self.channel_tls = channel_tls
+        self.metrics = TransferMetrics()
+        self.metrics_token_file = identity.config_dir / 'metrics_token'
+        self.metrics_token = load_token(self.metrics_token_file)
+        self.auth = Auth(identity, trust_store, identity.config_dir / 'nonces.bin', self.metrics)
+        self.sessions = SessionKeys()
+        self.metrics.add(Gauge('myshare_auth_sessions', 'Session keys agreed with senders',
+                               function=lambda: len(self.sessions.sessions)))
+        self.metrics.add(Gauge('myshare_live_nonces', 'Nonces remembered for replay protection',
+                               function=lambda: len(self.auth.nonce_cache)))
         self.incoming_dir = pathlib.Path.home() / 'Downloads' / 'MyShare' / 'Incoming'
         self.incoming_dir.mkdir(parents=True, exist_ok=True)
+        self.uploads = UploadSessionStore(self.incoming_dir / '.partial')
+        self.content_index = ContentIndex(identity.config_dir / 'content_index.json', self.incoming_dir)
+        self.index_save_handle = None
+        self.swarm_jobs = {}  # file_hash -> {'token', 'expires', 'upload_id', 'peers'} of swarm sends joined
+        self.swarm_tasks = {}  # upload_id -> task fetching the upload's missing chunks from its peers
+        # 'always': sync every received range, so resume points survive power loss.
+        # 'finalize': sync a file only before it is moved into place.
+        # 'never': leave it to the OS.
+        self.fsync = fsync
+        self.upload_slots = asyncio.Semaphore(max_uploads)
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='myshare-io')
 
     async def run(self):
-        app = web.Application()
+        app = web.Application(client_max_size=MAX_REQUEST_SIZE, middlewares=[self.measure_request])
         app.router.add_post('/upload', self.upload)
+        app.router.add_post('/upload/init', self.upload_init)
+        app.router.add_post('/upload/pack', self.upload_pack)
+        app.router.add_get('/upload/{upload_id}', self.upload_status)
+        app.router.add_put('/upload/{upload_id}', self.upload_append)
+        app.router.add_post('/upload/{upload_id}/finalize', self.upload_finalize)
+        app.router.add_post('/upload/{upload_id}/swarm', self.upload_swarm)
+        app.router.add_get('/swarm/{file_hash}', self.swarm_status)
+        app.router.add_get('/swarm/{file_hash}/data', self.swarm_data)
         app.router.add_get('/pubkey', self.get_pubkey)
+        app.router.add_get('/info', self.get_info)
+        app.router.add_post('/have', self.have)
+        app.router.add_post('/materialize', self.materialize)
+        app.router.add_post('/session', self.open_session)
+        app.router.add_get('/metrics', self.get_metrics)
 
-        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        ssl_context.load_cert_chain(str(self.identity.cert_file), str(self.identity.key_file))
+        ssl_context = self.tls_context = server_context(self.identity.cert_file, self.identity.key_file)
 
         runner = web.AppRunner(app)
         await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', self.port, ssl_context=ssl_context)
+        site = web.TCPSite(runner, None, self.port, ssl_context=ssl_context)  # Every IPv4 and IPv6 address
         await site.start()
+        channel_servers = await self.start_channel(ssl_context if self.channel_tls else None)
         print(f"Server started on port {self.port}")
+        print(f"Metrics on /metrics, bearer token in {self.metrics_token_file}")
+        self.index_task = asyncio.create_task(self.refresh_content_index())
+        lag_task = asyncio.create_task(self.metrics.watch_loop_lag(asyncio.get_running_loop()))
         try:
             await asyncio.Future()  # Run forever
-        except KeyboardInterrupt:
+        finally:
+            # asyncio.run() turns Ctrl+C into cancelling this task
+            lag_task.cancel()
+            for task in list(self.swarm_tasks.values()):
+                task.cancel()
+            for channel_server in channel_servers:
+                channel_server.close()
             await runner.cleanup()
+            self.io_executor.shutdown(wait=True)
+            self.auth.nonce_cache.close()
+
+    async def start_channel(self, ssl_context):
+        """Listen for the data channel on IPv4 and, where available, IPv6 on the same port."""
+        channel_servers = [await asyncio.start_server(
+            self.handle_channel, '0.0.0.0', self.channel_port, ssl=ssl_context, limit=CHUNK_SIZE)]
+        self.channel_port = channel_servers[0].sockets[0].getsockname()[1]
+        if socket.has_ipv6:
+            try:
+                channel_servers.append(await asyncio.start_server(
+                    self.handle_channel, '::', self.channel_port, ssl=ssl_context, limit=CHUNK_SIZE))
+            except OSError:
+                pass  # IPv6 disabled; senders reach the channel over IPv4 or fall back to HTTPS
+        return channel_servers
 
     async def get_pubkey(self, request):
         """Serve the public key."""
@@ -43,64 +137,875 @@ class TransferServer:
         )
         return web.Response(text=pem.decode())
 
+    async def get_info(self, request):
+        """Advertise the protocol features this receiver supports."""
+        return web.json_response({
+            'device_id': self.identity.device_id,
+            'codecs': available_codecs(),
+            'hash_types': [MERKLE_PREFIX, 'sha256'],
+            'channel_port': self.channel_port,
+            'channel_tls': self.channel_tls,
+            'session_auth': True,
+            'pack': True,
+            'swarm': True,
+        })
+
+    async def get_metrics(self, request):
+        """Serve metrics in the Prometheus text format to holders of the metrics token.
+
+        The token is in ~/.myshare/metrics_token; scrapers send it as a
+        bearer token (credentials_file in a Prometheus scrape config).
+        """
+        if not check_token(request.headers.get('Authorization'), self.metrics_token):
+            self.metrics.auth_failed('metrics_token')
+            return web.Response(status=401, text="Metrics token required",
+                                headers={'WWW-Authenticate': 'Bearer'})
+        return web.Response(body=self.metrics.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    @web.middleware
+    async def measure_request(self, request, handler):
+        resource = request.match_info.route.resource
+        with self.metrics.requests.time(resource.canonical if resource is not None else 'unmatched'):
+            return await handler(request)
+
+    async def handle_channel(self, reader, writer):
+        """Receive raw frames for an upload session over the binary data channel."""
+        phases = self.metrics.request_phases()
+
+        def run_io(func, *args):
+            return self.run_io(phases.wrap('disk_write', func), *args)
+
+        def received(count):
+            self.metrics.received_bytes.inc('channel', amount=count)
+
+        try:
+            async with self.upload_slot():
+                await receive_frames(reader, writer, self.uploads.get, CHUNK_SIZE,
+                                     run_io, sync=self.fsync == 'always', received=received)
+        except web.HTTPServiceUnavailable:
+            pass  # Too busy; closing makes the sender fall back and retry
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            phases.observe()
+
     async def upload(self, request):
-        """Handle file upload."""
-        data = await request.post()
-        file = data.get('file')
-        filename = data.get('filename')
-        file_hash = data.get('file_hash')
-        nonce = data.get('nonce')
-        timestamp = float(data.get('timestamp', 0))
-        sender_id = data.get('sender_id')
-        sender_name = data.get('sender_name', f'Device-{sender_id[:8]}')
-        receiver_id = data.get('receiver_id')
-        signature = data.get('signature')
-        pubkey_pem_field = data.get('pubkey_pem')
-
-        if not all([file, filename, file_hash, nonce, sender_id, receiver_id, signature]):
-            return web.Response(status=400, text="Missing fields")
+        """Handle file upload, streaming the file part straight to disk.
 
-        # Check if sender is already trusted
-        is_new_sender = not self.trust_store.is_trusted(sender_id)
-        
-        # Try to get pubkey from trust store, or use the one from request
-        pubkey = self.trust_store.get_pubkey(sender_id)
-        if not pubkey:
-            if pubkey_pem_field:
+        Waits for an upload slot first; until one frees up the body is not
+        read, so a sender beyond the limit is slowed by TCP flow control.
+        """
+        async with self.upload_slot():
+            return await self.receive_upload(request)
+
+    async def receive_upload(self, request):
+        reader = await request.multipart()
+        fields = {}
+        tmp_path = None
+        received_hash = None
+        phases = self.metrics.request_phases()
+        try:
+            while True:
+                with phases.time('multipart_parse'):
+                    part = await reader.next()
+                if part is None:
+                    break
+                if part.name == 'file':
+                    if tmp_path is not None:
+                        return web.Response(status=400, text="Duplicate file field")
+                    tmp_path = self.incoming_dir / f'.{uuid.uuid4().hex}.part'
+                    try:
+                        decompressor = self.make_decompressor(fields.get('codec'))
+                        hasher = new_hasher(fields.get('hash_type'))
+                    except ValueError as e:
+                        return web.Response(status=400, text=str(e))
+                    try:
+                        size = int(fields.get('size') or 0)
+                    except ValueError:
+                        return web.Response(status=400, text="Invalid size")
+                    received_hash = await self.receive_file_part(part, tmp_path, decompressor, hasher, size,
+                                                                 phases)
+                else:
+                    with phases.time('multipart_parse'):
+                        value = await self.read_field(part)
+                    if value is None:
+                        return web.Response(status=400, text=f"Field too large: {part.name}")
+                    fields[part.name] = value
+
+            if not tmp_path or not fields.get('filename'):
+                return web.Response(status=400, text="Missing fields")
+            response = await self.authenticate(fields)
+            if response is not None:
+                return response
+
+            # The signature covers the claimed hash; the bytes on disk must match it
+            if received_hash != fields['file_hash']:
+                return web.Response(status=400, text="File hash mismatch")
+
+            await self.store_file(tmp_path, fields['filename'], fields.get('relpath'), received_hash)
+            tmp_path = None
+            return web.Response(text="OK")
+        finally:
+            if tmp_path is not None:
+                await self.run_io(tmp_path.unlink, True)
+            phases.observe()
+
+    async def upload_pack(self, request):
+        """Receive a pack of small files (see transfer.pack), storing them as the bytes arrive.
+
+        Files are written in batches on the I/O threads while the next batch
+        is read from the network. Replies with the relpaths whose bytes did
+        not match their hash, and those sent without data whose content is
+        not stored here; everything else was stored.
+        """
+        async with self.upload_slot():
+            return await self.receive_pack(request)
+
+    async def receive_pack(self, request):
+        content = request.content
+        try:
+            manifest_size, = MANIFEST_HEADER.unpack(await content.readexactly(MANIFEST_HEADER.size))
+            if manifest_size > MAX_MANIFEST_SIZE:
+                return web.Response(status=400, text="Manifest too large")
+            fields = json.loads(await content.readexactly(manifest_size))
+            entries = parse_entries(fields['entries'])
+        except asyncio.IncompleteReadError:
+            return web.Response(status=400, text="Truncated pack")
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text="Invalid manifest")
+        if manifest_hash(fields['entries']) != fields.get('file_hash'):
+            return web.Response(status=400, text="Entry list does not match file_hash")
+        response = await self.authenticate(fields)
+        if response is not None:
+            return response
+
+        failed, missing = [], []
+        pending = set()
+        phases = self.metrics.request_phases()
+        write_packed = phases.wrap('disk_write', self.write_packed)
+
+        def collect(done):
+            for task in done:
+                for relpath, file_hash, file_path, stat in task.result():
+                    if file_path is None:
+                        failed.append(relpath)
+                    else:
+                        self.content_index.add(file_hash, file_path, stat)
+
+        batch, batch_size = [], 0
+        try:
+            for relpath, size, file_hash, data in entries:
+                if data:
+                    try:
+                        body = await content.readexactly(size)
+                    except asyncio.IncompleteReadError:
+                        return web.Response(status=400, text="Truncated pack")
+                    self.metrics.received_bytes.inc('pack', amount=size)
+                    batch.append((relpath, file_hash, body, None))
+                    batch_size += size
+                else:
+                    source = self.content_index.lookup(file_hash)
+                    if source is None:
+                        missing.append(relpath)
+                        continue
+                    batch.append((relpath, file_hash, None, source))
+                if batch_size >= PACK_BATCH_SIZE or len(batch) >= PACK_BATCH_FILES:
+                    pending.add(asyncio.ensure_future(self.run_io(write_packed, batch)))
+                    batch, batch_size = [], 0
+                    if len(pending) >= IO_WORKERS:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        collect(done)
+            if batch:
+                pending.add(asyncio.ensure_future(self.run_io(write_packed, batch)))
+        finally:
+            # Files written before an error stay; they were verified
+            if pending:
+                done, _ = await asyncio.wait(pending)
+                collect(done)
+            self.schedule_index_save()
+            phases.observe()
+        return web.json_response({'failed': failed, 'missing': missing})
+
+    def write_packed(self, batch):
+        """Verify and store a batch of packed files (blocking).
+
+        Returns (relpath, file_hash, path, stat) per file; path and stat are
+        None for a file whose bytes did not match its hash.
+        """
+        results = []
+        for relpath, file_hash, body, source in batch:
+            if body is None:
+                file_path = self.copy_stored(source, relpath, relpath)
+                results.append((relpath, file_hash, file_path, file_path.stat()))
+                continue
+            if data_digest(body, file_hash) != file_hash:
+                results.append((relpath, file_hash, None, None))
+                continue
+            file_path = self.incoming_path(relpath, relpath)
+            tmp_path = file_path.with_name(f'.{uuid.uuid4().hex}.part')
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(body)
+                    sync_file(f, self.fsync != 'never')
+                    stat = os.fstat(f.fileno())
+                self.move_into_place(tmp_path, file_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            results.append((relpath, file_hash, file_path, stat))
+        return results
+
+    async def upload_init(self, request):
+        """Start a resumable upload, or resume the existing one for the same content."""
+        try:
+            fields = await request.json()
+            size = int(fields['size'])
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text="Invalid request")
+        if size < 0 or not fields.get('filename'):
+            return web.Response(status=400, text="Invalid request")
+
+        chunk_size = parse_merkle_hash(str(fields.get('file_hash') or ''))
+        chunk_hashes = fields.get('chunk_hashes')
+        if chunk_size is not None:
+            if not isinstance(chunk_hashes, list):
+                return web.Response(status=400, text="Invalid request")
+            try:
+                digests = [bytes.fromhex(h) for h in chunk_hashes]
+            except (ValueError, TypeError):
+                return web.Response(status=400, text="Invalid request")
+            chunk_hashes = [digest.hex() for digest in digests]  # Compared with hexdigest() as chunks arrive
+            # The signed root commits to the chunk digests; check them before trusting any.
+            # Each chunk is held in memory until verified, so only the standard chunk size is accepted.
+            if (chunk_size != merkle_chunk_size(size) or len(digests) != merkle_chunk_count(size, chunk_size)
+                    or merkle_root(digests, chunk_size) != fields['file_hash']):
+                return web.Response(status=400, text="Chunk hashes do not match file_hash")
+
+        response = await self.authenticate(fields)
+        if response is not None:
+            return response
+
+        session = self.uploads.find(fields['sender_id'], fields['receiver_id'], fields['file_hash'],
+                                    fields['filename'], fields.get('relpath'))
+        if session is not None and session.size != size:
+            await self.run_io(self.uploads.remove, session)
+            session = None
+        if session is None:
+            session = await self.run_io(self.uploads.create, {
+                'filename': fields['filename'],
+                'relpath': fields.get('relpath'),
+                'size': size,
+                'file_hash': fields['file_hash'],
+                'nonce': fields['nonce'],
+                'sender_id': fields['sender_id'],
+                'receiver_id': fields['receiver_id'],
+                'chunk_size': chunk_size,
+                'chunk_hashes': chunk_hashes if chunk_size is not None else None,
+            })
+        return web.json_response(self.session_status(session))
+
+    async def upload_status(self, request):
+        """Report how many bytes of a resumable upload have been received."""
+        session = self.uploads.get(request.match_info['upload_id'])
+        if session is None:
+            return web.Response(status=404, text="Unknown upload")
+        return web.json_response(self.session_status(session))
+
+    async def upload_append(self, request):
+        """Write the request body into a resumable upload at the given offset.
+
+        Ranges may arrive in any order and over several connections at once;
+        the part file is preallocated, so each range is written in place.
+        """
+        session = self.uploads.get(request.match_info['upload_id'])
+        if session is None:
+            return web.Response(status=404, text="Unknown upload")
+        try:
+            offset = int(request.query['offset'])
+        except (KeyError, ValueError):
+            return web.Response(status=400, text="Missing offset")
+        if not 0 <= offset <= session.size:
+            return web.Response(status=400, text="Invalid offset")
+        if session.lock.locked():
+            # Being finalized
+            return web.json_response(self.session_status(session), status=409)
+        try:
+            decompressor = self.make_decompressor(request.headers.get(CODEC_HEADER))
+        except ValueError as e:
+            return web.Response(status=400, text=str(e))
+
+        phases = self.metrics.request_phases()
+        async with self.upload_slot():
+            # Finalize may have started, or finished, while this waited for a slot
+            if self.uploads.get(session.upload_id) is not session:
+                return web.Response(status=404, text="Unknown upload")
+            if session.lock.locked():
+                return web.json_response(self.session_status(session), status=409)
+            f = await self.run_io(open, session.part_path, 'r+b')
+            try:
                 try:
-                    # Handle both bytes and string
-                    if hasattr(pubkey_pem_field, 'read'):
-                        pubkey_pem = pubkey_pem_field.read()
+                    writer = RangeWriter(session, f, offset)
+                except ChunkVerificationError as e:
+                    return web.Response(status=400, text=str(e))
+
+                def write(body_chunk):
+                    for chunk in decompressor.feed(body_chunk) if decompressor else (body_chunk,):
+                        writer.write(chunk)
+
+                write = phases.wrap('disk_write', write)
+                try:
+                    async for body_chunk in request.content.iter_chunked(CHUNK_SIZE):
+                        self.metrics.received_bytes.inc('range', amount=len(body_chunk))
+                        await self.run_io(write, body_chunk)
+                except ConnectionError:
+                    pass  # Sender went away; what arrived is kept and reported on the next status query
+                except (ChunkVerificationError, ValueError) as e:
+                    return web.Response(status=400, text=str(e))
+                finally:
+                    # Ranges are recorded only after their bytes are flushed (and synced, per policy)
+                    await self.run_io(phases.wrap('disk_write', sync_file), f, self.fsync == 'always')
+                    writer.close()
+                    await self.run_io(session.save)
+            finally:
+                await self.run_io(f.close)
+                phases.observe()
+        return web.json_response(self.session_status(session))
+
+    async def upload_finalize(self, request):
+        """Verify a completed resumable upload and move it into place."""
+        session = self.uploads.get(request.match_info['upload_id'])
+        if session is None:
+            return web.Response(status=404, text="Unknown upload")
+        if session.lock.locked() or not session.is_complete():
+            return web.json_response(self.session_status(session), status=409)
+
+        async with session.lock, session.swarm_lock:
+            received_hash = session.meta['file_hash']
+            if not session.chunk_size or self.fsync != 'always':
+                # Chunks were not verified on arrival, or their ranges were recorded
+                # without a sync and may not match the disk after a crash
+                loop = asyncio.get_running_loop()
+                received_hash = await loop.run_in_executor(None, file_digest, session.part_path, received_hash)
+            if received_hash != session.meta['file_hash']:
+                await self.run_io(self.uploads.remove, session)
+                return web.Response(status=400, text="File hash mismatch")
+            if self.fsync == 'finalize':
+                await self.run_io(sync_path, session.part_path)
+            await self.store_file(session.part_path, session.meta['filename'], session.meta.get('relpath'),
+                                  received_hash)
+            await self.run_io(self.uploads.remove, session)
+        return web.Response(text="OK")
+
+    async def upload_swarm(self, request):
+        """Join a swarm send (see transfer.swarm): fetch this upload's missing chunks from its peers.
+
+        Sent by the upload's sender, signed over the file hash, with the
+        job's token and the other receivers' URLs. Sent again as more
+        receivers join; the latest peer list is used from then on.
+        """
+        session = self.uploads.get(request.match_info['upload_id'])
+        if session is None:
+            return web.Response(status=404, text="Unknown upload")
+        try:
+            fields = await request.json()
+            token = str(fields['token'])
+            peers = [str(url) for url in fields['peers'] if str(url).startswith('https://')]
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text="Invalid request")
+        if not session.chunk_size:
+            return web.Response(status=400, text="A swarm needs chunk hashes")
+        if fields.get('file_hash') != session.meta['file_hash'] or fields.get('sender_id') != session.meta['sender_id']:
+            return web.Response(status=403, text="Not this upload's sender")
+        response = await self.authenticate(fields)
+        if response is not None:
+            return response
+
+        now = time.time()
+        for file_hash, job in list(self.swarm_jobs.items()):
+            if job['expires'] < now:
+                del self.swarm_jobs[file_hash]
+        self.swarm_jobs[session.meta['file_hash']] = {
+            'token': token,
+            'expires': now + SWARM_TTL,
+            'upload_id': session.upload_id,
+            'peers': peers,
+        }
+        if session.upload_id not in self.swarm_tasks:
+            task = self.swarm_tasks[session.upload_id] = asyncio.create_task(self.pull_swarm(session))
+            task.add_done_callback(lambda _: self.swarm_tasks.pop(session.upload_id, None))
+        return web.json_response(self.session_status(session))
+
+    async def swarm_status(self, request):
+        """Tell another receiver of a swarm which byte ranges of the file are here."""
+        source = self.swarm_source(request)
+        if source is None:
+            return web.Response(status=404, text="Unknown swarm")
+        _, size, ranges = source
+        return web.json_response({'size': size, 'ranges': ranges})
+
+    async def swarm_data(self, request):
+        """Serve a byte range of a swarm's file to another receiver, if every byte of it is here."""
+        source = self.swarm_source(request)
+        if source is None:
+            return web.Response(status=404, text="Unknown swarm")
+        path, size, ranges = source
+        try:
+            http_range = request.http_range
+        except ValueError:
+            return web.Response(status=400, text="Invalid range")
+        start, stop = http_range.start, http_range.stop
+        if start is None or stop is None or not 0 <= start < stop <= size:
+            return web.Response(status=400, text="Invalid range")
+        if not any(range_start <= start and stop <= range_end for range_start, range_end in ranges):
+            return web.Response(status=416, text="Range not held here")
+        self.metrics.swarm_served_bytes.inc(amount=stop - start)
+        return web.FileResponse(path)
+
+    def swarm_source(self, request):
+        """(path, size, held ranges) of a swarm's file for a request with the job's token, or None."""
+        file_hash = request.match_info['file_hash']
+        job = self.swarm_jobs.get(file_hash)
+        token = request.headers.get(TOKEN_HEADER, '')
+        if job is None or job['expires'] < time.time():
+            return None  # Ended or never here; peers that arrive late are not attacks
+        if not hmac.compare_digest(token.encode(), job['token'].encode()):
+            self.metrics.auth_failed('swarm_token')
+            return None
+        session = self.uploads.get(job['upload_id'])
+        if session is not None:
+            return session.part_path, session.size, [list(r) for r in session.ranges]
+        # Finalized since; keep serving the stored file
+        path = self.content_index.lookup(file_hash)
+        if path is None:
+            return None
+        size = path.stat().st_size
+        return path, size, [[0, size]]
+
+    async def pull_swarm(self, session):
+        """Fetch the chunks an upload lacks from the other receivers of its swarm until it is complete.
+
+        Runs while the upload is open and the job has not expired. Peers
+        are asked which chunks they hold every SWARM_POLL seconds; the
+        rarest missing chunks are fetched first, SWARM_PULLS at a time,
+        each from a random peer that holds it.
+        """
+        file_hash = session.meta['file_hash']
+        chunk_size = session.chunk_size
+        fetching = {}  # task -> chunk index
+        availability, checked = {}, 0.0
+        loop = asyncio.get_running_loop()
+        connector = TCPConnector(limit=SWARM_PULLS * 2)
+        async with ClientSession(connector=connector, timeout=ClientTimeout(sock_read=30)) as http:
+            try:
+                while self.uploads.get(session.upload_id) is session and not session.is_complete():
+                    job = self.swarm_jobs.get(file_hash)
+                    if job is None or job['upload_id'] != session.upload_id or job['expires'] < time.time():
+                        return
+                    if len(fetching) < SWARM_PULLS:
+                        if loop.time() - checked >= SWARM_POLL:
+                            availability = await self.swarm_availability(http, file_hash, job, session.size, chunk_size)
+                            checked = loop.time()
+                        held = held_chunks(session.ranges, session.size, chunk_size)
+                        wanted = [index for index in availability
+                                  if index not in held and index not in fetching.values()]
+                        for index, peers in rarest_first(wanted, availability, SWARM_PULLS - len(fetching)):
+                            task = asyncio.create_task(self.fetch_swarm_chunk(
+                                http, session, job, random.choice(peers), index))
+                            fetching[task] = index
+                    if fetching:
+                        done, _ = await asyncio.wait(fetching, timeout=SWARM_POLL,
+                                                     return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            del fetching[task]
                     else:
-                        pubkey_pem = pubkey_pem_field
-                    
-                    # Ensure it's bytes
-                    if isinstance(pubkey_pem, str):
-                        pubkey_pem = pubkey_pem.encode('utf-8')
-                    
-                    pubkey = serialization.load_pem_public_key(pubkey_pem)
+                        await asyncio.sleep(SWARM_POLL)
+            finally:
+                for task in fetching:
+                    task.cancel()
+                if fetching:
+                    await asyncio.wait(fetching)
+
+    async def swarm_availability(self, http, file_hash, job, size, chunk_size):
+        """Ask every peer which chunks it holds; return {chunk index: [peer URLs]}."""
+        async def ask(url):
+            try:
+                async with http.get(f"{url}/swarm/{file_hash}", headers={TOKEN_HEADER: job['token']},
+                                    ssl=client_context(), timeout=ClientTimeout(total=SWARM_POLL * 4)) as resp:
+                    if resp.status != 200:
+                        return url, []
+                    return url, (await resp.json())['ranges']
+            except (ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError):
+                return url, []
+
+        availability = {}
+        for url, ranges in await asyncio.gather(*[ask(url) for url in job['peers']]):
+            try:
+                for index in held_chunks(ranges, size, chunk_size):
+                    availability.setdefault(index, []).append(url)
+            except (ValueError, TypeError):
+                continue  # Malformed reply from that peer
+        return availability
+
+    async def fetch_swarm_chunk(self, http, session, job, url, index):
+        """Fetch one chunk from a peer and write it if it matches its digest; failures are left for a retry."""
+        chunk_size = session.chunk_size
+        start = index * chunk_size
+        end = min(start + chunk_size, session.size)
+        headers = {TOKEN_HEADER: job['token'], 'Range': f'bytes={start}-{end - 1}'}
+        try:
+            async with http.get(f"{url}/swarm/{session.meta['file_hash']}/data", headers=headers,
+                                ssl=client_context()) as resp:
+                if resp.status != 206:
+                    return
+                data = await resp.read()
+        except (ClientError, asyncio.TimeoutError):
+            return
+        if len(data) != end - start:
+            return
+        async with session.swarm_lock:
+            # Finalize may have started, or the sender or another peer delivered the chunk, during the fetch
+            if (session.lock.locked() or self.uploads.get(session.upload_id) is not session
+                    or index in held_chunks(session.ranges, session.size, chunk_size)):
+                return
+            self.metrics.received_bytes.inc('swarm', amount=len(data))
+            try:
+                writer = await self.run_io(self.write_swarm_chunk, session, start, data)
+            except (ChunkVerificationError, OSError):
+                return  # Corrupt, or the part file is gone
+            writer.close()
+            await self.run_io(session.save)
+
+    def write_swarm_chunk(self, session, offset, data):
+        """Write a chunk fetched from a peer into an upload's part file (blocking); return its RangeWriter."""
+        with open(session.part_path, 'r+b') as f:
+            writer = RangeWriter(session, f, offset)
+            try:
+                writer.write(data)
+            finally:
+                sync_file(f, self.fsync == 'always')
+        return writer
+
+    async def have(self, request):
+        """Report which of the given content hashes are already stored here.
+
+        The sender signs the SHA-256 of the newline-joined hash list in place
+        of a file hash, so one signature covers the whole query.
+        """
+        try:
+            fields = await request.json()
+            hashes = [str(h) for h in fields['hashes']]
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text="Invalid request")
+        if hashlib.sha256('\n'.join(hashes).encode()).hexdigest() != fields.get('file_hash'):
+            return web.Response(status=400, text="Hash list does not match file_hash")
+        response = await self.authenticate(fields)
+        if response is not None:
+            return response
+        present = [h for h in hashes if self.content_index.lookup(h) is not None]
+        return web.json_response({'have': present})
+
+    async def materialize(self, request):
+        """Create a file from already-stored content instead of receiving it again."""
+        try:
+            fields = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="Invalid request")
+        if not fields.get('filename'):
+            return web.Response(status=400, text="Missing fields")
+        response = await self.authenticate(fields)
+        if response is not None:
+            return response
+
+        source = self.content_index.lookup(fields['file_hash'])
+        if source is None:
+            return web.Response(status=404, text="Content not available")
+        await self.run_io(self.copy_stored, source, fields['filename'], fields.get('relpath'))
+        return web.Response(text="OK")
+
+    def copy_stored(self, source, filename, relpath=None):
+        """Place already-stored content at a new path, hard linking when possible (blocking)."""
+        file_path = self.incoming_path(filename, relpath)
+        if file_path == source:
+            return file_path
+        tmp_path = file_path.with_name(f'.{uuid.uuid4().hex}.part')
+        try:
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                # Different filesystem or no hard link support
+                shutil.copyfile(source, tmp_path)
+                if self.fsync != 'never':
+                    sync_path(tmp_path)
+            self.move_into_place(tmp_path, file_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return file_path
+
+    async def open_session(self, request):
+        """Session handshake: agree on a key that authenticates the sender's further requests.
+
+        The sender signs its ephemeral X25519 key like any request, with the
+        key's hash in place of a file hash, so nonce, timestamp and receiver
+        binding are checked as usual. The reply carries this side's ephemeral
+        key and a signature over the whole exchange.
+        """
+        try:
+            fields = await request.json()
+            client_public = bytes.fromhex(fields['client_key'])
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text="Invalid request")
+        handshake = self.auth.handshake
+        if len(client_public) != 32 or fields.get('file_hash') != handshake.offer_hash(client_public):
+            return web.Response(status=400, text="Invalid client key")
+        if fields.get('session_id'):
+            return web.Response(status=400, text="A session must be opened with a signature")
+        if fields.get('receiver_id') != self.identity.device_id:
+            return web.Response(status=403, text="Wrong receiver")
+        response = await self.authenticate(fields)
+        if response is not None:
+            return response
+
+        sender_id, receiver_id = fields['sender_id'], fields['receiver_id']
+        server_key, server_public = handshake.ephemeral_key()
+        key = handshake.derive_key(server_key, client_public, client_public, server_public, sender_id, receiver_id)
+        session_id = self.sessions.issue(key, sender_id, receiver_id)
+        transcript = handshake.transcript_hash(client_public, server_public, session_id)
+        return web.json_response({
+            'session_id': session_id,
+            'server_key': server_public.hex(),
+            'expires_in': SESSION_TTL,
+            'signature': self.auth.create_auth_header(transcript, fields['nonce'], fields['timestamp'],
+                                                      receiver_id, sender_id),
+        })
+
+    async def refresh_content_index(self):
+        """Index files that arrived in the incoming directory by other means."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.content_index.refresh)
+        await self.run_io(self.content_index.save)
+
+    def schedule_index_save(self):
+        """Save the content index shortly, coalescing bursts of completed uploads."""
+        if self.index_save_handle is None:
+            def save():
+                self.index_save_handle = None
+                asyncio.get_running_loop().run_in_executor(self.io_executor, self.content_index.save)
+            self.index_save_handle = asyncio.get_running_loop().call_later(1.0, save)
+
+    async def run_io(self, func, *args):
+        """Run blocking file or key work on the bounded I/O executor."""
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, func, *args)
+
+    @contextlib.asynccontextmanager
+    async def upload_slot(self):
+        """Hold one of the upload slots, answering 503 if none frees up within UPLOAD_WAIT."""
+        self.metrics.waiting_uploads.inc()
+        try:
+            await asyncio.wait_for(self.upload_slots.acquire(), UPLOAD_WAIT)
+        except asyncio.TimeoutError:
+            self.metrics.busy_rejections.inc()
+            raise web.HTTPServiceUnavailable(text="Too many uploads in progress",
+                                             headers={'Retry-After': str(RETRY_AFTER)})
+        finally:
+            self.metrics.waiting_uploads.dec()
+        self.metrics.active_uploads.inc()
+        try:
+            yield
+        finally:
+            self.metrics.active_uploads.dec()
+            self.upload_slots.release()
+
+    def session_status(self, session):
+        return {
+            'upload_id': session.upload_id,
+            'size': session.size,
+            'offset': session.offset,
+            'ranges': session.ranges,
+        }
+
+    async def receive_file_part(self, part, tmp_path, decompressor=None, hasher=None, size=0, phases=None):
+        """Write a multipart file part to disk chunk by chunk, returning its hash.
+
+        The hash is SHA-256 unless the sender announced another hash type.
+        With a decompressor the part is decoded as it arrives; the hash is
+        always taken over the decoded, original content. Decoding, hashing
+        and writing run on the I/O executor. A size announced by the sender
+        is preallocated up front and trimmed to what actually arrived.
+        """
+        hasher = hasher or hashlib.sha256()
+        phases = phases or self.metrics.request_phases()
+
+        def open_part():
+            f = open(tmp_path, 'wb')
+            # The size is not signed; never reserve more than the disk has free
+            if size and size < shutil.disk_usage(tmp_path.parent).free:
+                preallocate(f, size)
+            return f
+
+        def write(chunk):
+            for data in decompressor.feed(chunk) if decompressor else (chunk,):
+                hasher.update(data)
+                f.write(data)
+
+        def close():
+            try:
+                f.truncate()
+                sync_file(f, self.fsync != 'never')
+            finally:
+                f.close()
+
+        write = phases.wrap('disk_write', write)
+        f = await self.run_io(phases.wrap('disk_write', open_part))
+        try:
+            while True:
+                chunk = await part.read_chunk(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.metrics.received_bytes.inc('multipart', amount=len(chunk))
+                await self.run_io(write, chunk)
+        finally:
+            await self.run_io(phases.wrap('disk_write', close))
+        return hasher.hexdigest()
+
+    def make_decompressor(self, codec):
+        """Return a StreamDecompressor for a negotiated codec, or None for raw bodies."""
+        if not codec:
+            return None
+        if codec not in available_codecs():
+            raise ValueError(f"Unsupported codec: {codec}")
+        return StreamDecompressor(codec)
+
+    async def read_field(self, part):
+        """Read a small text field, or return None if it exceeds MAX_FIELD_SIZE."""
+        data = bytearray()
+        while True:
+            chunk = await part.read_chunk(8192)
+            if not chunk:
+                break
+            data.extend(chunk)
+            if len(data) > MAX_FIELD_SIZE:
+                return None
+        return data.decode('utf-8')
+
+    async def authenticate(self, fields):
+        """Check the signed fields of a request; return an error response or None."""
+        file_hash = fields.get('file_hash')
+        nonce = fields.get('nonce')
+        sender_id = fields.get('sender_id')
+        receiver_id = fields.get('receiver_id')
+        signature = fields.get('signature')
+        pubkey_pem = fields.get('pubkey_pem')
+        session_id = fields.get('session_id')
+
+        if not all([file_hash, nonce, sender_id, receiver_id, signature or session_id]):
+            return web.Response(status=400, text="Missing fields")
+        try:
+            timestamp = float(fields.get('timestamp', 0))
+        except ValueError:
+            return web.Response(status=400, text="Invalid timestamp")
+
+        if session_id:
+            # A MAC under the key agreed in the session handshake replaces the signature
+            session = self.sessions.get(session_id)
+            if session is None:
+                self.metrics.auth_failed('unknown_session')
+                return web.Response(status=401, text="Unknown session")
+            if session['sender_id'] != sender_id or session['receiver_id'] != receiver_id:
+                self.metrics.auth_failed('session_mismatch')
+                return web.Response(status=403, text="Auth failed")
+            with self.metrics.phases.time('mac_verify'):
+                verified = self.auth.verify_session_mac(session['key'], file_hash, nonce, timestamp, sender_id,
+                                                        receiver_id, fields.get('mac'))
+            if not verified:
+                return web.Response(status=403, text="Auth failed")
+            return None
+
+        sender_name = fields.get('sender_name') or f'Device-{sender_id[:8]}'
+
+        # Try to get pubkey from trust store, or use the one from request. The store queries SQLite
+        # and may wait on another process's write, so it is read off the event loop too.
+        with self.metrics.phases.time('pubkey_load'):
+            pubkey = await self.run_io(self.trust_store.get_pubkey, sender_id)
+            is_new_sender = pubkey is None
+            if not pubkey and pubkey_pem:
+                try:
+                    pubkey = await self.run_io(serialization.load_pem_public_key, pubkey_pem.encode('utf-8'))
                 except Exception as e:
+                    self.metrics.auth_failed('invalid_pubkey')
                     return web.Response(status=403, text=f"Invalid pubkey: {str(e)}")
-            else:
-                return web.Response(status=403, text="Sender not trusted and no pubkey provided")
+        if not pubkey:
+            self.metrics.auth_failed('untrusted')
+            return web.Response(status=403, text="Sender not trusted and no pubkey provided")
 
-        if not self.auth.verify_auth(file_hash, nonce, timestamp, sender_id, receiver_id, signature, pubkey):
+        with self.metrics.phases.time('signature_verify'):
+            verified = self.auth.verify_auth(file_hash, nonce, timestamp, sender_id, receiver_id, signature, pubkey)
+        if not verified:
             return web.Response(status=403, text="Auth failed")
 
         # Auto-trust new senders after successful signature verification
         if is_new_sender and pubkey:
-            self.trust_store.add_device(sender_id, sender_name, pubkey)
+            with self.metrics.phases.time('trust_store_save'):
+                await self.run_io(self.trust_store.add_device, sender_id, sender_name, pubkey)
             print(f"Auto-trusted new device: {sender_name}")
+        return None
 
-        # Save file
-        safe_filename = self.safe_filename(filename)
-        file_path = self.incoming_dir / safe_filename
-        with open(file_path, 'wb') as f:
-            f.write(file.file.read())
+    async def store_file(self, tmp_path, filename, relpath=None, file_hash=None):
+        """Move a verified file into the incoming directory, under relpath if given."""
+        file_path = await self.run_io(self.incoming_path, filename, relpath)
+        await self.run_io(self.move_into_place, tmp_path, file_path)
+        if file_hash:
+            self.content_index.add(file_hash, file_path)
+            self.schedule_index_save()
+        return file_path
 
-        return web.Response(text="OK")
+    def move_into_place(self, tmp_path, file_path):
+        """Atomically rename a finished temp file to its final path (blocking)."""
+        os.replace(tmp_path, file_path)
+        if self.fsync == 'always':
+            sync_directory(file_path.parent)
+
+    def incoming_path(self, filename, relpath=None):
+        file_path = self.incoming_dir / self.safe_relpath(relpath or filename)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        return file_path
+
+    def safe_relpath(self, relpath):
+        """Sanitize a sender-supplied relative path so it stays inside incoming_dir."""
+        parts = [self.safe_filename(part) for part in re.split(r'[/\\]', relpath)
+                 if part not in ('', '.', '..')]
+        if not parts:
+            parts = ['unnamed']
+        if parts[0] == '.partial':
+            parts[0] = '_partial'
+        return pathlib.Path(*parts)
 
     def safe_filename(self, filename):
         """Sanitize filename."""
         filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
-        return filename
\ No newline at end of file
+        return filename
+
+
+def sync_file(f, durable=True):
+    """Flush a file object, and fsync it when durable is set."""
+    f.flush()
+    if durable:
+        os.fsync(f.fileno())
+
+
+def sync_path(path):
+    with open(path, 'r+b') as f:
+        os.fsync(f.fileno())
+
+
+def sync_directory(path):
+    """Persist a rename by syncing the containing directory, where the OS allows it."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""Swarm sends: receivers of the same large file pass verified chunks to each other.
+
+When one sender pushes a large file to many receivers, its uplink is the
+bottleneck. In a swarm send the sender uploads each merkle chunk to only
+one receiver, and the receivers fetch the chunks they lack from each other.
+The sender's upload stays about one copy of the file however many
+receivers there are. Every chunk a receiver gets from a peer is checked
+against the chunk digests the sender signed, so a peer cannot inject
+data.
+
+On top of resumable uploads, a swarm adds:
+
+    POST /upload/{upload_id}/swarm   (signed by the sender) the job's token and the other receivers' URLs
+    GET  /swarm/{file_hash}          byte ranges this receiver holds, for holders of the token
+    GET  /swarm/{file_hash}/data     those bytes, by HTTP Range, for holders of the token
+
+The sender keeps polling each receiver's upload status as usual, and
+sends a receiver whatever its peers have not delivered within SWARM_STALL
+seconds itself.
+"""
+import secrets
+from .hashing import merkle_chunk_count
+
+SWARM_MIN_SIZE = 64 * 1024 * 1024  # Smaller files are sent to every receiver directly
+SWARM_POLL = 0.5  # Seconds between availability and progress checks
+SWARM_STALL = 15  # Seconds without progress before the sender fills in the missing chunks itself
+SWARM_PULLS = 4  # Chunks a receiver fetches from its peers at once
+SWARM_TTL = 3600  # Seconds a receiver serves a job's chunks to peers after joining it
+TOKEN_HEADER = 'X-MyShare-Swarm-Token'
+
+
+class SwarmJob:
+    """Sender-side state of one file in a swarm send."""
+
+    def __init__(self, file_hash, size, chunk_size):
+        self.file_hash = file_hash
+        self.size = size
+        self.chunk_size = chunk_size
+        self.token = secrets.token_urlsafe(32)  # Lets the receivers fetch from each other
+        self.unseeded = list(range(merkle_chunk_count(size, chunk_size)))
+        self.peers = []  # Base URLs of the receivers that joined, in order
+
+    def take(self, held=()):
+        """Claim the next chunk no receiver has been sent yet, skipping those in held; None when done."""
+        for i, index in enumerate(self.unseeded):
+            if index not in held:
+                del self.unseeded[i]
+                return index
+        return None
+
+    def untake(self, index):
+        """Give back a chunk whose upload failed, so another receiver seeds it."""
+        self.unseeded.insert(0, index)
+
+    def chunk(self, index):
+        """(offset, length) of a chunk."""
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+
+class Swarm:
+    """Swarm jobs of one send, shared by the per-receiver clients like SharedReads."""
+
+    def __init__(self):
+        self.jobs = {}  # file_hash -> SwarmJob
+        self.seeded_bytes = 0
+
+    def job(self, file_hash, size, chunk_size):
+        if file_hash not in self.jobs:
+            self.jobs[file_hash] = SwarmJob(file_hash, size, chunk_size)
+        return self.jobs[file_hash]
+
+    def stats(self):
+        return {'seeded_bytes': self.seeded_bytes}
+
+
+def held_chunks(ranges, size, chunk_size):
+    """Indices of the chunks that sorted, merged [start, end) ranges cover completely."""
+    held = set()
+    for start, end in ranges:
+        index = -(-start // chunk_size)
+        while index * chunk_size < size and min((index + 1) * chunk_size, size) <= end:
+            held.add(index)
+            index += 1
+    return held
+
+
+def rarest_first(wanted, availability, limit):
+    """Pick up to limit chunks from wanted that some peer holds, rarest first.
+
+    availability maps chunk index -> peer URLs holding it. Returns
+    (index, peer URLs) pairs. Fetching rare chunks first spreads them
+    before the one peer that has them is busy or gone.
+    """
+    candidates = [(len(availability[index]), index) for index in wanted if availability.get(index)]
+    candidates.sort()
+    return [(index, availability[index]) for _, index in candidates[:limit]]
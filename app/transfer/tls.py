@@ -0,0 +1,99 @@
+"""TLS contexts that resume sessions with peers they have talked to before.
+
+A full handshake against the RSA-2048 identity certificate costs far more
+than a small transfer. The client context remembers the latest session per
+peer host, including TLS 1.3 tickets, and offers it on the next connection,
+so repeated connections to a known device skip the full handshake.
+Both sides count handshakes and resumptions so the hit rate can be checked.
+
+Python cannot serialize SSL sessions, and a session is only accepted by the
+context that created it. The cache therefore lives as long as the process.
+Repeated CLI invocations share it by going through the background agent.
+"""
+import collections
+import ssl
+import threading
+
+MAX_CACHED_SESSIONS = 256  # Peer hosts whose latest session is remembered
+
+_client_context = None
+
+
+class ResumptionStats:
+    def __init__(self):
+        self.handshakes = 0
+        self.resumed = 0
+
+    def as_dict(self):
+        return {'handshakes': self.handshakes, 'resumed': self.resumed}
+
+    def since(self, before):
+        """Counts accumulated after an earlier as_dict() snapshot."""
+        return {key: value - before[key] for key, value in self.as_dict().items()}
+
+
+class _TrackedSSLObject(ssl.SSLObject):
+    def do_handshake(self):
+        super().do_handshake()
+        self.context.handshake_done(self)
+
+
+class ResumingContext(ssl.SSLContext):
+    """SSLContext that offers cached sessions to servers and counts resumptions.
+
+    asyncio (and so aiohttp) drives TLS through wrap_bio(), which is where
+    a remembered session is attached to a new client connection.
+    """
+
+    def __init__(self, protocol):
+        super().__init__()
+        self.sslobject_class = _TrackedSSLObject
+        self.stats = ResumptionStats()
+        self.connections = collections.OrderedDict()  # host -> SSLObject of its latest connection
+        self.cache_lock = threading.Lock()  # Parallel streams handshake from several threads
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side and server_hostname:
+            session = self.cached_session(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def cached_session(self, host):
+        with self.cache_lock:
+            sslobj = self.connections.get(host)
+        if sslobj is None:
+            return None
+        # TLS 1.3 tickets arrive after the handshake, so the session is read only now
+        session = sslobj.session
+        if session is None or not (session.has_ticket or session.id):
+            return None
+        return session
+
+    def handshake_done(self, sslobj):
+        with self.cache_lock:
+            self.stats.handshakes += 1
+            if sslobj.session_reused:
+                self.stats.resumed += 1
+            host = sslobj.server_hostname
+            if not sslobj.server_side and host:
+                self.connections[host] = sslobj
+                self.connections.move_to_end(host)
+                while len(self.connections) > MAX_CACHED_SESSIONS:
+                    self.connections.popitem(last=False)
+
+
+def client_context():
+    """The process-wide client context; peers are authenticated by signatures, not certificates."""
+    global _client_context
+    if _client_context is None:
+        context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        _client_context = context
+    return _client_context
+
+
+def server_context(cert_file, key_file):
+    """Server context that issues session tickets and counts resumed handshakes."""
+    context = ResumingContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(str(cert_file), str(key_file))
+    return context
@@ -0,0 +1,209 @@
+"""Server-side tracking of resumable, partially received uploads."""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+SESSION_TTL = 7 * 24 * 3600  # Drop partial uploads untouched for a week
+
+
+def preallocate(f, size):
+    """Reserve size bytes for an open file and set its length, so writes land in place."""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass  # Not supported by this filesystem; truncate below still sizes the file
+    f.truncate(size)
+
+
+class UploadSession:
+    """A partial upload: a metadata file plus the bytes received so far."""
+
+    def __init__(self, partial_dir, upload_id, meta):
+        self.upload_id = upload_id
+        self.meta = meta
+        self.meta_path = partial_dir / f'{upload_id}.json'
+        self.part_path = partial_dir / f'{upload_id}.part'
+        self.lock = asyncio.Lock()
+        self.swarm_lock = asyncio.Lock()  # Held while writing a chunk fetched from a peer; finalize waits for it
+        self.save_lock = threading.Lock()  # save() may run on several executor threads
+
+    @property
+    def size(self):
+        return self.meta['size']
+
+    @property
+    def ranges(self):
+        """Sorted, merged [start, end) byte ranges durably received so far."""
+        return self.meta.setdefault('ranges', [])
+
+    @property
+    def offset(self):
+        """Length of the contiguous prefix received, i.e. where a single stream resumes."""
+        ranges = self.ranges
+        if ranges and ranges[0][0] == 0:
+            return ranges[0][1]
+        return 0
+
+    @property
+    def chunk_size(self):
+        """Merkle chunk size when chunks are verified on arrival, else None."""
+        return self.meta.get('chunk_size')
+
+    @property
+    def chunk_hashes(self):
+        return self.meta.get('chunk_hashes')
+
+    def is_complete(self):
+        return self.offset == self.size
+
+    def add_range(self, start, end):
+        """Record that bytes [start, end) are on disk, merging adjacent ranges."""
+        if end <= start:
+            return
+        merged = []
+        for range_start, range_end in sorted(self.ranges + [[start, end]]):
+            if merged and range_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], range_end)
+            else:
+                merged.append([range_start, range_end])
+        self.meta['ranges'] = merged
+
+    def preallocate(self):
+        """Create the part file at its final size so ranges can be written at any offset."""
+        with open(self.part_path, 'wb') as f:
+            preallocate(f, self.size)
+
+    def save(self):
+        with self.save_lock:
+            self.meta['updated_at'] = time.time()
+            tmp_path = self.meta_path.with_suffix('.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.meta, f)
+            os.replace(tmp_path, self.meta_path)
+
+    def delete(self):
+        self.meta_path.unlink(missing_ok=True)
+        self.part_path.unlink(missing_ok=True)
+
+
+class ChunkVerificationError(Exception):
+    """A received chunk does not match the digest announced by the sender."""
+
+
+class RangeWriter:
+    """Write a run of bytes into a session's part file starting at an offset.
+
+    For sessions with announced chunk digests, every chunk is collected in
+    memory and verified before any of it is written, and only verified
+    chunks are recorded as received. A bad chunk is rejected on its own and
+    simply sent again, and never overwrites a good copy of the same chunk
+    already on disk. Call close() once the run ends, even if it ended early.
+    """
+
+    def __init__(self, session, f, offset):
+        self.session = session
+        self.f = f
+        self.start = offset
+        self.position = offset
+        self.verified_end = offset
+        self.buffer = None  # The current chunk's bytes, when chunks are verified
+        if session.chunk_size:
+            if offset % session.chunk_size:
+                raise ChunkVerificationError(f"Offset {offset} is not chunk aligned")
+            self.buffer = bytearray()
+        f.seek(offset)
+
+    def write(self, data):
+        """Write data, raising ChunkVerificationError when a chunk does not match."""
+        if len(data) > self.session.size - self.position:
+            raise ValueError("Upload exceeds declared size")
+        if self.buffer is None:
+            self.f.write(data)
+            self.position += len(data)
+            self.verified_end = self.position
+            return
+        chunk_size = self.session.chunk_size
+        view = memoryview(data)
+        while view:
+            chunk_end = min((self.position // chunk_size + 1) * chunk_size, self.session.size)
+            piece = view[:chunk_end - self.position]
+            self.buffer += piece
+            self.position += len(piece)
+            view = view[len(piece):]
+            if self.position == chunk_end:
+                index = (chunk_end - 1) // chunk_size
+                if hashlib.sha256(self.buffer).hexdigest() != self.session.chunk_hashes[index]:
+                    raise ChunkVerificationError(f"Chunk {index} failed verification")
+                self.f.write(self.buffer)
+                self.verified_end = chunk_end
+                self.buffer = bytearray()
+
+    def close(self):
+        self.session.add_range(self.start, self.verified_end)
+
+
+class UploadSessionStore:
+    """Partial uploads persisted under a directory so they survive restarts."""
+
+    def __init__(self, partial_dir):
+        self.partial_dir = partial_dir
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        self.sessions = {}
+        self.load()
+
+    def load(self):
+        """Load sessions from disk, discarding expired or unreadable ones."""
+        now = time.time()
+        for meta_path in self.partial_dir.glob('*.json'):
+            upload_id = meta_path.stem
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = None
+            session = UploadSession(self.partial_dir, upload_id, meta or {})
+            if meta is None or now - meta.get('updated_at', 0) > SESSION_TTL:
+                session.delete()
+                continue
+            if 'ranges' not in meta:
+                # Written before ranges were tracked: the part file is a plain prefix
+                received = session.part_path.stat().st_size if session.part_path.exists() else 0
+                session.add_range(0, received)
+                with open(session.part_path, 'ab') as f:
+                    f.truncate(session.size)
+                session.save()
+            self.sessions[upload_id] = session
+
+    def get(self, upload_id):
+        return self.sessions.get(upload_id)
+
+    def find(self, sender_id, receiver_id, file_hash, filename, relpath):
+        """Find an unfinished upload of the same content to the same place from the same sender.
+
+        Identical files sent to different paths get a session each, since
+        finalizing a session stores it at its own path only.
+        """
+        for session in self.sessions.values():
+            meta = session.meta
+            if (meta['sender_id'] == sender_id and meta['receiver_id'] == receiver_id
+                    and meta['file_hash'] == file_hash and meta['filename'] == filename
+                    and meta.get('relpath') == relpath):
+                return session
+        return None
+
+    def create(self, meta):
+        upload_id = uuid.uuid4().hex
+        session = UploadSession(self.partial_dir, upload_id, dict(meta, created_at=time.time(), ranges=[]))
+        session.preallocate()
+        session.save()
+        self.sessions[upload_id] = session
+        return session
+
+    def remove(self, session):
+        self.sessions.pop(session.upload_id, None)
+        session.delete()
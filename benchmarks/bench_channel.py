@@ -0,0 +1,133 @@
+"""Microbenchmark: multipart upload path vs. the binary framed data channel.
+
+Starts a receiver in a child process on localhost (throwaway identities
+under temporary home directories), sends the same file repeatedly through
+each data path and reports throughput and CPU seconds per GB on both ends.
+
+    python benchmarks/bench_channel.py --size-mb 512 --repeat 3
+"""
+import argparse
+import asyncio
+import os
+import pathlib
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+GB = 1024 ** 3
+
+
+def serve(port, plain_channel):
+    """Child process: run a TransferServer until SIGTERM."""
+    from app.security.identity import Identity
+    from app.security.trust_store import TrustStore
+    from app.transfer.server import TransferServer
+
+    server = TransferServer(Identity(), TrustStore(), port, channel_tls=not plain_channel)
+
+    async def run():
+        task = asyncio.create_task(server.run())
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        await stop
+        task.cancel()
+
+    asyncio.run(run())
+
+
+async def wait_for_info(port):
+    from aiohttp import ClientSession
+    async with ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f"https://127.0.0.1:{port}/info", ssl=False) as resp:
+                    return await resp.json()
+            except OSError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("Receiver did not start")
+
+
+def run_mode(mode, file_path, repeat, port):
+    """Send file_path `repeat` times through one data path; return measurements."""
+    import app.transfer.client as client_module
+    from app.security.identity import Identity
+    from app.security.trust_store import TrustStore
+
+    server_home = tempfile.mkdtemp(prefix='myshare-bench-rx-')
+    env = dict(os.environ, HOME=server_home)
+    args = [sys.executable, __file__, '--serve', str(port)]
+    if mode == 'channel-plain':
+        args.append('--plain-channel')
+    child = subprocess.Popen(args, env=env)
+    try:
+        info = asyncio.run(wait_for_info(port))
+        client = client_module.TransferClient(Identity(), TrustStore(), compress=False,
+                                              use_channel=mode.startswith('channel'))
+        # The multipart path is only used below the resumable threshold; lift it for this run
+        saved_threshold = client_module.RESUMABLE_THRESHOLD
+        if mode == 'multipart':
+            client_module.RESUMABLE_THRESHOLD = float('inf')
+        try:
+            cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+            start = time.monotonic()
+            for i in range(repeat):
+                asyncio.run(client.send_file('127.0.0.1', port, file_path, info['device_id'],
+                                             relpath=f'bench-{i}', check_existing=False))
+            elapsed = time.monotonic() - start
+            cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+        finally:
+            client_module.RESUMABLE_THRESHOLD = saved_threshold
+    finally:
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        child.send_signal(signal.SIGTERM)
+        child.wait()
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    total = file_path.stat().st_size * repeat
+    client_cpu = (cpu_end.ru_utime + cpu_end.ru_stime) - (cpu_start.ru_utime + cpu_start.ru_stime)
+    server_cpu = ((children_after.ru_utime + children_after.ru_stime)
+                  - (children_before.ru_utime + children_before.ru_stime))
+    return {
+        'mode': mode,
+        'seconds': elapsed,
+        'mb_per_s': total / elapsed / 1024 ** 2,
+        'client_cpu_per_gb': client_cpu / (total / GB),
+        'server_cpu_per_gb': server_cpu / (total / GB),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--port', type=int, default=18780)
+    parser.add_argument('--modes', default='multipart,channel-tls,channel-plain')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--plain-channel', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.plain_channel)
+        return
+
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='myshare-bench-tx-')
+    file_path = pathlib.Path(os.environ['HOME']) / 'payload.bin'
+    with open(file_path, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    print(f"{'mode':<14} {'seconds':>8} {'MB/s':>8} {'client s/GB':>12} {'server s/GB':>12}")
+    for mode in args.modes.split(','):
+        result = run_mode(mode, file_path, args.repeat, args.port)
+        print(f"{result['mode']:<14} {result['seconds']:>8.2f} {result['mb_per_s']:>8.1f} "
+              f"{result['client_cpu_per_gb']:>12.2f} {result['server_cpu_per_gb']:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
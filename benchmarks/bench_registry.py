@@ -0,0 +1,66 @@
+"""Benchmark: recording a browse that finds many devices, then looking them up.
+
+Adds N devices to a fresh registry one by one, as `search` does, and
+again as one batch, as a lookup's browse does, then looks each device up
+by short ID, device ID and fingerprint. Every operation should cost about
+the same however many devices are registered.
+
+    python benchmarks/bench_registry.py --devices 100,1000,10000
+"""
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from app.device_registry import DeviceRegistry
+
+
+def run(count):
+    """Return seconds per device for one-by-one adds, batched adds and each kind of lookup."""
+    devices = [(str(uuid.uuid4()), f'host-{i}', f'10.0.{i // 256 % 256}.{i % 256}', 8080, uuid.uuid4().hex)
+               for i in range(count)]
+    timings = {}
+    with tempfile.TemporaryDirectory() as config_dir:
+        registry = DeviceRegistry(pathlib.Path(config_dir))
+        start = time.perf_counter()
+        short_ids = [registry.add_device(*device) for device in devices]
+        timings['add'] = time.perf_counter() - start
+        start = time.perf_counter()
+        with registry.batch():
+            for device in devices:
+                registry.add_device(*device)
+        timings['batched add'] = time.perf_counter() - start
+        start = time.perf_counter()
+        for short_id in short_ids:
+            registry.get_device_by_short_id(short_id)
+        timings['by short ID'] = time.perf_counter() - start
+        start = time.perf_counter()
+        for device in devices:
+            registry.get_device_by_full_id(device[0])
+        timings['by device ID'] = time.perf_counter() - start
+        start = time.perf_counter()
+        for device in devices:
+            registry.get_device_by_fingerprint(device[4])
+        timings['by fingerprint'] = time.perf_counter() - start
+        registry.close()
+    return {name: seconds / count for name, seconds in timings.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', default='100,1000,10000', help='Comma-separated device counts')
+    args = parser.parse_args()
+
+    print(f"{'devices':>8} " + " ".join(f"{name:>15}" for name in
+                                       ('add', 'batched add', 'by short ID', 'by device ID', 'by fingerprint')))
+    for count in [int(n) for n in args.devices.split(',')]:
+        timings = run(count)
+        print(f"{count:>8} " + " ".join(f"{seconds * 1e6:>12.1f} us" for seconds in timings.values()))
+
+
+if __name__ == '__main__':
+    main()
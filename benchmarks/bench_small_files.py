@@ -0,0 +1,109 @@
+"""Benchmark: files per second when sending a directory of many small files.
+
+Starts a receiver in a child process on localhost (throwaway identities
+under temporary home directories), creates a directory tree of small
+files and sends it with small-file packs, and optionally one request per
+file, reporting files per second for each. A second send of the same
+tree measures the case where the receiver already has everything.
+
+    python benchmarks/bench_small_files.py --files 100000 --modes pack,single --fsync never
+"""
+import argparse
+import asyncio
+import os
+import pathlib
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from bench_channel import wait_for_info
+
+
+def serve(port, fsync):
+    """Child process: run a TransferServer until SIGTERM."""
+    from app.security.identity import Identity
+    from app.security.trust_store import TrustStore
+    from app.transfer.server import TransferServer
+
+    server = TransferServer(Identity(), TrustStore(), port, fsync=fsync)
+
+    async def run():
+        task = asyncio.create_task(server.run())
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        await stop
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def make_tree(root, count, max_size):
+    random.seed(0)
+    for i in range(count):
+        path = root / f'd{i % 100:02d}' / f'{i:06d}.txt'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(random.randint(0, max_size)))
+
+
+def run_mode(mode, tree, port, fsync):
+    """Send the tree twice through one path; return (first, repeat) seconds."""
+    import app.transfer.client as client_module
+    from app.security.identity import Identity
+    from app.security.trust_store import TrustStore
+
+    server_home = tempfile.mkdtemp(prefix='myshare-bench-rx-')
+    env = dict(os.environ, HOME=server_home)
+    child = subprocess.Popen([sys.executable, __file__, '--serve', str(port), '--fsync', fsync], env=env)
+    saved_min_files = client_module.PACK_MIN_FILES
+    if mode == 'single':
+        client_module.PACK_MIN_FILES = float('inf')
+    try:
+        info = asyncio.run(wait_for_info(port))
+        client = client_module.TransferClient(Identity(), TrustStore(), compress=False)
+        times = []
+        for _ in range(2):
+            start = time.monotonic()
+            summary = asyncio.run(client.send_files('127.0.0.1', port, [tree], info['device_id']))
+            times.append(time.monotonic() - start)
+            if summary['failed']:
+                sys.exit(f"{mode}: {len(summary['failed'])} files failed, e.g. {summary['failed'][0]}")
+    finally:
+        client_module.PACK_MIN_FILES = saved_min_files
+        child.send_signal(signal.SIGTERM)
+        child.wait()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100_000)
+    parser.add_argument('--max-size', type=int, default=4096, help='Largest file in bytes; sizes are uniform')
+    parser.add_argument('--port', type=int, default=18781)
+    parser.add_argument('--modes', default='pack', help='Comma-separated: pack, single')
+    parser.add_argument('--fsync', default='always', choices=['always', 'finalize', 'never'],
+                        help="Receiver's fsync policy")
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.fsync)
+        return
+
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='myshare-bench-tx-')
+    tree = pathlib.Path(os.environ['HOME']) / 'tree'
+    make_tree(tree, args.files, args.max_size)
+
+    print(f"{'mode':<8} {'seconds':>8} {'files/s':>9} {'repeat s':>9} {'repeat files/s':>15}")
+    for mode in args.modes.split(','):
+        first, repeat = run_mode(mode, tree, args.port, args.fsync)
+        print(f"{mode:<8} {first:>8.2f} {args.files / first:>9.0f} {repeat:>9.2f} {args.files / repeat:>15.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Benchmark: cold start-up time of each CLI command, checked against a budget.
+
+Runs every command below in a fresh interpreter, --runs times each,
+under a throwaway home directory and with no agent running, and takes
+the median wall time. Commands that only read local state must stay
+cheap. A command that goes over its budget, usually because a module
+started importing aiohttp, zeroconf, cryptography or OpenCV at the top,
+makes the script exit non-zero. Scale the budgets for slower machines
+with --scale.
+
+    python benchmarks/bench_startup.py --runs 7
+"""
+import argparse
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# (arguments, budget in ms); {file} is replaced with a small file to grab
+COMMANDS = [
+    (['--help'], 200),
+    (['grabbed'], 200),
+    (['grab', '{file}'], 200),
+    (['release'], 200),
+    (['agent', '--status'], 200),
+    (['listen', '--help'], 200),
+    (['search', '--help'], 200),
+    (['send', '--help'], 200),
+    (['trust', '--help'], 200),
+    (['bench', '--help'], 200),
+    # Loads the registry and trust store, fails to find the device and exits
+    (['send', '--no-agent', '0001', '{file}'], 400),
+]
+
+
+def run(args, env):
+    """Wall seconds for one run of `python -m app.main args`."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'app.main', *args], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Runs per command; the median counts')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply every budget by this')
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='myshare-bench-startup-')
+    env = dict(os.environ, HOME=home)
+    grab_file = pathlib.Path(home) / 'grab.txt'
+    grab_file.write_text('grab me\n')
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    interpreter = time.perf_counter() - start
+    print(f"Bare interpreter: {interpreter * 1000:.0f} ms")
+    print(f"{'command':<40} {'median ms':>10} {'budget ms':>10}")
+    over = 0
+    for command, budget in COMMANDS:
+        command = [str(grab_file) if arg == '{file}' else arg for arg in command]
+        median = statistics.median(run(command, env) for _ in range(args.runs)) * 1000
+        budget *= args.scale
+        over += median > budget
+        label = ' '.join(arg if arg != str(grab_file) else 'FILE' for arg in command)
+        print(f"{label:<40} {median:>10.0f} {budget:>10.0f}" + ("  OVER BUDGET" if median > budget else ""))
+    if over:
+        sys.exit(f"{over} command(s) over their start-up budget")
+
+
+if __name__ == '__main__':
+    main()
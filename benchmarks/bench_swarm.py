@@ -0,0 +1,131 @@
+"""Benchmark: time to get one large file onto N receivers, direct fan-out vs. swarm.
+
+Starts N receivers in child processes on localhost (throwaway identities
+under temporary home directories) and sends one file to all of them,
+once as a plain fan-out and once as a swarm. Loopback has no uplink
+bottleneck, so the sender's reads are throttled to --uplink MB/s in
+total, standing in for its network link; the receivers pass chunks to
+each other unthrottled, as peers on a switched LAN would. Direct sends
+should take about N times as long as one; swarm sends much less.
+
+    python benchmarks/bench_swarm.py --size-mb 256 --receivers 1,2,4,8 --uplink 50
+"""
+import argparse
+import asyncio
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from bench_channel import wait_for_info
+
+MB = 1000 * 1000
+
+
+def serve(port):
+    """Child process: run a TransferServer until SIGTERM."""
+    from app.security.identity import Identity
+    from app.security.trust_store import TrustStore
+    from app.transfer.server import TransferServer
+
+    server = TransferServer(Identity(), TrustStore(), port, fsync='never')
+
+    async def run():
+        task = asyncio.create_task(server.run())
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        await stop
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def throttle_uplink(client_class, rate):
+    """Make every read the sender sends from wait its turn under a shared rate limit."""
+    read_chunk = client_class._read_chunk
+    lock = threading.Lock()
+    state = {'free_at': time.monotonic()}
+
+    def throttled(self, f, offset, length):
+        data = read_chunk(self, f, offset, length)
+        with lock:
+            now = time.monotonic()
+            state['free_at'] = max(state['free_at'], now) + len(data) / rate
+            delay = state['free_at'] - now
+        time.sleep(delay)
+        return data
+
+    client_class._read_chunk = throttled
+
+
+def run(count, swarm, file_path, base_port):
+    """Send file_path to count fresh receivers; return (seconds, bytes the sender uploaded)."""
+    from app.security.identity import Identity
+    from app.security.trust_store import TrustStore
+    from app.transfer.client import TransferClient
+
+    children = []
+    try:
+        for i in range(count):
+            env = dict(os.environ, HOME=tempfile.mkdtemp(prefix='myshare-bench-rx-'))
+            children.append(subprocess.Popen([sys.executable, __file__, '--serve', str(base_port + i)], env=env,
+                                             stdout=subprocess.DEVNULL))
+        targets = [('127.0.0.1', base_port + i, asyncio.run(wait_for_info(base_port + i))['device_id'])
+                   for i in range(count)]
+        client = TransferClient(Identity(), TrustStore(), compress=False)
+        start = time.monotonic()
+        results, stats = asyncio.run(client.send_files_many(targets, [file_path], swarm=swarm))
+        elapsed = time.monotonic() - start
+        for receiver_id, summary in results.items():
+            if 'error' in summary or summary['failed']:
+                sys.exit(f"Send to {receiver_id} failed: {summary.get('error') or summary['failed']}")
+    finally:
+        for child in children:
+            child.send_signal(signal.SIGTERM)
+        for child in children:
+            child.wait()
+    size = os.path.getsize(file_path)
+    return elapsed, stats.get('seeded_bytes', size * count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--receivers', default='1,2,4,8', help='Comma-separated receiver counts')
+    parser.add_argument('--uplink', type=float, default=50, help="Sender's upload rate in MB/s")
+    parser.add_argument('--modes', default='direct,swarm', help='Comma-separated: direct, swarm')
+    parser.add_argument('--port', type=int, default=18881, help='First receiver port')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    from app.transfer.client import TransferClient
+    throttle_uplink(TransferClient, args.uplink * MB)
+
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='myshare-bench-tx-')
+    file_path = pathlib.Path(os.environ['HOME']) / 'large.bin'
+    with open(file_path, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(MB))
+
+    print(f"{'receivers':>9} {'mode':<7} {'seconds':>8} {'uploaded MB':>12} {'vs one receiver':>16}")
+    baseline = {}
+    for count in [int(n) for n in args.receivers.split(',')]:
+        for mode in args.modes.split(','):
+            seconds, uploaded = run(count, mode == 'swarm', str(file_path), args.port)
+            baseline.setdefault(mode, seconds)
+            print(f"{count:>9} {mode:<7} {seconds:>8.2f} {uploaded / MB:>12.0f} {seconds / baseline[mode]:>15.2f}x")
+
+
+if __name__ == '__main__':
+    main()
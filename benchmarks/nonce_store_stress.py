@@ -0,0 +1,102 @@
+"""Stress test for the receiver's replay-protection nonce store.
+
+Pushes millions of nonces through a NonceStore with a short window, so
+buckets expire many times during the run. When the live set hits
+max_nonces the floor rises and older timestamps are refused; those are
+counted separately. Checks along the way that:
+
+- replays of live nonces are refused,
+- the live count never exceeds max_nonces,
+- the journal stays compact,
+- a reloaded store still refuses everything it had accepted.
+
+Reports insert throughput, peak memory and journal size.
+
+    python benchmarks/nonce_store_stress.py --nonces 5000000 --window 4
+"""
+import argparse
+import pathlib
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from app.transfer.nonce_store import NonceStore, RECORD
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit(f"FAIL: {message}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nonces', type=int, default=5_000_000)
+    parser.add_argument('--window', type=float, default=4.0, help='Replay window in seconds')
+    parser.add_argument('--bucket-seconds', type=float, default=0.25)
+    parser.add_argument('--max-nonces', type=int, default=1_000_000)
+    parser.add_argument('--memory', action='store_true',
+                        help='Trace Python allocations for the live set (slows the run down)')
+    args = parser.parse_args()
+
+    path = pathlib.Path(tempfile.mkdtemp(prefix='myshare-nonces')) / 'nonces.bin'
+    store = NonceStore(path, args.window, args.bucket_seconds, args.max_nonces)
+    if args.memory:
+        tracemalloc.start()
+    recent = []
+    peak_live = 0
+    below_floor = 0
+    start = time.perf_counter()
+    for i in range(args.nonces):
+        nonce = str(uuid.uuid4())
+        timestamp = time.time() + random.uniform(-args.window / 2, args.window / 2)
+        if timestamp < store.floor:
+            # Over max_nonces the store refuses old timestamps instead of forgetting nonces
+            check(store.seen(nonce, timestamp), "nonce below the floor accepted")
+            below_floor += 1
+            continue
+        check(not store.seen(nonce, timestamp), "fresh nonce reported as seen")
+        store.add(nonce, timestamp)
+        peak_live = max(peak_live, len(store))
+        if i % 1000 == 0 and timestamp >= store.floor:
+            recent.append((nonce, timestamp))
+            recent = recent[-1000:]
+            check(store.seen(nonce, timestamp), "replay of a live nonce accepted")
+            check(len(store) <= args.max_nonces, "live nonces exceed max_nonces")
+    elapsed = time.perf_counter() - start
+    if args.memory:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    journal_size = path.stat().st_size
+    live = len(store)
+    check(journal_size <= (2 * live + 100_001) * RECORD.size + 16, "journal was not compacted")
+    store.close()
+
+    start_load = time.perf_counter()
+    reloaded = NonceStore(path, args.window, args.bucket_seconds, args.max_nonces)
+    load_time = time.perf_counter() - start_load
+    still_live = [(n, t) for n, t in recent if t >= time.time() - args.window + args.bucket_seconds]
+    check(all(reloaded.seen(n, t) for n, t in still_live), "reloaded store accepted a replay")
+
+    print(f"nonces pushed:      {args.nonces:,} in {elapsed:.1f}s ({args.nonces / elapsed:,.0f}/s, "
+          f"seen() + add() each)")
+    print(f"live at end:        {live:,} (peak {peak_live:,}, limit {args.max_nonces:,}), "
+          f"{below_floor:,} refused below the floor")
+    print(f"journal on disk:    {journal_size / 1e6:.1f} MB before close, "
+          f"{path.stat().st_size / 1e6:.1f} MB compacted")
+    print(f"reload:             {load_time:.2f}s, {len(reloaded):,} live, "
+          f"{len(still_live)} sampled replays refused")
+    if args.memory:
+        print(f"traced peak memory: {traced_peak / 1e6:.1f} MB")
+    print(f"max RSS:            {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    reloaded.close()
+
+
+if __name__ == '__main__':
+    main()